@@ -14,6 +14,7 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import asyncio
 import re
 import sys
 import logging
@@ -23,7 +24,14 @@ class Collector:
     Collectors are plugins that return a specific set of data items pertinent to
     a given Monitor object every time their collect() method is called.  Context
     is given by the Monitor properties that are used to init the Collector.
+
+    Collectors may also provide a collect_many(collectors) class method to
+    collect for the Collectors of several Monitors at once, see
+    collect_bulk().
     """
+    # The run of collect() started by collect_async(), if any
+    _pending = None
+
     def __init__(self, properties):
         """
         The Collector constructor should use the passed-in properties to
@@ -41,6 +49,27 @@ class Collector:
         """
         return {}
 
+    async def collect_async(self):
+        """
+        The asyncio version of collect(), used when the guests are collected
+        by an event loop.  This default runs collect() in the executor of the
+        loop.  A call that timed out keeps its executor thread until collect()
+        returns and the Collector raises CollectionError until then, so
+        collect() never runs twice at a time.
+        Override this method in collectors that can wait for their data
+        without blocking a thread.
+        Return: A dictionary of statistics.
+        """
+        pending = self._pending
+        if pending is not None and not pending.done():
+            raise CollectionError("%s is still collecting" %
+                                  self.__class__.__name__)
+        loop = asyncio.get_running_loop()
+        pending = self._pending = loop.run_in_executor(None, self.collect)
+        # Nobody waits for the result of a call that timed out
+        pending.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return await asyncio.shield(pending)
+
     def getFields(self):
         """
         Used to query the names of mandatory statistics fields that this
@@ -64,6 +93,42 @@ class Collector:
         """
         return set()
 
+def collect_bulk(collectors, method):
+    """
+    Implement collect_many() for Collectors that read one hypervisor interface
+    method per guest: call the bulk version of that method, like
+    getAllVmMemoryStats, once for all guests of each interface and hand the
+    value for each guest to the process() method of its Collector.  Each
+    Collector must have the hypervisor_iface and uuid attributes.  Interfaces
+    without the bulk method are called through collect() as usual.
+    Return: A list with the dictionary returned by, or the exception raised
+            by, each of the collectors
+    """
+    results = [None] * len(collectors)
+    groups = {}
+    for i, c in enumerate(collectors):
+        iface = c.hypervisor_iface
+        groups.setdefault(id(iface), (iface, []))[1].append(i)
+
+    for iface, indexes in groups.values():
+        bulk = getattr(iface, method, None)
+        values = {}
+        if bulk is not None:
+            try:
+                values = bulk([collectors[i].uuid for i in indexes])
+            except Exception as e:
+                values = dict((collectors[i].uuid, e) for i in indexes)
+        for i in indexes:
+            c = collectors[i]
+            try:
+                if bulk is None:
+                    results[i] = c.collect()
+                else:
+                    results[i] = c.process(values.get(c.uuid))
+            except Exception as e:
+                results[i] = e
+    return results
+
 def get_collectors(config_str, properties, global_config):
     """
     Initialize a set of new Collector instances for a Monitor.
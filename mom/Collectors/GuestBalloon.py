@@ -38,7 +38,18 @@ class GuestBalloon(Collector):
         self.balloon_info_available = False
 
     def collect(self):
-        stat = self.hypervisor_iface.getVmBalloonInfo(self.uuid)
+        return self.process(self.hypervisor_iface.getVmBalloonInfo(self.uuid))
+
+    @classmethod
+    def collect_many(cls, collectors):
+        return collect_bulk(collectors, 'getAllVmBalloonInfo')
+
+    def process(self, stat):
+        """
+        Handle the value, or exception, getVmBalloonInfo() returned
+        """
+        if isinstance(stat, Exception):
+            raise stat
         if stat is None:
             self.stats_error('getVmBalloonInfo() is not ready')
         else:
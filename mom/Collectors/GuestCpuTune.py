@@ -41,8 +41,18 @@ class GuestCpuTune(Collector):
         self.cpu_tune_info_available = False
 
     def collect(self):
-        stat = self.hypervisor_iface.getVmCpuTuneInfo(self.uuid)
+        return self.process(self.hypervisor_iface.getVmCpuTuneInfo(self.uuid))
 
+    @classmethod
+    def collect_many(cls, collectors):
+        return collect_bulk(collectors, 'getAllVmCpuTuneInfo')
+
+    def process(self, stat):
+        """
+        Handle the value, or exception, getVmCpuTuneInfo() returned
+        """
+        if isinstance(stat, Exception):
+            raise stat
         if stat is None:
             self.stats_error('getVmCpuTuneInfo() is not ready')
         else:
@@ -49,12 +49,26 @@ class GuestMemory(Collector):
         try:
             stat = self.hypervisor_iface.getVmMemoryStats(self.uuid)
         except HypervisorInterfaceError as e:
-            self.stats_error('getVmMemoryStats(): %s' % e)
+            stat = e
+        return self.process(stat)
+
+    @classmethod
+    def collect_many(cls, collectors):
+        return collect_bulk(collectors, 'getAllVmMemoryStats')
+
+    def process(self, stat):
+        """
+        Handle the value, or exception, getVmMemoryStats() returned
+        """
+        if isinstance(stat, HypervisorInterfaceError):
+            self.stats_error('getVmMemoryStats(): %s' % stat)
             # We don't raise a CollectionError here because a different
             # Collector (such as GuestQemuAgent) may be able to get them.
             # If not, the Monitor's collect method will detect the missing
             # fields anyway.
             return {}
+        elif isinstance(stat, Exception):
+            raise stat
         else:
             self.memstats_available = True
             return stat
@@ -14,10 +14,12 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import asyncio
 import socket
 from subprocess import *
 from mom.Collectors.Collector import *
 from mom.Collectors.HostMemory import HostMemory
+from mom.Collectors.ProcFile import SHARED_MAX_AGE, open_shared
 
 def sock_send(conn, msg):
     """
@@ -78,6 +80,9 @@ class GuestNetworkDaemon(Collector):
         self.ip = self.get_guest_ip(properties)
         self.port = 2187              # XXX: This needs to be configurable
         self.socket = None
+        # The connection of collect_async()
+        self.reader = None
+        self.writer = None
         self.state = 'ok'
 
     def get_guest_ip(self, properties):
@@ -139,7 +144,41 @@ class GuestNetworkDaemon(Collector):
                                   (self.name, msg))
 
         self.state = 'ok'
+        return self.parse(data)
 
+    async def collect_async(self):
+        if self.state == 'dead':
+            return {}
+        if self.ip is None:
+            self.state = 'dead'
+            raise CollectionError('No IP address for guest %s' % self.name)
+
+        if self.writer is None:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.ip, self.port)
+            except OSError as msg:
+                raise CollectionError('Network connection to %s failed: %s' %
+                                      (self.name, msg))
+        try:
+            self.writer.write(b"stats\n")
+            await self.writer.drain()
+            data = await self.reader.readline()
+            if len(data) == 0:
+                raise socket.error("Unable to receive on socket")
+        except (OSError, asyncio.CancelledError) as e:
+            # A timeout cancels the call and may leave the reply unread
+            self.writer.close()
+            self.reader = self.writer = None
+            if isinstance(e, OSError):
+                raise CollectionError('Network communication to %s failed: '
+                                      '%s' % (self.name, e))
+            raise
+
+        self.state = 'ok'
+        return self.parse(data.rstrip(b"\n").decode('utf-8'))
+
+    def parse(self, data):
         # Parse the data string
         result = {}
         for item in data.split(","):
@@ -169,9 +208,10 @@ class _Server:
     def __init__(self, config):
         self.config = config
         self.logger = logging.getLogger('mom.Collectors.GuestNetworkDaemon.Server')
-        # Borrow a HostMemory Collector to get the needed data
+        # Borrow a HostMemory Collector to get the needed data, the page
+        # faults come from the /proc/vmstat it parses
         self.collector = HostMemory(None)
-        self.vmstat = open_datafile("/proc/vmstat")
+        self.vmstat = open_shared("/proc/vmstat")
 
         # Socket Setup
         self.listen_ip = config.get('main', 'host')
@@ -184,8 +224,6 @@ class _Server:
 
     def __del__(self):
         sock_close(self.socket)
-        if self.vmstat is not None:
-            self.vmstat.close()
 
     def send_props(self, conn):
         response = "min_free:" + self.min_free + ",max_free:" + self.max_free
@@ -193,10 +231,9 @@ class _Server:
 
     def send_stats(self, conn):
         data = self.collector.collect()
-        self.vmstat.seek(0)
-        contents = self.vmstat.read()
-        minflt = parse_int("^pgfault (.*)", contents)
-        majflt = parse_int("^pgmajfault (.*)", contents)
+        vmstat = self.vmstat.fields(SHARED_MAX_AGE)
+        minflt = vmstat['pgfault']
+        majflt = vmstat['pgmajfault']
 
         response = "mem_available:%i,mem_unused:%i,swap_in:%i,swap_out:%i," \
                    "major_fault:%i,minor_fault:%i" % \
@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 from mom.Collectors.Collector import *
+from mom.Collectors.ProcFile import parse_fields
 from mom.Collectors.QemuGuestAgentClient import *
 
 class GuestQemuAgent(Collector):
@@ -139,26 +140,26 @@ class GuestQemuAgent(Collector):
     def collect(self):
         if not self.connect():
             raise CollectionError('Unable to connect to agent')
-        meminfo = self.getfile("/proc/meminfo")
-        vmstat = self.getfile("/proc/vmstat")
-
-        avail = parse_int("^MemTotal: (.*) kB", meminfo)
-        anon = parse_int("^AnonPages: (.*) kB", meminfo)
-        unused = parse_int("^MemFree: (.*) kB", meminfo)
-        buffers = parse_int("^Buffers: (.*) kB", meminfo)
-        cached = parse_int("^Cached: (.*) kB", meminfo)
-        swap_total = parse_int("^SwapTotal: (.*) kB", meminfo)
-        swap_free = parse_int("^SwapFree: (.*) kB", meminfo)
+        meminfo = parse_fields(self.getfile("/proc/meminfo"))
+        vmstat = parse_fields(self.getfile("/proc/vmstat"))
+
+        avail = meminfo.get('MemTotal')
+        anon = meminfo.get('AnonPages')
+        unused = meminfo.get('MemFree')
+        buffers = meminfo.get('Buffers')
+        cached = meminfo.get('Cached')
+        swap_total = meminfo.get('SwapTotal')
+        swap_free = meminfo.get('SwapFree')
         free = unused + buffers + cached
 
         # /proc/vmstat reports cumulative statistics so we must subtract the
         # previous values to get the difference since the last collection.
-        minflt = parse_int("^pgfault (.*)", vmstat)
-        majflt = parse_int("^pgmajfault (.*)", vmstat)
+        minflt = vmstat.get('pgfault')
+        majflt = vmstat.get('pgmajfault')
         self.swap_in_prev = self.swap_in_cur
         self.swap_out_prev = self.swap_out_cur
-        self.swap_in_cur = parse_int("^pswpin (.*)", vmstat)
-        self.swap_out_cur = parse_int("^pswpout (.*)", vmstat)
+        self.swap_in_cur = vmstat.get('pswpin')
+        self.swap_out_cur = vmstat.get('pswpout')
         if self.swap_in_prev is None:
             self.swap_in_prev = self.swap_in_cur
         if self.swap_out_prev is None:
@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 from mom.Collectors.Collector import *
+from mom.Collectors.ProcFile import ProcFile
 
 class GuestQemuProc(Collector):
     """
@@ -32,7 +33,11 @@ class GuestQemuProc(Collector):
         self.pid = properties['pid']
         self.pid_stat_file = None
         if self.pid is not None:
-            self.pid_stat_file = open_datafile("/proc/" + str(self.pid) + "/stat")
+            try:
+                self.pid_stat_file = ProcFile("/proc/%s/stat" % self.pid)
+            except OSError as e:
+                raise FatalError("GuestQemuProc: open %s failed: %s" %
+                                 (e.filename, e.strerror))
         self.prev_minor_faults = None
         self.prev_major_faults = None
 
@@ -45,10 +50,9 @@ class GuestQemuProc(Collector):
             return {}
 
         # Only report the change in these statistics since the last collection
-        self.pid_stat_file.seek(0)
         try:
             stats = self.pid_stat_file.read().split()
-        except IOError as e:
+        except OSError as e:
             raise CollectionError("Cannot read stat file: %s" % e.strerror)
         cur_minor_faults = int(stats[9])
         cur_major_faults = int(stats[11])
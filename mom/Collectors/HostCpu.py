@@ -20,19 +20,16 @@ class HostCpu(Collector):
     """
 
     def __init__(self, properties):
-        self.cpuinfo = open_datafile("/proc/cpuinfo")
-
-    def __del__(self):
-        if self.cpuinfo is not None:
-            self.cpuinfo.close()
+        # The number of CPUs does not change, count them once
+        cpuinfo = open_datafile("/proc/cpuinfo")
+        try:
+            self.cpu_count = count_occurrences("^processor.*:.*",
+                                               cpuinfo.read())
+        finally:
+            cpuinfo.close()
 
     def collect(self):
-        self.cpuinfo.seek(0)
-
-        contents = self.cpuinfo.read()
-        cpu_count = count_occurrences("^processor.*:.*", contents)
-
-        data = { 'cpu_count': cpu_count }
+        data = { 'cpu_count': self.cpu_count }
         return data
 
     def getFields(self):
@@ -15,8 +15,9 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import os
-from subprocess import *
 from mom.Collectors.Collector import *
+from mom.Collectors.ProcFile import ProcFile
+from mom.PidIndex import PidIndex
 
 class HostKSM(Collector):
     """
@@ -34,6 +35,13 @@ class HostKSM(Collector):
         ksmd_cpu_usage - The cpu usage of kernel thread ksmd during the monitor interval
         ksm_share_across_nodes - Toggle, policy_string, Share memory pages across all
                                  NUMA nodes = 1, default = 1
+
+    The shareable estimate is the virtual size of the qemu processes, or their
+    anonymous memory with shareable-estimate set to anonymous in the
+    [Collector: HostKSM] section.  The qemu processes are those running a
+    guest, with a -uuid option, not every process with qemu in its name as
+    with pgrep before: qemu helpers like qemu-ga or qemu-nbd are no longer
+    counted.
     """
 
     sysfs_keys = [ 'full_scans', 'pages_sharing', 'pages_unshared', 'run',
@@ -43,37 +51,57 @@ class HostKSM(Collector):
     def __init__(self, properties):
         self.open_files()
         self.interval = properties['interval']
+        try:
+            self.estimate = properties['config']['shareable-estimate']
+        except KeyError:
+            self.estimate = 'vsz'
+        if self.estimate not in ('vsz', 'anonymous'):
+            raise FatalError("HostKSM: unknown shareable-estimate %s" %
+                             self.estimate)
+        self.pid_index = PidIndex(pidfile_dirs=())
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
         self.pid = self._get_ksmd_pid()
+        self.ksmd_stat = None
+        if self.pid is not None:
+            try:
+                self.ksmd_stat = ProcFile('/proc/%s/stat' % self.pid)
+            except OSError:
+                self.pid = None
         self.last_jiff = self.get_ksmd_jiffies()
 
     def __del__(self):
-        for datum in self.sysfs_keys:
-            if datum in self.files and self.files[datum] is not None:
-                self.files[datum].close()
+        for file in getattr(self, 'files', {}).values():
+            file.close()
+        if getattr(self, 'ksmd_stat', None) is not None:
+            self.ksmd_stat.close()
 
     def _get_ksmd_pid(self):
-        proc = Popen(['pidof', 'ksmd'], stdout=PIPE)
-        out = proc.communicate()[0]
-        if proc.returncode == 0:
-            return int(out)
-        else:
-            return None
+        # Kernel threads are started early, ksmd has one of the first pids
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/%s/comm' % entry) as f:
+                    if f.read().strip() == 'ksmd':
+                        return int(entry)
+            except IOError:
+                continue
+        return None
 
     def open_files(self):
         self.files = {}
         for datum in self.sysfs_keys:
             name = '/sys/kernel/mm/ksm/%s' % datum
             try:
-                self.files[datum] = open(name, 'r')
-            except IOError as e:
+                self.files[datum] = ProcFile(name, 64)
+            except OSError as e:
                 raise FatalError("HostKSM: open %s failed: %s" % (name, e.strerror))
 
     def get_ksmd_jiffies(self):
         if self.pid is None:
             return 0
         else:
-            return sum(map(int, open('/proc/%s/stat' % self.pid)
-                       .read().split()[13:15]))
+            return sum(map(int, self.ksmd_stat.read().split()[13:15]))
 
     def get_ksmd_cpu_usage(self):
         """
@@ -93,25 +121,34 @@ class HostKSM(Collector):
         Estimate how much memory has been reported to KSM for potential sharing.
         We assume that qemu is reporting guest physical memory areas to KSM.
         """
-        try:
-            p1 = Popen(["pgrep", "qemu"], stdout=PIPE).communicate()[0]
-        except OSError:
-            raise CollectionError("HostKSM: Unable to execute pgrep")
-        pids = p1.split()
-        if len(pids) == 0:
-            return 0
-        ps_argv = ["ps", "-ovsz", "h"] + pids
-        p1 = Popen(ps_argv, stdout=PIPE).communicate()[0]
         mem_tot = 0
-        for mem in p1.split():
-            mem_tot = mem_tot + int(mem)
+        for pid in self.pid_index.qemu_pids(refresh=True):
+            mem_tot = mem_tot + self.get_process_mem(pid)
         return mem_tot
 
+    def get_process_mem(self, pid):
+        """
+        Return the shareable estimate of a process in kB, 0 if it has ended.
+        """
+        if self.estimate == 'anonymous':
+            try:
+                with open('/proc/%d/smaps_rollup' % pid) as f:
+                    anonymous = parse_int('^Anonymous: (.*) kB', f.read())
+                if anonymous is not None:
+                    return anonymous
+            except IOError:
+                # Kernels older than 4.14 only have the virtual size
+                pass
+        try:
+            with open('/proc/%d/statm' % pid) as f:
+                return int(f.read().split()[0]) * self.page_kb
+        except (IOError, IndexError, ValueError):
+            return 0
+
     def collect(self):
         data = {}
         for (datum, file) in self.files.items():
-            file.seek(0)
-            data['ksm_' + datum] = parse_int('(.*)', file.read())
+            data['ksm_' + datum] = file.read_int()
         data['ksm_shareable'] = self.get_shareable_mem()
         data['ksmd_cpu_usage'] = self.get_ksmd_cpu_usage()
         return data
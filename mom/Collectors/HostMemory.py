@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 from mom.Collectors.Collector import *
+from mom.Collectors.ProcFile import SHARED_MAX_AGE, open_shared
 
 class HostMemory(Collector):
     """
@@ -26,42 +27,41 @@ class HostMemory(Collector):
         swap_in       - The amount of memory swapped in since the last collection (pages)
         swap_out      - The amount of memory swapped out since the last collection (pages)
         anon_pages    - The amount of memory used for anonymous memory areas (kB)
+    The optional field is:
+        mem_available_estimate - The kernel estimate of the memory available
+                                 to new processes without swapping, the
+                                 MemAvailable of Linux 3.14 and later (kB)
     """
     def __init__(self, properties):
-        self.meminfo = open_datafile("/proc/meminfo")
-        self.vmstat = open_datafile("/proc/vmstat")
+        try:
+            self.meminfo = open_shared("/proc/meminfo")
+            self.vmstat = open_shared("/proc/vmstat")
+        except OSError as e:
+            raise FatalError("HostMemory: open %s failed: %s" %
+                             (e.filename, e.strerror))
         self.swap_in_prev = None
         self.swap_in_cur = None
         self.swap_out_prev = None
         self.swap_out_cur = None
 
-    def __del__(self):
-        if self.meminfo is not None:
-            self.meminfo.close()
-        if self.vmstat is not None:
-            self.vmstat.close()
-
     def collect(self):
-        self.meminfo.seek(0)
-        self.vmstat.seek(0)
-
-        contents = self.meminfo.read()
-        avail = parse_int("^MemTotal: (.*) kB", contents)
-        anon = parse_int("^AnonPages: (.*) kB", contents)
-        unused = parse_int("^MemFree: (.*) kB", contents)
-        buffers = parse_int("^Buffers: (.*) kB", contents)
-        cached = parse_int("^Cached: (.*) kB", contents)
+        meminfo = self.meminfo.fields(SHARED_MAX_AGE)
+        avail = meminfo.get('MemTotal')
+        anon = meminfo.get('AnonPages')
+        unused = meminfo.get('MemFree')
+        buffers = meminfo.get('Buffers')
+        cached = meminfo.get('Cached')
         free = unused + buffers + cached
-        swap_total = parse_int("^SwapTotal: (.*) kB", contents)
-        swap_free = parse_int("^SwapFree: (.*) kB", contents)
+        swap_total = meminfo.get('SwapTotal')
+        swap_free = meminfo.get('SwapFree')
 
         # /proc/vmstat reports cumulative statistics so we must subtract the
         # previous values to get the difference since the last collection.
-        contents = self.vmstat.read()
+        vmstat = self.vmstat.fields(SHARED_MAX_AGE)
         self.swap_in_prev = self.swap_in_cur
         self.swap_out_prev = self.swap_out_cur
-        self.swap_in_cur = parse_int("^pswpin (.*)", contents)
-        self.swap_out_cur = parse_int("^pswpout (.*)", contents)
+        self.swap_in_cur = vmstat.get('pswpin')
+        self.swap_out_cur = vmstat.get('pswpout')
         if self.swap_in_prev is None:
             self.swap_in_prev = self.swap_in_cur
         if self.swap_out_prev is None:
@@ -73,9 +73,13 @@ class HostMemory(Collector):
         data = { 'mem_available': avail, 'mem_unused': unused, \
                  'mem_free': free, 'swap_in': swap_in, 'swap_out': swap_out, \
                  'anon_pages': anon, 'swap_total': swap_total, \
-                 'swap_usage': swap_total - swap_free }
+                 'swap_usage': swap_total - swap_free, \
+                 'mem_available_estimate': meminfo.get('MemAvailable') }
         return data
 
     def getFields(self):
         return {'mem_available', 'mem_unused', 'mem_free', 'swap_in', 'swap_out',
                 'anon_pages', 'swap_total', 'swap_usage'}
+
+    def getOptionalFields(self):
+        return {'mem_available_estimate'}
@@ -0,0 +1,111 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import re
+import threading
+import time
+
+# The fields parsed from a shared file are reused for that long, the
+# collectors of a monitor all run within it
+SHARED_MAX_AGE = 0.5
+
+_FIELD = re.compile(r'^([^\s:]+):?\s+(\d+)', re.M)
+_BYTES_FIELD = re.compile(_FIELD.pattern.encode(), re.M)
+
+def parse_fields(data):
+    """
+    Parse the 'key: value [kB]' lines of /proc/meminfo style contents, or the
+    'key value' lines of /proc/vmstat style ones, in a single pass.
+    Return: A dict of each key to its integer value
+    """
+    if isinstance(data, str):
+        return dict((key, int(value)) for key, value in _FIELD.findall(data))
+    return dict((key.decode(), int(value))
+                for key, value in _BYTES_FIELD.findall(data))
+
+class ProcFile(object):
+    """
+    A procfs or sysfs file kept open and read from its start with os.pread
+    into a buffer reused by every read, which grows when the contents do not
+    fit in it.
+    """
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(size)
+        self.lock = threading.Lock()
+        # (time, fields) of the last parse shared by fields()
+        self._parsed = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        fd = getattr(self, 'fd', None)
+        if fd is not None:
+            self.fd = None
+            os.close(fd)
+
+    def _read(self):
+        # Call with the lock held, the buffer is only valid until the next read
+        while True:
+            length = os.preadv(self.fd, [self.buffer], 0)
+            if length < len(self.buffer):
+                return memoryview(self.buffer)[:length]
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def read(self):
+        """
+        Return: The contents of the file as bytes
+        """
+        with self.lock:
+            return self._read().tobytes()
+
+    def read_int(self):
+        """
+        Return: The contents of a single value file as an integer
+        """
+        with self.lock:
+            return int(self._read())
+
+    def fields(self, max_age=0):
+        """
+        Parse the file with parse_fields(), or return the fields parsed less
+        than max_age seconds ago.  The dict must not be modified.
+        """
+        now = time.monotonic()
+        with self.lock:
+            parsed = self._parsed
+            if parsed is not None and now - parsed[0] < max_age:
+                return parsed[1]
+            fields = parse_fields(self._read())
+            self._parsed = (now, fields)
+            return fields
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+def open_shared(path):
+    """
+    Return the ProcFile of path shared by all the collectors, opening it the
+    first time.  Used with fields(SHARED_MAX_AGE), the file is read and
+    parsed once per tick however many collectors need it.
+    """
+    with _shared_lock:
+        procfile = _shared.get(path)
+        if procfile is None:
+            procfile = _shared[path] = ProcFile(path)
+        return procfile
@@ -14,52 +14,144 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+from mom.History import NAN
+from mom.History import History
+from mom.History import HistoryView
+
 class EntityError(Exception):
     pass
 
-class Entity:
+# The statistics of an Entity that has none
+NO_STATISTICS = HistoryView(History(1), 0, 0)
+
+class Snapshot(object):
+    """
+    The data of a Monitor as of one sample: its properties, variables,
+    recent statistics, their aggregates and the latest value of every valid
+    field.  A Monitor publishes a new Snapshot whenever its data changes and
+    never changes a published one, so any number of Entities can share it
+    without locking.
+
+    The latest values are a tuple, entity_class is the Entity class whose
+    attributes read them, see entity_class().
+    """
+    __slots__ = ('version', 'properties', 'variables', 'statistics',
+                 'aggregates', 'entity_class', 'values')
+
+    def __init__(self, version, properties, variables, statistics,
+                 aggregates, entity_class, values):
+        self.version = version
+        self.properties = properties
+        self.variables = variables
+        self.statistics = statistics
+        self.aggregates = aggregates
+        self.entity_class = entity_class
+        self.values = values
+
+class Entity(object):
     """
     An entity is an object that is designed to be inserted into the rule-
     processing namespace.  The properties and statistics elements allow it to
     contain a snapshot of Monitor data that can be used as inputs to rules.  The
     rule-accessible methods provide a simple syntax for referencing data.
+
+    The data is read from a Snapshot shared with other Entities.  Properties
+    and variables are copied the first time this Entity changes them.
     """
-    def __init__(self, monitor=None):
-        self.properties = {}
-        self.variables = {}
-        self.statistics = []
+    __slots__ = ('snapshot', 'properties', 'variables', 'statistics',
+                 'aggregates', 'controls', 'monitor', '_values')
+
+    # The statistics available as attributes, see entity_class()
+    _fields = ()
+
+    def __init__(self, monitor=None, snapshot=None):
+        if snapshot is None:
+            snapshot = EMPTY_SNAPSHOT
+        self.snapshot = snapshot
+        self.properties = snapshot.properties
+        self.variables = snapshot.variables
+        # A HistoryView of the recent samples
+        self.statistics = snapshot.statistics
+        # Rolling aggregates of the statistics from the Monitor, if any
+        self.aggregates = snapshot.aggregates
+        # The most-recent value of each of _fields
+        self._values = snapshot.values
         self.controls = {}
         self.monitor = monitor
 
     def _set_property(self, name, val):
+        if self.properties is self.snapshot.properties:
+            self.properties = dict(self.properties)
         self.properties[name] = val
 
     def _set_variable(self, name, val):
+        if self.variables is self.snapshot.variables:
+            self.variables = dict(self.variables)
         self.variables[name] = val
 
     def _set_statistics(self, stats):
+        """
+        Set the statistics from a HistoryView or a list of samples, each a
+        dict of statistic to value.
+        """
+        if isinstance(stats, HistoryView):
+            self.statistics = stats
+            return
+        stats = list(stats)
+        history = History(len(stats))
         for row in stats:
-            self.statistics.append(row)
+            history.append(row, NAN)
+        self.statistics = history.view()
+
+    def _set_aggregates(self, aggregates):
+        """
+        Set the (sum, count, min, max, ewma) of each statistic as computed by
+        the Monitor.  The dict is shared and must not be changed.  Statistics
+        without aggregates are computed from the history.
+        """
+        self.aggregates = aggregates
+
+    def _aggregate(self, name):
+        """
+        Return the aggregates of a statistic, computing them from the history
+        when the Monitor did not provide them.
+        """
+        if name not in self.monitor.valid_fields:
+            raise KeyError("Field '%s' is not declared in any collector." % name)
+
+        if (len(self.statistics) == 0):
+            raise EntityError("Statistic '%s' not available" % name)
+
+        summary = self.aggregates.get(name)
+        if summary is not None:
+            return summary
+
+        values = [x for x in self.statistics.values(name) if x is not None]
+        if len(values) == 0:
+            return (0, 0, None, None, None)
+        total = 0
+        for value in values:
+            total = total + value
+        alpha = 2.0 / (len(self.statistics) + 1)
+        ewma = float(values[0])
+        for value in values[1:]:
+            ewma += alpha * (value - ewma)
+        return (total, len(values), min(values), max(values), ewma)
 
     def _store_variables(self):
         """
         Pass rule-defined variables back to the Monitor for storage
         """
-        if self.monitor is not None:
+        if self.monitor is not None and \
+                self.variables is not self.snapshot.variables:
             self.monitor.update_variables(self.variables)
 
     def _finalize(self):
         """
         Once all data has been added to the Entity, perform any extra processing
         """
-        # Add the most-recent stats to the top-level namespace for easy access
-        # from within rules scripts.
-        if len(self.statistics) > 0:
-            for stat in self.statistics[-1].keys():
-                if stat in self.monitor.valid_fields:
-                    setattr(self, stat, self.statistics[-1][stat])
-                else:
-                    self.monitor.logger.debug("Field '%s' not known. Ignoring." % stat)
+        cls, self._values = self.monitor._latest_fields(self.statistics)
+        self.__class__ = cls
 
     def _disp(self, name=''):
         """
@@ -71,7 +163,7 @@ class Entity:
             prop_str = prop_str + " " + i
 
         if len(self.statistics) > 0:
-            for i in self.statistics[0].keys():
+            for i in self.statistics.fields():
                 stat_str = stat_str + " " + i
         else:
             stat_str = ""
@@ -96,7 +188,7 @@ class Entity:
             raise KeyError("Field '%s' is not declared in any collector." % name)
 
         if len(self.statistics) > 0:
-            return self.statistics[-1].get(name, default)
+            return self.statistics.value(name, -1, default)
         else:
             return None
 
@@ -104,27 +196,70 @@ class Entity:
         """
         Calculate the average value of a statistic using all recent values.
         """
+        total, count = self._aggregate(name)[:2]
+        if count == 0:
+            return float(0)
+        else:
+            return float(total / count)
+
+    def StatMin(self, name):
+        """
+        Get the smallest recent value of a statistic.
+        Returns None if the statistic has no values.
+        """
+        return self._aggregate(name)[2]
+
+    def StatMax(self, name):
+        """
+        Get the largest recent value of a statistic.
+        Returns None if the statistic has no values.
+        """
+        return self._aggregate(name)[3]
+
+    def StatEwma(self, name):
+        """
+        Get the exponentially weighted moving average of a statistic.  Each
+        value weighs 2 / (sample-history-length + 1) of the average.
+        Returns None if the statistic has no values.
+        """
+        return self._aggregate(name)[4]
+
+    def StatDelta(self, name):
+        """
+        Get the change of a statistic between the two most recent samples.
+        Returns None if either sample has no value.
+        """
         if name not in self.monitor.valid_fields:
             raise KeyError("Field '%s' is not declared in any collector." % name)
 
-        if (len(self.statistics) == 0):
-            raise EntityError("Statistic '%s' not available" % name)
+        if len(self.statistics) < 2:
+            return None
+        last = self.statistics.value(name, -1)
+        previous = self.statistics.value(name, -2)
+        if last is None or previous is None:
+            return None
+        return last - previous
 
-        total = 0
-        nonEmptyStats = [x for x in self.statistics \
-                         if x.get(name, None) is not None]
-        for row in nonEmptyStats:
-            total = total + row[name]
-        if (len(nonEmptyStats) == 0):
-            return float(0)
-        else:
-            return float(total / len(nonEmptyStats))
+    def StatRate(self, name):
+        """
+        Get the change per second of a statistic between the two most recent
+        samples, using the time they were actually collected.
+        Returns None if either sample has no value or no time.
+        """
+        delta = self.StatDelta(name)
+        if delta is None:
+            return None
+        last = self.statistics.timestamp(-1)
+        previous = self.statistics.timestamp(-2)
+        if last is None or previous is None or last <= previous:
+            return None
+        return delta / (last - previous)
 
     def SetVar(self, name, val):
         """
         Store a named value in this Entity.
         """
-        self.variables[name] = val
+        self._set_variable(name, val)
 
     def GetVar(self, name):
         """
@@ -151,3 +286,30 @@ class Entity:
             return self.controls[name]
         else:
             return None
+
+EMPTY_SNAPSHOT = Snapshot(0, {}, {}, NO_STATISTICS, {}, Entity, ())
+
+_entity_classes = {}
+
+def _field(i):
+    return property(lambda self: self._values[i])
+
+def entity_class(fields):
+    """
+    Return the subclass of Entity that adds the most-recent stats to the
+    top-level namespace for easy access from within rules scripts.  Each of
+    the given statistics becomes an attribute reading its position in the
+    values of the Entity, so creating an Entity does not depend on the
+    number of statistics.  Statistics named like an Entity member are only
+    available through Stat().  Classes are shared by all Entities with the
+    same statistics.
+    """
+    cls = _entity_classes.get(fields)
+    if cls is None:
+        namespace = {'__slots__': (), '_fields': fields}
+        for i, name in enumerate(fields):
+            if not hasattr(Entity, name):
+                namespace[name] = _field(i)
+        cls = _entity_classes.setdefault(fields,
+                                         type('Entity', (Entity,), namespace))
+    return cls
@@ -15,11 +15,17 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import queue
+import random
 import threading
 import time
 import logging
 from mom.GuestMonitor import GuestMonitor
 from mom.GuestMonitor import GuestMonitorThread
+from mom.Scheduler import Scheduler
 
 
 GuestData = namedtuple('GuestData', ['monitor', 'thread'])
@@ -38,6 +44,11 @@ class GuestManager(threading.Thread):
     The GuestManager thread maintains a list of currently active guests on the
     system.  When a new guest is discovered, a new GuestMonitor is spawned.
     When GuestMonitors stop running, they are removed from the list.
+
+    Guests are discovered by listing them every guest-manager-interval.  With
+    guest-manager-events, the hypervisor interface reports the guests that
+    start and stop as it happens and the full listing is only made every
+    guest-manager-reconcile-interval to catch missed events.
     """
     def __init__(self, config, hypervisor_iface):
         threading.Thread.__init__(self, name='GuestManager')
@@ -49,6 +60,22 @@ class GuestManager(threading.Thread):
         self.guests_lock = threading.Lock()
         self._threaded = config.getboolean('main',
                                            'guest-manager-multi-thread')
+        self._async = config.getboolean('main', 'guest-manager-asyncio',
+                                        fallback=False)
+        # In multi-thread mode, collect on a pool of workers instead of a
+        # thread per guest
+        workers = config.getint('main', 'guest-monitor-workers', fallback=0)
+        if self._threaded and workers > 0 and not self._async:
+            self._scheduler = Scheduler(workers, 'GuestMonitor')
+        else:
+            self._scheduler = None
+        if config.getboolean('main', 'guest-manager-events', fallback=False):
+            # (id, running) of the guests started or stopped
+            self._events = queue.Queue()
+        else:
+            self._events = None
+        # Called after queueing an event, to wake the asyncio loop
+        self._wake = None
 
     def interrogate(self):
         """
@@ -75,29 +102,195 @@ class GuestManager(threading.Thread):
 
         return ret
 
+    def rpc_get_scheduler_stats(self):
+        if self._scheduler is None:
+            return {}
+        return self._scheduler.stats()
+
     def run(self):
+        if self._async:
+            try:
+                self.logger.info("Guest Manager starting: asyncio")
+                asyncio.run(self._run_async())
+            except Exception:
+                self.logger.error("Guest Manager crashed", exc_info=True)
+            else:
+                self.logger.info("Guest Manager ending")
+            return
         try:
-            self.logger.info("Guest Manager starting: %s",
-                "multi-thread" if self._threaded else "single-thread");
+            if self._scheduler is not None:
+                self.logger.info("Guest Manager starting: %d workers",
+                                 self._scheduler.stats()['workers'])
+                self._scheduler.start()
+            else:
+                self.logger.info("Guest Manager starting: %s",
+                    "multi-thread" if self._threaded else "single-thread");
             interval = self.config.getint('main', 'guest-manager-interval')
+            reconcile = self._start_events()
+            next_poll = time.monotonic()
             while self.config.getint('__int__', 'running') == 1:
-                domain_list = self.hypervisor_iface.getVmList()
-                if domain_list is not None:
-                    self._spawn_guest_monitors(domain_list)
-                    self._check_guest_monitors(domain_list)
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + reconcile
+                    domain_list = self.hypervisor_iface.getVmList()
+                    if domain_list is not None:
+                        self._spawn_guest_monitors(domain_list)
+                        self._check_guest_monitors(domain_list)
 
                 if not self._threaded:
                     self._collect_from_guest_monitors()
 
-                time.sleep(interval)
+                self._wait(interval)
 
-            if self._threaded:
+            if self._scheduler is not None:
+                self._scheduler.stop()
+            elif self._threaded:
                 self._wait_for_guest_monitors()
         except Exception as e:
             self.logger.error("Guest Manager crashed", exc_info=True)
         else:
             self.logger.info("Guest Manager ending")
 
+    async def _run_async(self):
+        """
+        The asyncio mode: one event loop collects all guests, each in its own
+        task.  Collectors without an asyncio implementation, and the
+        hypervisor interface, run on a pool of guest-monitor-workers threads
+        (the asyncio default when 0).
+        """
+        loop = asyncio.get_running_loop()
+        workers = self.config.getint('main', 'guest-monitor-workers',
+                                     fallback=0)
+        if workers > 0:
+            loop.set_default_executor(ThreadPoolExecutor(workers))
+        interval = self.config.getint('main', 'guest-manager-interval')
+        reconcile = self._start_events()
+        wake = asyncio.Event()
+        if self._events is not None:
+            self._wake = lambda: loop.call_soon_threadsafe(wake.set)
+        next_poll = loop.time()
+        # id -> (monitor, task)
+        tasks = {}
+        try:
+            while self.config.getint('__int__', 'running') == 1:
+                if loop.time() >= next_poll:
+                    next_poll = loop.time() + reconcile
+                    domain_list = await loop.run_in_executor(
+                        None, self.hypervisor_iface.getVmList)
+                    if domain_list is not None:
+                        await loop.run_in_executor(
+                            None, self._spawn_guest_monitors, domain_list)
+                        self._check_guest_monitors(domain_list)
+                wake.clear()
+                if self._events is not None:
+                    await loop.run_in_executor(None, self._handle_vm_events)
+
+                for id, (monitor, task) in list(tasks.items()):
+                    if task.done():
+                        del tasks[id]
+                        self._drop_stopped_monitor(id, monitor)
+
+                with self.guests_lock:
+                    guests = dict(self.guests)
+                for id, (monitor, task) in list(tasks.items()):
+                    if id not in guests or guests[id].monitor is not monitor:
+                        task.cancel()
+                        del tasks[id]
+                for id, guest in guests.items():
+                    if id not in tasks:
+                        task = loop.create_task(
+                            self._collect_async(guest.monitor))
+                        tasks[id] = (guest.monitor, task)
+
+                try:
+                    await asyncio.wait_for(wake.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wake = None
+            for monitor, task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*[task for monitor, task in tasks.values()],
+                                 return_exceptions=True)
+
+    async def _collect_async(self, monitor):
+        """
+        Collect from a guest every guest-monitor-interval until its
+        GuestMonitor ends.
+        """
+        loop = asyncio.get_running_loop()
+        timeout = self.config.getfloat('main', 'guest-collector-timeout',
+                                       fallback=0) or None
+        # Spread the collections of the guests over the interval
+        await asyncio.sleep(random.uniform(0, monitor.interval))
+        try:
+            while monitor.should_run():
+                start = loop.time()
+                await monitor.collect_async(timeout)
+                await asyncio.sleep(max(0, monitor.interval -
+                                        (loop.time() - start)))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception("Collection of %s crashed", monitor.name)
+
+    def _start_events(self):
+        """
+        Register for the guest events of the hypervisor interface if enabled.
+        Return: The number of seconds between two listings of the guests
+        """
+        interval = self.config.getint('main', 'guest-manager-interval')
+        if self._events is None:
+            return interval
+        if not self.hypervisor_iface.registerVmEventHandler(self._on_vm_event):
+            self.logger.warning("The hypervisor interface does not report "
+                                "guest events, listing the guests every "
+                                "%s seconds", interval)
+            self._events = None
+            return interval
+        return self.config.getint('main', 'guest-manager-reconcile-interval')
+
+    def _on_vm_event(self, id, running):
+        """
+        Guest event handler, called from a thread of the hypervisor interface
+        """
+        self._events.put((id, running))
+        wake = self._wake
+        if wake is not None:
+            wake()
+
+    def _wait(self, timeout):
+        """
+        Sleep for timeout seconds, handling the guest events meanwhile
+        """
+        if self._events is None:
+            time.sleep(timeout)
+            return
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                id, running = self._events.get(timeout=remaining)
+            except queue.Empty:
+                break
+            self._handle_vm_event(id, running)
+
+    def _handle_vm_events(self):
+        while True:
+            try:
+                id, running = self._events.get_nowait()
+            except queue.Empty:
+                break
+            self._handle_vm_event(id, running)
+
+    def _handle_vm_event(self, id, running):
+        if running:
+            self._spawn_guest_monitors([id])
+        else:
+            with self.guests_lock:
+                self._unregister_guest(id)
+
     def _spawn_guest_monitors(self, domain_list):
         """
         Get the list of running domains and spawn GuestMonitors for any guests
@@ -125,7 +318,9 @@ class GuestManager(threading.Thread):
 
     def _create_monitor(self, info):
         guest = GuestMonitor(self.config, info, self.hypervisor_iface)
-        if self._threaded:
+        if self._scheduler is not None or self._async:
+            thread = None
+        elif self._threaded:
             thread = GuestMonitorThread(info, guest)
             thread.start()
         else:
@@ -171,14 +366,65 @@ class GuestManager(threading.Thread):
 
     def _collect_from_guest_monitors(self):
         with self.guests_lock:
-            for uuid, guest in self.guests.items():
-                if guest.monitor.should_run():
-                    guest.monitor.collect()
+            monitors = [guest.monitor for guest in self.guests.values()
+                        if guest.monitor.should_run()]
+            collected = self._collect_many(monitors)
+            for monitor in monitors:
+                monitor.collect(collected)
+
+    def _collect_many(self, monitors):
+        """
+        Collect at once for all guests using the collectors that provide
+        collect_many(), typically with a single hypervisor interface call.
+        Return: A dict of collector to the data it collected or the
+                exception it raised, for Monitor.collect()
+        """
+        groups = {}
+        for monitor in monitors:
+            for c in monitor.collectors:
+                if getattr(type(c), 'collect_many', None) is not None:
+                    groups.setdefault(type(c), []).append(c)
+
+        collected = {}
+        for cls, collectors in groups.items():
+            try:
+                results = cls.collect_many(collectors)
+            except Exception:
+                # The monitors will call these collectors one by one
+                self.logger.exception("%s.collect_many failed", cls.__name__)
+                continue
+            collected.update(zip(collectors, results))
+        return collected
+
+    def _scheduled_collect(self, uuid, monitor):
+        """
+        Scheduler job of a guest, ends with its GuestMonitor
+        """
+        if monitor.should_run():
+            monitor.collect()
+        if monitor.should_run():
+            return True
+        self._drop_stopped_monitor(uuid, monitor)
+        return False
+
+    def _drop_stopped_monitor(self, uuid, monitor):
+        """
+        Like a dead GuestMonitorThread, forget a GuestMonitor that stopped so
+        the next poll starts a new one if the guest is still running
+        """
+        with self.guests_lock:
+            guest = self.guests.get(uuid)
+            if guest is not None and guest.monitor is monitor:
+                self._unregister_guest(uuid)
 
     def _register_guest(self, uuid, guest):
         if uuid not in self.guests:
             self.logger.debug('added monitor for guest %s', uuid)
             self.guests[uuid] = guest
+            if self._scheduler is not None:
+                self._scheduler.add(uuid, functools.partial(
+                    self._scheduled_collect, uuid, guest.monitor),
+                    guest.monitor.interval)
         else:
             del guest
 
@@ -187,3 +433,5 @@ class GuestManager(threading.Thread):
             guest = self.guests.pop(uuid)
             self.logger.debug('removed monitor for guest %s', uuid)
             guest.monitor.terminate()
+            if self._scheduler is not None:
+                self._scheduler.remove(uuid)
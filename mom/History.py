@@ -0,0 +1,249 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import time
+import weakref
+from array import array
+
+NAN = float('nan')
+
+class Column(object):
+    """
+    The values of one statistic in a ring of slots.  Integer and float
+    statistics are kept in a preallocated array of that type, a statistic
+    that mixes types or has other values falls back to a list.  The valid
+    mask tells which slots hold a value, empty slots read as None.
+    """
+    __slots__ = ('values', 'valid')
+
+    typecodes = {int: 'q', float: 'd'}
+
+    def __init__(self, capacity):
+        self.values = None
+        self.valid = bytearray(capacity)
+
+    def get(self, slot):
+        if self.valid[slot]:
+            return self.values[slot]
+        return None
+
+    def set(self, slot, value):
+        if value is None:
+            self.valid[slot] = 0
+            return
+        if self.values is None:
+            typecode = self.typecodes.get(type(value))
+            if typecode is None:
+                self.values = [None] * len(self.valid)
+            else:
+                self.values = array(typecode, [0]) * len(self.valid)
+        try:
+            if type(self.values) is array and \
+                    self.typecodes.get(type(value)) != self.values.typecode:
+                raise TypeError
+            self.values[slot] = value
+        except (TypeError, OverflowError):
+            self.values = list(self.values)
+            self.values[slot] = value
+        self.valid[slot] = 1
+
+class History(object):
+    """
+    The recent samples of a Monitor stored by column: one ring of slots per
+    statistic plus a column of the monotonic time each sample was added.
+    Samples are numbered in the order they are added and sample n lives in
+    slot n % capacity.
+
+    Readers get HistoryViews, which read the rings without copying.  The
+    ring has two spare slots and a view copies its samples one append before
+    the ring wraps over them, so views stay valid however long they are kept.
+    A view read from the ring while it was being copied is read again from
+    the copy, so it never returns a slot being overwritten.
+
+    Only one thread appends, while any number read without locking: the map
+    of columns is replaced rather than changed when a statistic is new, so
+    readers iterate over the one they got.
+    """
+    def __init__(self, length):
+        self.length = max(length, 1)
+        self.capacity = self.length + 2
+        self.times = array('d', [NAN]) * self.capacity
+        self.columns = {}
+        # The number of the next sample and of the oldest one in the history
+        self.end = 0
+        self.start = 0
+        self.views = weakref.WeakSet()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def slot(self, seq):
+        return seq % self.capacity
+
+    def append(self, data, timestamp=None):
+        """
+        Add a sample, given as a dict of statistic to value, evicting the
+        oldest one when the history is full.
+        Return: A dict of the values of the evicted sample or None
+        """
+        # Views whose oldest sample the next append will overwrite
+        limit = self.end + 1 - self.capacity
+        for view in list(self.views):
+            if view.start <= limit:
+                view._detach()
+                self.views.discard(view)
+
+        seq = self.end
+        slot = self.slot(seq)
+        for key, column in self.columns.items():
+            if key not in data:
+                column.valid[slot] = 0
+        new = [key for key in data if key not in self.columns]
+        if new:
+            columns = dict(self.columns)
+            for key in new:
+                columns[key] = Column(self.capacity)
+            self.columns = columns
+        columns = self.columns
+        for key, value in data.items():
+            columns[key].set(slot, value)
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.times[slot] = timestamp
+        self.end += 1
+
+        if len(self) > self.length:
+            evicted = self.row(self.start)
+            self.start += 1
+            return evicted
+        return None
+
+    def row(self, seq):
+        slot = self.slot(seq)
+        columns = self.columns
+        return dict((key, column.get(slot))
+                    for key, column in columns.items())
+
+    def values(self, name, start=None, end=None):
+        """
+        Iterate over the values of a statistic in sample order.
+        """
+        column = self.columns.get(name)
+        if column is None:
+            return
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        for seq in range(start, end):
+            yield column.get(self.slot(seq))
+
+    def view(self):
+        view = HistoryView(self, self.start, self.end)
+        self.views.add(view)
+        return view
+
+    def resized(self, length):
+        """
+        Return a History of a new length holding the latest samples.
+        """
+        history = History(length)
+        start = max(self.start, self.end - history.length)
+        history.start = history.end = start
+        for seq in range(start, self.end):
+            history.append(self.row(seq), self.times[self.slot(seq)])
+        return history
+
+class HistoryView(object):
+    """
+    A read-only snapshot of the samples of a History.  It behaves as a
+    sequence of dicts, one per sample, but the methods reading a single
+    statistic do not build those dicts.
+    """
+    __slots__ = ('history', 'start', 'end', '__weakref__')
+
+    def __init__(self, history, start, end):
+        self.history = history
+        self.start = start
+        self.end = end
+
+    def _detach(self):
+        """
+        Copy the samples of this view to a History of its own.  Samples
+        keep their numbers, so readers can use either History.
+        """
+        source = self.history
+        history = History(max(self.end - self.start, 1))
+        history.start = history.end = self.start
+        for seq in range(self.start, self.end):
+            history.append(source.row(seq), source.times[source.slot(seq)])
+        self.history = history
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _seq(self, i):
+        n = self.end - self.start
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError('history index out of range')
+        return self.start + i
+
+    def _read(self, read):
+        """
+        Return read(history) of the History of this view, again from the
+        copy when the view was detached meanwhile: the ring may have been
+        overwritten during the first read.
+        """
+        while True:
+            history = self.history
+            result = read(history)
+            if self.history is history:
+                return result
+
+    def __getitem__(self, i):
+        seq = self._seq(i)
+        return self._read(lambda history: history.row(seq))
+
+    def __iter__(self):
+        for seq in range(self.start, self.end):
+            yield self._read(lambda history: history.row(seq))
+
+    def fields(self):
+        return self.history.columns.keys()
+
+    def value(self, name, i=-1, default=None):
+        """
+        Return the value of a statistic in sample i, default if the
+        statistic is unknown.
+        """
+        seq = self._seq(i)
+        def read(history):
+            column = history.columns.get(name)
+            if column is None:
+                return default
+            return column.get(history.slot(seq))
+        return self._read(read)
+
+    def values(self, name):
+        return iter(self._read(lambda history: list(
+            history.values(name, self.start, self.end))))
+
+    def timestamp(self, i=-1):
+        """
+        Return the monotonic time sample i was taken, None if unknown.
+        """
+        seq = self._seq(i)
+        t = self._read(lambda history: history.times[history.slot(seq)])
+        return None if t != t else t
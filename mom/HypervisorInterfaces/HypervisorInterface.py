@@ -36,6 +36,15 @@ class HypervisorInterface(object):
         """
         pass
 
+    def registerVmEventHandler(self, handler):
+        """
+        This method asks the interface to call handler(id, running) when a
+        guest starts (running is True) or stops (running is False), id being
+        its identifier in getVmList.  The handler is called from a thread of
+        the interface.  It returns whether the interface reports such events.
+        """
+        return False
+
     def startVmMemoryStats(self, uuid):
         """
         This method activates the memory statistics of a given guest.
@@ -58,6 +67,29 @@ class HypervisorInterface(object):
         """
         pass
 
+    def getAllVmMemoryStats(self, uuids):
+        """
+        This method returns the memory statistics of several guests at once,
+        as a dict mapping each uuid to what getVmMemoryStats returns for it,
+        or the exception it raises.  Interfaces able to get the statistics of
+        all guests with fewer calls override the bulk methods.
+        """
+        return call_each(self.getVmMemoryStats, uuids)
+
+    def getAllVmBalloonInfo(self, uuids):
+        """
+        This method returns the balloon info of several guests at once, see
+        getAllVmMemoryStats.
+        """
+        return call_each(self.getVmBalloonInfo, uuids)
+
+    def getAllVmCpuTuneInfo(self, uuids):
+        """
+        This method returns the cpu tune info of several guests at once, see
+        getAllVmMemoryStats.
+        """
+        return call_each(self.getVmCpuTuneInfo, uuids)
+
     def setVmBalloonTarget(self, uuid, target):
         """
         This method sets the balloon target of a given guest. It's used by the
@@ -73,6 +105,20 @@ class HypervisorInterface(object):
         pass
 
 
+def call_each(method, uuids):
+    """
+    Call a per-guest interface method for each of uuids.
+    Return: A dict of uuid to the result or the exception raised
+    """
+    ret = {}
+    for uuid in uuids:
+        try:
+            ret[uuid] = method(uuid)
+        except Exception as e:
+            ret[uuid] = e
+    return ret
+
+
 class HypervisorInterfaceError(Exception):
     pass
 
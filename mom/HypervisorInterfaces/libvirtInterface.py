@@ -15,28 +15,87 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 import libvirt
-import re
 import logging
-from subprocess import *
+import threading
+import time
 from mom.HypervisorInterfaces.HypervisorInterface import *
+from mom.PidIndex import PidIndex
 from xml.etree import ElementTree
 from xml.dom.minidom import parseString as _domParseStr
 
 _METADATA_VM_TUNE_URI = 'http://ovirt.org/vm/tune/1.0'
 
+# How long domain handles and their static configuration are cached when no
+# domain event invalidates them earlier
+CACHE_EXPIRATION_DOMAIN = 300
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def _start_event_loop():
+    """
+    Register the default libvirt event implementation and run it in a thread
+    of its own, once per process.  It has to be started before the
+    connections that register for domain events are opened.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            libvirt.virEventRegisterDefaultImpl()
+            _event_loop = threading.Thread(target=_run_event_loop,
+                                           name='libvirt-events')
+            _event_loop.daemon = True
+            _event_loop.start()
+
+def _run_event_loop():
+    logger = logging.getLogger('mom.libvirtInterface')
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except libvirt.libvirtError as e:
+            logger.error("libvirtInterface: event loop error: %s", e)
+            time.sleep(1)
+
+class _CachedDomain(object):
+    __slots__ = ('domain', 'used', 'loaded', 'values')
+
+    def __init__(self, domain, now):
+        self.domain = domain
+        # When the entry was last used and its values were first read
+        self.used = now
+        self.loaded = now
+        # Static configuration read from the domain, by name
+        self.values = {}
+
 class libvirtInterface(HypervisorInterface):
     """
     libvirtInterface provides a wrapper for the libvirt API so that libvirt-
     related error handling can be consolidated in one place.  An instance of
     this class provides a single libvirt connection that can be shared by all
     threads.  If the connection is broken, an attempt will be made to reconnect.
+
+    Domain handles are cached by uuid until they are not used for
+    CACHE_EXPIRATION_DOMAIN seconds.  The configuration that rarely changes,
+    the guaranteed memory, the vcpu limit and the vcpu count, is read again
+    every CACHE_EXPIRATION_DOMAIN seconds.  With libvirt-events enabled,
+    changes of a domain reported by libvirt drop its entry immediately,
+    without events that expiration is all that notices a hotplug or a tune.
     """
     def __init__(self, config):
         self.conn = None
         self.uri = config.get('main', 'libvirt-hypervisor-uri')
         self.interval = config.getint('main', 'guest-monitor-interval')
         self.logger = logging.getLogger('mom.libvirtInterface')
+        self.pids = PidIndex()
+        self.events = config.getboolean('main', 'libvirt-events')
+        self._domains = {}
+        self._domains_lock = threading.Lock()
+        self._vm_event_handler = None
+        # uuid -> id of the running domains, for their stop events
+        self._ids = {}
         libvirt.registerErrorHandler(self._error_handler, None)
+        if self.events:
+            _start_event_loop()
         self._connect()
         self._setStatsFields()
 
@@ -55,8 +114,76 @@ class libvirtInterface(HypervisorInterface):
         except libvirt.libvirtError as e:
             self.logger.error("libvirtInterface: error setting up " \
                     "connection: %s", e)
+            return
+        if self.events:
+            self._registerDomainEvents()
+
+    def _registerDomainEvents(self):
+        events = [(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                   self._onLifecycleEvent),
+                  (libvirt.VIR_DOMAIN_EVENT_ID_TUNABLE, self._onDomainEvent),
+                  # Older versions of libvirt don't have this event
+                  (getattr(libvirt, 'VIR_DOMAIN_EVENT_ID_METADATA_CHANGE',
+                           None), self._onDomainEvent)]
+        for event, callback in events:
+            if event is None:
+                continue
+            try:
+                self.conn.domainEventRegisterAny(None, event, callback, None)
+            except libvirt.libvirtError as e:
+                self.logger.warning("libvirtInterface: failed to register "
+                                    "for domain event %i: %s", event, e)
+
+    def _onDomainEvent(self, conn, domain, *args):
+        """
+        Called from the libvirt event loop when the tunables or the metadata
+        of a domain changed.
+        """
+        try:
+            uuid = domain.UUIDString()
+        except libvirt.libvirtError:
+            return
+        self._invalidateDomain(uuid)
+
+    def _onLifecycleEvent(self, conn, domain, event, detail, opaque):
+        """
+        Called from the libvirt event loop when a domain was defined, started,
+        stopped, migrated or crashed.  Starts and stops are passed on to the
+        vm event handler, the id of a stopped domain is the one it had while
+        running.
+        """
+        try:
+            uuid = domain.UUIDString()
+            dom_id = domain.ID() if event == libvirt.VIR_DOMAIN_EVENT_STARTED \
+                     else None
+        except libvirt.libvirtError:
+            return
+        self._invalidateDomain(uuid)
+        if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            self._ids[uuid] = dom_id
+            # Look the new qemu process up in a fresh scan if needed
+            self.pids.refresh()
+            running = True
+        elif event in (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                       libvirt.VIR_DOMAIN_EVENT_CRASHED):
+            dom_id = self._ids.pop(uuid, None)
+            running = False
+        else:
+            return
+        handler = self._vm_event_handler
+        if handler is not None and dom_id is not None:
+            handler(dom_id, running)
+
+    def registerVmEventHandler(self, handler):
+        if not self.events:
+            return False
+        self._vm_event_handler = handler
+        return True
 
     def _reconnect(self):
+        # The cached handles belong to the broken connection
+        with self._domains_lock:
+            self._domains.clear()
         try:
             self.conn.close()
         except libvirt.libvirtError:
@@ -78,13 +205,52 @@ class libvirtInterface(HypervisorInterface):
             return dom
 
     def _getDomainFromUUID(self, dom_uuid):
+        entry = self._getCachedDomain(dom_uuid)
+        if entry is None:
+            return None
+        return entry.domain
+
+    def _getCachedDomain(self, dom_uuid):
+        now = time.monotonic()
+        with self._domains_lock:
+            entry = self._domains.get(dom_uuid)
+            if entry is not None:
+                entry.used = now
+                if now - entry.loaded >= CACHE_EXPIRATION_DOMAIN:
+                    entry.values = {}
+                    entry.loaded = now
+                return entry
         try:
             dom = self.conn.lookupByUUIDString(dom_uuid)
         except libvirt.libvirtError as e:
             self._handleException(e)
             return None
-        else:
-            return dom
+        entry = _CachedDomain(dom, now)
+        with self._domains_lock:
+            # Drop the domains that were not used for a while, like those
+            # of departed guests
+            for uuid, cached in list(self._domains.items()):
+                if now - cached.used >= CACHE_EXPIRATION_DOMAIN:
+                    del self._domains[uuid]
+            self._domains[dom_uuid] = entry
+        return entry
+
+    def _invalidateDomain(self, dom_uuid):
+        with self._domains_lock:
+            self._domains.pop(dom_uuid, None)
+
+    def _getDomainConfig(self, dom_uuid, domain, key, fetch):
+        """
+        Return the value of a static setting of the domain from the cache, or
+        call fetch(domain) to read it.  None is not cached.
+        """
+        entry = self._getCachedDomain(dom_uuid)
+        if entry is not None and key in entry.values:
+            return entry.values[key]
+        value = fetch(domain)
+        if entry is not None and value is not None:
+            entry.values[key] = value
+        return value
 
     def _domainIsRunning(self, domain):
         try:
@@ -118,23 +284,12 @@ class libvirtInterface(HypervisorInterface):
             return None
         return info
 
-    def _domainGetPid(self, uuid):
+    def _domainGetPid(self, uuid, name):
         """
-        This is an ugly way to find the pid of the qemu process associated with
-        this guest.  Scan ps output looking for our uuid and record the pid.
-        Something is probably wrong if more or less than 1 match is returned.
+        Find the pid of the qemu process associated with this guest from its
+        libvirt pidfile or, failing that, the command lines in /proc.
         """
-        p1 = Popen(["ps", "axww"], stdout=PIPE).communicate()[0].decode("utf-8")
-        matches = re.findall(r"^\s*(\d+)\s+.*" + uuid, p1, re.M)
-        if len(matches) < 1:
-            self.logger.warning("No matching process for domain with uuid %s", \
-                                uuid)
-            return None
-        elif len(matches) > 1:
-            self.logger.warning("Too many process matches for domain with uuid %s",\
-                                uuid)
-            return None
-        return int(matches[0])
+        return self.pids.lookup(uuid, name)
 
     def _domainSetMemoryStatsPeriod(self, domain, period):
         try:
@@ -174,6 +329,8 @@ class libvirtInterface(HypervisorInterface):
             return False
 
     def getVmList(self):
+        # New guests are looked up in a fresh scan of /proc
+        self.pids.refresh()
         try:
             dom_list = self.conn.listDomainsID()
         except libvirt.libvirtError as e:
@@ -186,9 +343,11 @@ class libvirtInterface(HypervisorInterface):
         guest_domain = self._getDomainFromID(id)
         data['uuid'] = self._domainGetUUID(guest_domain)
         data['name'] = self._domainGetName(guest_domain)
-        data['pid'] = self._domainGetPid(data['uuid'])
+        data['pid'] = self._domainGetPid(data['uuid'], data['name'])
         if None in data.values():
             return None
+        if self.events:
+            self._ids[data['uuid']] = id
         return data
 
     def startVmMemoryStats(self, uuid):
@@ -244,13 +403,24 @@ class libvirtInterface(HypervisorInterface):
             self.logger.error('Failed to get domain info')
             return None
         ret =  {'balloon_max': info[1], 'balloon_cur': info[2],
-                'balloon_min': self._getGuaranteedMemory(domain) }
+                'balloon_min': self._getDomainConfig(uuid, domain,
+                    'min_guarantee', self._getGuaranteedMemory) }
         return ret
 
     def getVmCpuTuneInfo(self, uuid):
-        ret = {}
         domain = self._getDomainFromUUID(uuid)
+        # Get the number of vcpus
+        vcpuCount = self._getDomainConfig(uuid, domain, 'vcpu_count',
+                                          self._domainGetVcpuCount)
+        return self._domainGetCpuTuneInfo(uuid, domain, vcpuCount)
+
+    def _domainGetVcpuCount(self, domain):
+        vcpuCount = domain.vcpusFlags(libvirt.VIR_DOMAIN_VCPU_CURRENT)
+        if vcpuCount == -1:
+            return None
+        return vcpuCount
 
+    def _domainGetVcpuLimit(self, domain):
         # Get the user selection for vcpuLimit from the metadata
         metadataCpuLimit = None
         try:
@@ -264,9 +434,14 @@ class libvirtInterface(HypervisorInterface):
             metadataCpuLimitXML = _domParseStr(metadataCpuLimit)
             nodeList = \
                 metadataCpuLimitXML.getElementsByTagName('vcpuLimit')
-            ret['vcpu_user_limit'] = nodeList[0].childNodes[0].data
+            return nodeList[0].childNodes[0].data
         else:
-            ret['vcpu_user_limit'] = 100
+            return 100
+
+    def _domainGetCpuTuneInfo(self, uuid, domain, vcpuCount):
+        ret = {}
+        ret['vcpu_user_limit'] = self._getDomainConfig(uuid, domain,
+            'vcpu_user_limit', self._domainGetVcpuLimit)
 
         # Retrieve the current cpu tuning params
         ret.update(domain.schedulerParameters())
@@ -277,9 +452,7 @@ class libvirtInterface(HypervisorInterface):
         if ret['vcpu_period'] is None:
             ret['vcpu_period'] = 0
 
-        # Get the number of vcpus
-        vcpuCount = domain.vcpusFlags(libvirt.VIR_DOMAIN_VCPU_CURRENT)
-        if vcpuCount != -1:
+        if vcpuCount is not None:
             ret['vcpu_count'] =  vcpuCount
         else:
             self.logger.error('Failed to get VM cpu count')
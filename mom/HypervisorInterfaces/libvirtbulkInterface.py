@@ -0,0 +1,141 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+
+import libvirt
+
+from mom.HypervisorInterfaces.HypervisorInterface import \
+    HypervisorInterfaceError
+from mom.HypervisorInterfaces.libvirtInterface import libvirtInterface
+
+
+class libvirtBulkInterface(libvirtInterface):
+    """
+    libvirtBulkInterface extends the libvirtInterface to read the statistics
+    of all running domains with one getAllDomainStats call, like the vdsm
+    interfaces do with getAllVmStats, instead of looking up every domain and
+    querying it several times.  The result is kept for half of
+    guest-monitor-interval seconds and serves getVmMemoryStats,
+    getVmBalloonInfo and the vcpu count of getVmCpuTuneInfo for all guests
+    of a collection round, as well as their bulk versions used when
+    guest-manager-multi-thread is disabled.
+
+    Domains missing from the cached result, like those started since it was
+    read, are queried one by one until the next call.
+    """
+    # The statistics groups read for each domain
+    stats_groups = libvirt.VIR_DOMAIN_STATS_BALLOON | \
+                   libvirt.VIR_DOMAIN_STATS_VCPU
+
+    def __init__(self, config):
+        super(libvirtBulkInterface, self).__init__(config)
+        self._stats_lock = threading.Lock()
+        self._stats = None
+        self._stats_time = None
+
+    def getAllDomainStats(self):
+        """
+        Return a dict of the uuid of each running domain to its virDomain and
+        its statistics, from a call made less than half of
+        guest-monitor-interval seconds ago if possible.  Failed calls are not
+        cached.
+        """
+        with self._stats_lock:
+            now = time.monotonic()
+            if self._stats is None or \
+                    now - self._stats_time >= self.interval / 2.0:
+                try:
+                    records = self.conn.getAllDomainStats(
+                        self.stats_groups,
+                        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING)
+                except libvirt.libvirtError as e:
+                    self._handleException(e)
+                    return {}
+                self._stats = dict((self._domainGetUUID(domain),
+                                    (domain, stats))
+                                   for domain, stats in records)
+                self._stats_time = now
+            return self._stats
+
+    def _getDomainStats(self, uuid):
+        return self.getAllDomainStats().get(uuid)
+
+    def _callEach(self, method, uuids):
+        """
+        Call method(uuid, entry) for each of uuids with its entry of a single
+        getAllDomainStats result.
+        Return: A dict of uuid to the result or the exception raised
+        """
+        stats = self.getAllDomainStats()
+        ret = {}
+        for uuid in uuids:
+            try:
+                ret[uuid] = method(uuid, stats.get(uuid))
+            except Exception as e:
+                ret[uuid] = e
+        return ret
+
+    def getVmMemoryStats(self, uuid):
+        return self._memoryStats(uuid, self._getDomainStats(uuid))
+
+    def getAllVmMemoryStats(self, uuids):
+        return self._callEach(self._memoryStats, uuids)
+
+    def getVmBalloonInfo(self, uuid):
+        return self._balloonInfo(uuid, self._getDomainStats(uuid))
+
+    def getAllVmBalloonInfo(self, uuids):
+        return self._callEach(self._balloonInfo, uuids)
+
+    def getVmCpuTuneInfo(self, uuid):
+        return self._cpuTuneInfo(uuid, self._getDomainStats(uuid))
+
+    def getAllVmCpuTuneInfo(self, uuids):
+        return self._callEach(self._cpuTuneInfo, uuids)
+
+    def _memoryStats(self, uuid, entry):
+        if entry is None:
+            return super(libvirtBulkInterface, self).getVmMemoryStats(uuid)
+        domain, stats = entry
+        ret = {}
+        for key, field in self.mem_stats.items():
+            value = stats.get('balloon.' + key)
+            if value is not None:
+                ret[field] = value
+        if len(ret) == 0:
+            raise HypervisorInterfaceError('libvirt balloon statistics '
+                                           'are not active')
+        return ret
+
+    def _balloonInfo(self, uuid, entry):
+        if entry is None or 'balloon.current' not in entry[1]:
+            return super(libvirtBulkInterface, self).getVmBalloonInfo(uuid)
+        domain, stats = entry
+        return {'balloon_max': stats['balloon.maximum'],
+                'balloon_cur': stats['balloon.current'],
+                'balloon_min': self._getDomainConfig(uuid, domain,
+                    'min_guarantee', self._getGuaranteedMemory)}
+
+    def _cpuTuneInfo(self, uuid, entry):
+        if entry is None or 'vcpu.current' not in entry[1]:
+            return super(libvirtBulkInterface, self).getVmCpuTuneInfo(uuid)
+        domain, stats = entry
+        return self._domainGetCpuTuneInfo(uuid, domain,
+                                          stats['vcpu.current'])
+
+def instance(config):
+    return libvirtBulkInterface(config)
@@ -61,6 +61,22 @@ class MOMFuncs(object):
         self.logger.info("getNamedPolicies()")
         return self.threads['policy_engine'].rpc_get_named_policies()
 
+    @exported
+    def getPolicyProfile(self):
+        self.logger.info("getPolicyProfile()")
+        return self.threads['policy_engine'].rpc_get_policy_profile()
+
+    @exported
+    def resetPolicyProfile(self):
+        self.logger.info("resetPolicyProfile()")
+        return self.threads['policy_engine'].rpc_reset_policy_profile()
+
+    @exported
+    def setPolicyProfiling(self, enabled):
+        self.logger.info("setPolicyProfiling(%s)", enabled)
+        return self.threads['policy_engine'].rpc_set_policy_profiling(
+            bool(enabled))
+
     @exported
     def setVerbosity(self, verbosity):
         self.logger.info("setVerbosity()")
@@ -79,6 +95,11 @@ class MOMFuncs(object):
         ret = {'host': host_stats, 'guests': guest_stats}
         return ret
 
+    @exported
+    def getSchedulerStats(self):
+        self.logger.info("getSchedulerStats()")
+        return self.threads['guest_manager'].rpc_get_scheduler_stats()
+
     @exported
     def getActiveGuests(self):
         self.logger.info("getActiveGuests()")
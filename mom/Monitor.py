@@ -14,13 +14,100 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import asyncio
 import threading
 import logging
 from collections import deque
 from mom.Collectors import Collector
-from mom.Entity import Entity
+from mom.Entity import Snapshot
+from mom.Entity import entity_class
+from mom.History import History
 from mom.Plotter import Plotter
 
+class RollingStat(object):
+    """
+    Aggregates of one statistic over the samples in the history of a Monitor,
+    updated as samples are added and evicted so reading them is O(1).  None
+    values are skipped.  The minimum and maximum are kept with monotonic
+    deques of (sample number, value).  The sum is exact: while only integers
+    are in the window it is updated incrementally, otherwise it is computed
+    again in sample order when a value leaves the window, giving the same
+    result as summing the history.  The exponentially weighted moving
+    average covers every sample seen, not only the history.
+    """
+    __slots__ = ('alpha', 'total', 'count', 'floats', 'mins', 'maxs', 'ewma',
+                 'numeric')
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.total = 0
+        self.count = 0
+        # Number of floats in the window
+        self.floats = 0
+        self.mins = deque()
+        self.maxs = deque()
+        self.ewma = None
+        # Number of values in the window that are not numbers
+        self.numeric = 0
+
+    def add(self, seq, value):
+        if value is None:
+            return
+        if type(value) not in (int, float):
+            self.numeric += 1
+            return
+        self.total = self.total + value
+        self.count += 1
+        if type(value) is float:
+            self.floats += 1
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((seq, value))
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((seq, value))
+        if self.ewma is None:
+            self.ewma = float(value)
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+
+    def remove(self, seq, value, values):
+        """
+        Evict the oldest sample, numbered seq.  values iterates over the
+        values of this statistic in the samples left.
+        """
+        if value is None:
+            return
+        if type(value) not in (int, float):
+            self.numeric -= 1
+            return
+        self.count -= 1
+        if self.floats:
+            if type(value) is float:
+                self.floats -= 1
+            self.total = 0
+            for v in values:
+                if type(v) in (int, float):
+                    self.total = self.total + v
+        else:
+            self.total -= value
+        if self.mins and self.mins[0][0] == seq:
+            self.mins.popleft()
+        if self.maxs and self.maxs[0][0] == seq:
+            self.maxs.popleft()
+
+    def summary(self):
+        """
+        Return (sum, count, min, max, ewma) or None when the window holds
+        values that are not numbers.
+        """
+        if self.numeric:
+            return None
+        return (self.total, self.count,
+                self.mins[0][1] if self.mins else None,
+                self.maxs[0][1] if self.maxs else None,
+                self.ewma)
+
 class Monitor(object):
     """
     The Monitor class represents an entity, about which, data is collected and
@@ -32,11 +119,21 @@ class Monitor(object):
         # Guard the data with a lock to ensure consistency.
         self.data_lock = threading.Lock()
         self.properties = {}
-        self.statistics = deque()
+        self.statistics = History(config.getint('main',
+                                                'sample-history-length',
+                                                fallback=10))
+        # Rolling aggregates of every field and their summaries as of the
+        # last sample
+        self.aggregates = {}
+        self.summaries = {}
         self.variables = {}
+        # The data as of the last change, see interrogate()
+        self.snapshot = None
         self.name = name
         self.fields = None
         self.optional_fields = None
+        # (fields, optional_fields, their union)
+        self._valid_fields = None
         self.collectors = []
         self.logger = logging.getLogger('mom.Monitor')
 
@@ -51,21 +148,67 @@ class Monitor(object):
 
     @property
     def valid_fields(self):
-        return self.fields.union(self.optional_fields)
+        """
+        The union of the mandatory and optional fields, computed again only
+        when either set is replaced.
+        """
+        cached = self._valid_fields
+        if cached is None or cached[0] is not self.fields or \
+                cached[1] is not self.optional_fields:
+            cached = self._valid_fields = (
+                self.fields, self.optional_fields,
+                frozenset(self.fields.union(self.optional_fields)))
+        return cached[2]
 
-    def collect(self):
+    def collect(self, collected=None):
         """
         Collect a set of statistics by invoking all defined collectors and
-        merging the data into one dictionary and pushing it onto the deque of
-        historical statistics.  Maintain a history length as specified in the
-        config file.
+        merging the data into one dictionary and pushing it onto the history of
+        statistics.  Maintain a history length as specified in the config
+        file.
 
         Note: Priority is given to collectors based on the order that they are
         listed in the config file (ie. if two collectors produce the same
         statistic only the value produced by the first collector will be saved).
+
+        collected optionally maps collectors to the data they already
+        returned, or the exception they raised, through collect_many().
         Return: The dictionary of collected statistics
         """
 
+        self._init_fields()
+        data = self._merge(self._results(collected or {}))
+        if data is None:
+            return None
+        return self._store(data)
+
+    async def collect_async(self, timeout=None):
+        """
+        Like collect() but for an asyncio event loop: all collectors run
+        concurrently through their collect_async() method and one taking
+        more than timeout seconds counts as a collection error.
+        Return: The dictionary of collected statistics
+        """
+        self._init_fields()
+        results = await asyncio.gather(
+            *[self._collect_async(c, timeout) for c in self.collectors],
+            return_exceptions=True)
+        data = self._merge((c, None, r) if isinstance(r, BaseException)
+                           else (c, r, None)
+                           for c, r in zip(self.collectors, results))
+        if data is None:
+            return None
+        return self._store(data)
+
+    async def _collect_async(self, collector, timeout):
+        try:
+            return await asyncio.wait_for(collector.collect_async(), timeout)
+        except asyncio.TimeoutError:
+            raise Collector.CollectionError("%s timed out after %s seconds" %
+                                            (type(collector).__name__,
+                                             timeout))
+
+    def _init_fields(self):
         # The first time we are called, populate the list of expected fields
         if self.fields is None:
             self.fields = set()
@@ -80,34 +223,66 @@ class Monitor(object):
                 self.optional_fields |= c.getOptionalFields()
             self.logger.debug("Using optional fields: %s", repr(self.optional_fields))
 
-        # Remove mandatory fields from the optional list
-        # This can happen when more than one collector is able to provide
-        # the value
-        self.optional_fields = self.optional_fields.difference(self.fields)
+            # Remove mandatory fields from the optional list
+            # This can happen when more than one collector is able to provide
+            # the value
+            self.optional_fields = self.optional_fields.difference(self.fields)
 
         if self.plotter is not None:
-            self.plotter.setFields(self.fields.union(self.optional_fields))
+            self.plotter.setFields(self.valid_fields)
 
-        data = {}
+    def _results(self, collected):
+        """
+        Call the collectors one after the other, except those in collected.
+        Return: An iterator of (collector, collected data, exception raised)
+        """
         for c in self.collectors:
+            if c in collected:
+                result = collected[c]
+                if isinstance(result, Exception):
+                    yield c, None, result
+                else:
+                    yield c, result, None
+                continue
             try:
-                collected = c.collect()
-                if collected is None:
-                    self.logger.debug("Collector %s did not "
-                                      "return any data", str(c))
-                    continue
+                data = c.collect()
+            except Exception as e:
+                yield c, None, e
+            else:
+                yield c, data, None
+
+    def _merge(self, results):
+        """
+        Merge the results of the collectors, see _results(), into one
+        dictionary.
+        Return: The dictionary or None after a fatal collector error
+        """
+        data = {}
+        for c, collected, error in results:
+            if isinstance(error, Collector.CollectionError):
+                self._disp_collection_error("Collection error: %s" % error.msg)
+            elif isinstance(error, Collector.FatalError):
+                self._set_not_ready("Fatal Collector error: %s" % error.msg)
+                self.terminate()
+                return None
+            elif error is not None:
+                self.logger.error("Unexpected collection error",
+                                  exc_info=error)
+            elif collected is None:
+                self.logger.debug("Collector %s did not "
+                                  "return any data", str(c))
+            else:
                 for (key, val) in collected.items():
                     if key not in data or data[key] is None:
                         data[key] = val
-            except Collector.CollectionError as e:
-                self._disp_collection_error("Collection error: %s" % e.msg)
-            except Collector.FatalError as e:
-                self._set_not_ready("Fatal Collector error: %s" % e.msg)
-                self.terminate()
-                return None
-            except Exception:
-                self.logger.exception("Unexpected collection error")
+        return data
 
+    def _store(self, data):
+        """
+        Push the merged data of a collection onto the history if it has all
+        mandatory fields.
+        Return: The data or None if it is incomplete
+        """
         if not set(data).issuperset(self.fields):
             self._set_not_ready("Incomplete data: missing %s" % \
                                 (self.fields - set(data)))
@@ -118,9 +293,7 @@ class Monitor(object):
             data.setdefault(k, None)
 
         with self.data_lock:
-            self.statistics.append(data)
-            if len(self.statistics) > self.config.getint('main', 'sample-history-length'):
-                self.statistics.popleft()
+            self._add_sample(data)
 
         self._set_ready()
 
@@ -129,24 +302,86 @@ class Monitor(object):
 
         return data
 
+    def _add_sample(self, data, timestamp=None):
+        """
+        Append data to the history, evict the oldest sample when the history
+        is full and update the rolling aggregates.  Call with data_lock held.
+        """
+        length = self.config.getint('main', 'sample-history-length')
+        history = self.statistics
+        if history.length != length:
+            history = self.statistics = history.resized(length)
+            self.aggregates = {}
+            for seq in range(history.start, history.end):
+                self._account(seq, history.row(seq), length)
+
+        seq = history.end
+        old = history.append(data, timestamp)
+        self._account(seq, data, length)
+        if old is not None:
+            for key, val in old.items():
+                self.aggregates[key].remove(history.start - 1, val,
+                                            history.values(key))
+        # A new dict every time, so Entities can share it
+        self.summaries = dict((key, stat.summary()) for key, stat in
+                              self.aggregates.items())
+        self._publish()
+
+    def _publish(self, statistics=True):
+        """
+        Replace the snapshot with one of the current data, the properties
+        and variables are copied so later changes do not show through.  When
+        statistics is False only the variables changed, so the statistics of
+        the last snapshot are reused.  Call with data_lock held.
+        """
+        snapshot = self.snapshot
+        if statistics or snapshot is None:
+            view = self.statistics.view()
+            cls, values = self._latest_fields(view)
+        else:
+            view = snapshot.statistics
+            cls, values = snapshot.entity_class, snapshot.values
+        version = 1 if snapshot is None else snapshot.version + 1
+        self.snapshot = Snapshot(version, dict(self.properties),
+                                 dict(self.variables), view,
+                                 self.summaries, cls, values)
+
+    def _latest_fields(self, statistics):
+        """
+        Return the Entity class for the valid fields of the most recent
+        sample in statistics and the tuple of their values.
+        """
+        if len(statistics) == 0:
+            return entity_class(()), ()
+        valid = self.valid_fields
+        fields = []
+        values = []
+        for key, val in statistics[-1].items():
+            if key in valid:
+                fields.append(key)
+                values.append(val)
+            else:
+                self.logger.debug("Field '%s' not known. Ignoring." % key)
+        return entity_class(tuple(fields)), tuple(values)
+
+    def _account(self, seq, data, length):
+        for key, val in data.items():
+            stat = self.aggregates.get(key)
+            if stat is None:
+                stat = self.aggregates[key] = RollingStat(2.0 / (length + 1))
+            stat.add(seq, val)
+
     def interrogate(self):
         """
-        Take a snapshot of this Monitor object and return an Entity object which
-        is useful for rules processing.
+        Return an Entity object of the data of this Monitor which is useful
+        for rules processing.  Entities share the last published snapshot, so
+        this neither copies the data nor waits for a collection in progress.
         Return: A new Entity object
         """
-        if self.ready is not True:
+        snapshot = self.snapshot
+        if self.ready is not True or snapshot is None:
             return None
-        ret = Entity(monitor=self)
-        with self.data_lock:
-            for prop in self.properties.keys():
-                ret._set_property(prop, self.properties[prop])
-            for var in self.variables.keys():
-                ret._set_variable(var, self.variables[var])
-            ret._set_statistics(self.statistics)
-
-        ret._finalize()
-        return ret
+        return snapshot.entity_class(monitor=self, snapshot=snapshot)
 
     def update_variables(self, variables):
         """
@@ -155,6 +390,7 @@ class Monitor(object):
         with self.data_lock:
             for (var, val) in variables.items():
                 self.variables[var] = val
+            self._publish(statistics=False)
 
     def terminate(self):
         """
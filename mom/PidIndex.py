@@ -0,0 +1,201 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import os
+import threading
+
+# Where libvirt writes the pid of the qemu process of each running domain
+PIDFILE_DIRS = ('/run/libvirt/qemu', '/var/run/libvirt/qemu')
+
+# Every that many scans all the command lines are read again, whatever their
+# process looks like
+FULL_SCAN_EVERY = 12
+
+class PidIndex(object):
+    """
+    Find the pid of the qemu process of a guest from its uuid.
+
+    The pid is read from the pidfile libvirt keeps for the domain.  When there
+    is none, the command lines in /proc are scanned once and every qemu
+    process is indexed by the value of its -uuid option.  The scan is shared
+    by all lookups until refresh() is called, once per guest discovery cycle.
+    Later scans only read the command lines of the processes started since
+    the previous one, or that changed their command name since, like a
+    process scanned between the fork and the exec of qemu, unless a guest is
+    missing from them.
+
+    Only the processes with a -uuid option count as qemu processes, whatever
+    the name of their executable.
+
+    Found pids are cached along with the start time of their process, so a
+    pid that was reused by another process is not returned.
+    """
+    def __init__(self, proc='/proc', pidfile_dirs=PIDFILE_DIRS):
+        self.logger = logging.getLogger('mom.PidIndex')
+        self.proc = proc
+        self.pidfile_dirs = pidfile_dirs
+        self.lock = threading.Lock()
+        # uuid -> (pid, start time)
+        self.cache = {}
+        # uuid -> list of pids, from the last scan of /proc
+        self.scanned = None
+        # pid -> (start time, command name, uuid), with a None uuid for the
+        # processes that are not qemu
+        self.processes = {}
+        self.scans = 0
+
+    def refresh(self):
+        """
+        Let the next lookup missing the pidfiles scan /proc again.
+        """
+        with self.lock:
+            self.scanned = None
+
+    def lookup(self, uuid, name=None):
+        """
+        Return the pid of the qemu process running the guest with this uuid,
+        or None if there is not exactly one.  The name of the domain is needed
+        to find its pidfile.
+        """
+        with self.lock:
+            entry = self.cache.get(uuid)
+            if entry is not None:
+                pid, start = entry
+                if self._start_time(pid) == start:
+                    return pid
+                del self.cache[uuid]
+
+            pid = None
+            if name is not None:
+                pid = self._from_pidfile(uuid, name)
+            if pid is None:
+                pid = self._from_scan(uuid)
+            if pid is not None:
+                start = self._start_time(pid)
+                if start is not None:
+                    self.cache[uuid] = (pid, start)
+            return pid
+
+    def qemu_pids(self, refresh=False):
+        """
+        Return the pids of all the qemu processes, from the last scan of /proc
+        or a new one.
+        """
+        with self.lock:
+            if refresh:
+                self.scanned = None
+            return [pid for pids in self._scan().values() for pid in pids]
+
+    def _from_pidfile(self, uuid, name):
+        for directory in self.pidfile_dirs:
+            try:
+                with open(os.path.join(directory, name + '.pid')) as f:
+                    pid = int(f.read())
+            except (IOError, ValueError):
+                continue
+            # The domain may have been restarted since the pidfile was read
+            if self._uuid_of(pid) == uuid:
+                return pid
+        return None
+
+    def _from_scan(self, uuid):
+        matches = self._scan().get(uuid)
+        if not matches:
+            self.scanned = None
+            matches = self._scan(full=True).get(uuid, [])
+        # The pids may have been reused since their command line was read
+        matches = [pid for pid in matches if self._uuid_of(pid) == uuid]
+        if len(matches) < 1:
+            self.logger.warning("No matching process for domain with uuid %s",
+                                uuid)
+            return None
+        elif len(matches) > 1:
+            self.logger.warning("Too many process matches for domain with "
+                                "uuid %s", uuid)
+            return None
+        return matches[0]
+
+    def _scan(self, full=False):
+        if self.scanned is None:
+            if full or self.scans % FULL_SCAN_EVERY == 0:
+                self.processes = {}
+            scanned = {}
+            processes = {}
+            for entry in os.listdir(self.proc):
+                if not entry.isdigit():
+                    continue
+                pid = int(entry)
+                identity = self._identity(pid)
+                if identity is None:
+                    continue
+                known = self.processes.get(pid)
+                if known is not None and known[:2] == identity:
+                    uuid = known[2]
+                else:
+                    uuid = self._uuid_of(pid)
+                processes[pid] = identity + (uuid,)
+                if uuid is not None:
+                    scanned.setdefault(uuid, []).append(pid)
+            self.scanned = scanned
+            self.processes = processes
+            self.scans += 1
+            # Forget the guests that are gone
+            for uuid in set(self.cache) - set(scanned):
+                del self.cache[uuid]
+        return self.scanned
+
+    def _uuid_of(self, pid):
+        """
+        Return the value of the -uuid option of a process, None if it has
+        none or does not exist anymore.
+        """
+        try:
+            with open('%s/%d/cmdline' % (self.proc, pid), 'rb') as f:
+                cmdline = f.read()
+        except IOError:
+            return None
+        if b'-uuid' not in cmdline:
+            return None
+        args = cmdline.split(b'\0')
+        try:
+            return args[args.index(b'-uuid') + 1].decode('utf-8')
+        except (ValueError, IndexError):
+            return None
+
+    def _start_time(self, pid):
+        identity = self._identity(pid)
+        if identity is None:
+            return None
+        return identity[0]
+
+    def _identity(self, pid):
+        """
+        Return the start time and command name of a process, which tell a
+        reused pid or an exec from the process scanned before, or None if it
+        does not exist anymore.
+        """
+        try:
+            with open('%s/%d/stat' % (self.proc, pid), 'rb') as f:
+                stat = f.read()
+        except IOError:
+            return None
+        # The command name may contain spaces, the fields follow its ')'
+        end = stat.rfind(b')')
+        fields = stat[end + 2:].split()
+        try:
+            return int(fields[19]), stat[stat.find(b'(') + 1:end]
+        except (IndexError, ValueError):
+            return None
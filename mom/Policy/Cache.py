@@ -0,0 +1,126 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from . import Parser
+from .Parser import NumericToken
+from .Parser import Token
+
+# Bump when the layout of the cache files changes
+FORMAT = 1
+
+def parser_digest():
+    """
+    Return a digest of the parser source.  Parsed code is only valid for the
+    parser that produced it, so any upgrade changing the parser invalidates
+    the cache.
+    """
+    digest = hashlib.sha256()
+    with open(Parser.__file__, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def _encode(code):
+    if isinstance(code, list):
+        return [_encode(item) for item in code]
+    token = {'kind': code.kind, 'value': code.value, 'line': code.line}
+    if isinstance(code, NumericToken):
+        token['type'] = code.type
+    return token
+
+def _decode(obj):
+    if 'type' in obj:
+        return NumericToken(obj['type'], obj['value'], obj['line'])
+    return Token(obj['kind'], obj['value'], obj['line'])
+
+class PolicyCache(object):
+    """
+    A directory of parsed policies, so policies that did not change since
+    the last time they were loaded are not parsed again.  Every policy is
+    stored in its own JSON file named after a hash of its source, the cache
+    format and the parser.  Files are written atomically and the least
+    recently used ones are removed once there are more than max_entries.
+
+    Compiled policies are made of closures and cannot be stored, so only
+    the output of get_code is kept.
+    """
+    def __init__(self, directory, max_entries=100):
+        self.logger = logging.getLogger('mom.Policy.Cache')
+        self.directory = directory
+        self.max_entries = max_entries
+        self.salt = ('%d:%s:' % (FORMAT, parser_digest())).encode('utf-8')
+
+    def path(self, policy_str):
+        digest = hashlib.sha256(self.salt)
+        digest.update(policy_str.encode('utf-8'))
+        return os.path.join(self.directory, digest.hexdigest() + '.json')
+
+    def load(self, policy_str):
+        """
+        Return the cached code of policy_str or None if it is not cached.
+        """
+        path = self.path(policy_str)
+        try:
+            with open(path, 'r') as f:
+                code = json.load(f, object_hook=_decode)
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                self.logger.warning("Ignoring policy cache file %s: %s",
+                                    path, e)
+            return None
+        self.logger.debug("Using cached policy %s", path)
+        return code
+
+    def store(self, policy_str, code):
+        """
+        Add the code returned by get_code for policy_str to the cache.
+        Errors are logged and otherwise ignored.
+        """
+        path = self.path(policy_str)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(_encode(code), f, separators=(',', ':'))
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self.prune()
+        except OSError as e:
+            self.logger.warning("Unable to cache policy in %s: %s",
+                                self.directory, e)
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    pass
+        entries.sort()
+        for mtime, path in entries[:-self.max_entries]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
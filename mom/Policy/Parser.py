@@ -18,12 +18,14 @@ from __future__ import division
 import logging
 from functools import total_ordering
 import re
-from .spark import GenericScanner, GenericParser
+import time
 
 class PolicyError(Exception): pass
 
 @total_ordering
 class Token(object):
+    __slots__ = ('kind', 'value', 'line')
+
     def __init__(self, kind, value=None, line=None):
         self.kind = kind
         self.line = line
@@ -45,133 +47,156 @@ class Token(object):
         return '[%s %s]' % (self.kind, self.value)
 
 class NumericToken(Token):
+    __slots__ = ('type',)
+
     def __init__(self, type, value, line=None):
         self.type = type
         Token.__init__(self, 'number', value, line)
 
-class Scanner(GenericScanner):
-    def __init__(self, operators=''):
-        self.operators = operators
-        GenericScanner.__init__(self)
-
-    def get_re(self, name):
-        if name == 'user_op':
-            def escape(op):
-                nop = ''
-                for ch in op:
-                    if ch in '+*.':
-                        nop += '\\'
-                    nop += ch
-                return nop
-            return ' %s ' % '|'.join(map(escape, self.operators))
+class Signature(object):
+    """
+    The decoded doc string of a builtin.  It holds the kind ('value', 'code'
+    or 'symbol') expected for each argument and whether the last kind repeats
+    for any number of additional arguments ('...').
+    """
+    def __init__(self, name, types):
+        self.name = name
+        self.variadic = types[-1].value == '...' and \
+                        types[-1].kind == 'operator'
+        if self.variadic:
+            self.kinds = tuple(t.value for t in types[:-1])
         else:
-            raise AttributeError(name)
+            self.kinds = tuple(t.value for t in types)
 
-    def tokenize(self, input):
-        self.rv = []
-        GenericScanner.tokenize(self, input)
-        return self.rv
+    def kind(self, i):
+        """
+        Return the kind of argument number i
+        """
+        if i < len(self.kinds):
+            return self.kinds[i]
+        elif self.kinds:
+            return self.kinds[-1]
+        return 'value'
 
-    def t_whitespace(self, s, line):
-        r' \s+ '
-        return s.count("\n")
+    def check_arity(self, nargs, line):
+        """
+        Verify that nargs arguments satisfy this signature.
+        Return a PolicyError describing the mismatch or None if they do.
+        """
+        # check if we can check arity - it is not possible when variable
+        # number of arguments is expected so instead check for the
+        # minimal number of required arguments
+        if not self.variadic and len(self.kinds) != nargs:
+            return PolicyError("arity mismatch in doc parsing of '%s'"
+                               " on line %d" % (self.name, line))
+        elif self.variadic and len(self.kinds) > nargs:
+            return PolicyError("not enough arguments for '%s'"
+                               " on line %d" % (self.name, line))
+        return None
+
+class Reader(object):
+    """
+    The Reader turns policy source text into the nested lists of Tokens
+    consumed by the Evaluator.  Tokenizing uses a single regular expression
+    whose alternatives are tried in a fixed order; the named group of each
+    match selects the token kind.  Lists are assembled with an explicit stack
+    so reading is linear in the size of the input.
+
+    Grammar:
+        value  ::= number | string | symbol | operator | list
+        list   ::= ( value* ) | [ value* ] | { value* }
+
+    A {} block reads as a list starting with the symbol 'eval'.
+    """
+    # Alternatives are matched in order, so more specific patterns must come
+    # first.  eg. numbers before symbols and operators.
+    patterns = [
+        ('whitespace', r'\s+'),
+        ('comment', r'\#[^\n]*'),
+        ('open', r'[\(\[{]'),
+        ('close', r'[\)\]}]'),
+        ('float', r'-?[0-9]*\.[0-9]+(?:[Ee][+-]?[0-9]+)?'),
+        ('hex', r'0[Xx][0-9A-Fa-f]+'),
+        ('integer', r'-?(?:0(?![0-9oXx])|[1-9][0-9]*)(?![0-9eE])'),
+        ('exponent', r'-?(?:0(?![0-9oXx])|[1-9][0-9]*)[Ee][+-]?[0-9]+'),
+        ('octal', r'0o[0-9]+'),
+        ('string', r'"(?:[^"\\]|\\.)*"' r"|'(?:[^'\\]|\\.)*'"),
+        ('symbol', r'[A-Za-z_][A-Za-z0-9_\-\.]*'),
+        ('operator', None),
+    ]
+
+    closing = {'(': ')', '[': ']', '{': '}'}
+
+    def __init__(self, operators=()):
+        regex = []
+        for name, pattern in self.patterns:
+            if name == 'operator':
+                if not operators:
+                    continue
+                pattern = '|'.join(map(re.escape, operators))
+            regex.append('(?P<%s>%s)' % (name, pattern))
+        self.re = re.compile('|'.join(regex))
 
-    def t_pound_comment(self, s, line):
-        r' \#.*?\n '
-        pass
+    def read(self, string):
+        """
+        Read all values in string.
+        Return: A list of values
+        """
+        match = self.re.match
+        line = 1
+        pos = 0
+        end = len(string)
+        # Each entry holds the list being built, its opening bracket and
+        # the line it was opened on
+        stack = []
+        values = []
+
+        while pos < end:
+            m = match(string, pos)
+            if m is None:
+                raise PolicyError("unexpected character '%s' on line %d" %
+                                  (string[pos], line))
+            kind = m.lastgroup
+            text = m.group()
+            pos = m.end()
+
+            if kind == 'whitespace':
+                line += text.count('\n')
+            elif kind == 'comment':
+                pass
+            elif kind == 'open':
+                stack.append((values, text, line))
+                if text == '{':
+                    values = [Token('symbol', 'eval', line)]
+                else:
+                    values = []
+            elif kind == 'close':
+                if not stack:
+                    raise PolicyError("parse error: unexpected '%s' on line "
+                                      "%d" % (text, line))
+                outer, opening, opened = stack.pop()
+                if self.closing[opening] != text:
+                    raise PolicyError("parse error: '%s' on line %d does not "
+                                      "match '%s' on line %d" %
+                                      (text, line, opening, opened))
+                outer.append(values)
+                values = outer
+            elif kind == 'symbol' or kind == 'operator':
+                values.append(Token(kind, text, line))
+            elif kind == 'string':
+                values.append(Token('string', text, line))
+                line += text.count('\n')
+            elif kind == 'exponent':
+                # Python only recognizes scientific notation on float types
+                values.append(NumericToken('float', text, line))
+            else:
+                values.append(NumericToken(kind, text, line))
 
-    def t_symbol(self, s, line):
-        r' [A-Za-z_][A-Za-z0-9_\-\.]* '
-        self.rv.append(Token('symbol', s, line))
-
-    def t_string(self, s, line):
-        r' "([^"\\]|\\.)*" '
-        self.rv.append(Token('string', s, line))
-
-    def t_single_quote_string(self, s, line):
-        r" '([^'\\]|\\.)*' "
-        self.rv.append(Token('string', s, line))
-
-    def t_float(self, s, line):
-        r' -?(0|([1-9][0-9]*))*(\.[0-9]+)([Ee][+-]?[0-9]+)? '
-        self.rv.append(NumericToken('float', s, line))
-
-    def t_integer(self, s, line):
-        r' -?(0(?![0-9oXx])|[1-9][0-9]*)(?![0-9eE]) '
-        self.rv.append(NumericToken('integer', s, line))
-
-    def t_integer_with_exponent(self, s, line):
-        r' -?(0(?![0-9oXx])|[1-9][0-9]*)[Ee][+-]?[0-9]+ '
-        # Python only recognizes scientific notation on float types
-        self.rv.append(NumericToken('float', s, line))
-
-    def t_hex(self, s, line):
-        r' 0[Xx][0-9A-Fa-f]+ '
-        self.rv.append(NumericToken('hex', s, line))
-
-    def t_octal(self, s, line):
-        r' 0o[0-9]+ '
-        self.rv.append(NumericToken('octal', s, line))
-
-    def t_builtin_op(self, s, line):
-        r' [\(\){}\[\]] '
-        self.rv.append(Token(s, line=line))
-
-    def t_user_op(self, s, line):
-        self.rv.append(Token('operator', s, line))
-
-class Parser(GenericParser):
-    def __init__(self, start='value'):
-        GenericParser.__init__(self, start)
-
-    def mklist(self, args):
-        if len(args) == 2:
-            return []
-        return args[1]
-
-    def p_value_list(self, args):
-        '''
-          value_list ::= value
-          value_list ::= value_list value
-        '''
-        if len(args) == 1:
-            return [args[0]]
-        return args[0] + [args[1]]
-
-    def p_list(self, args):
-        '''
-          list ::= ( )
-          list ::= ( value_list )
-        '''
-        return self.mklist(args)
-
-    def p_bracket_list(self, args):
-        '''
-          bracket_list ::= [ ]
-          bracket_list ::= [ value_list ]
-        '''
-        return self.mklist(args)
-
-    def p_curly_list(self, args):
-        '''
-          curly_list ::= { }
-          curly_list ::= { value_list }
-        '''
-        return [Token('symbol', 'eval')] + self.mklist(args)
-
-    def p_value(self, args):
-        '''
-          value ::= operator
-          value ::= number
-          value ::= operator
-          value ::= symbol
-          value ::= string
-          value ::= single_quote_string
-          value ::= list
-          value ::= curly_list
-          value ::= bracket_list
-         '''
-        return args[0]
+        if stack:
+            outer, opening, opened = stack[-1]
+            raise PolicyError("parse error: '%s' on line %d is never closed" %
+                              (opening, opened))
+        return values
 
 class ExternalFunctions(object):
     '''
@@ -207,10 +232,7 @@ class GenericEvaluator(object):
                       reverse = True)
 
     def parse_doc(self, doc):
-        scanner = Scanner(['...'])
-        tokens = scanner.tokenize(doc)
-        parser = Parser(start='value_list')
-        return parser.parse(tokens)
+        return Reader(['...']).read(doc)
 
     # TODO: split up doc parsing...
     # use elipse syntax to indicate repetition in a
@@ -221,37 +243,38 @@ class GenericEvaluator(object):
     # is a list of zero or more tuples of symbol value
     # (symbol number ...)
     # is a list containing a symbol and zero or more numbers
+    def get_signature(self, name):
+        """
+        Return the Signature of the builtin with the given name or None if
+        it does not document its arguments.  Doc strings are parsed once per
+        Evaluator class, the first time any of its builtins is needed.
+        """
+        cls = type(self)
+        table = cls.__dict__.get('signature_table')
+        if table is None:
+            table = {}
+            for attr in dir(cls):
+                fn = getattr(cls, attr)
+                if attr.startswith('c_') and fn.__doc__ is not None:
+                    table[attr] = Signature(fn.__name__,
+                                            self.parse_doc(fn.__doc__))
+            cls.signature_table = table
+        return table.get(name)
+
     def _dispatch(self, fn, args, line):
-        doc = fn.__doc__
-        if doc == None:
+        signature = self.get_signature(fn.__name__)
+        if signature is None:
             args = list(map(self.eval, args))
         else:
-            types = self.parse_doc(doc)
-
-            # check if we can check arity - it is not possible when variable
-            # number of arguments is expected so instead check for the
-            # minimal number of required arguments
-            if len(types) != len(args) and (types[-1].value != '...'
-                                            or types[-1].kind != 'operator'):
-                raise PolicyError("arity mismatch in doc parsing of '%s'"
-                                  " on line %d" % (fn.__name__, line))
-            elif types[-1].value == '...' and len(types) > len(args) + 1:
-                raise PolicyError("not enough arguments for '%s'"
-                                  " on line %d" % (fn.__name__, line))
-
-            i = 0
-            while types and i < len(args):
-                # if we are repeating (...) element types, leave type intact
-                if types[0].value != '...' or types[0].kind != 'operator':
-                    type = types.pop(0)
-                # also get the type when it is the first ... or operator
-                elif i == 0:
-                    type = types[0]
-
-                if type.value == 'code':
-                    i += 1
+            error = signature.check_arity(len(args), line)
+            if error is not None:
+                raise error
+
+            for i in range(len(args)):
+                kind = signature.kind(i)
+                if kind == 'code':
                     continue
-                elif type.value == 'symbol':
+                elif kind == 'symbol':
                     if not isinstance(args[i], Token) or args[i].kind != 'symbol':
                         raise PolicyError('malformed expression'
                                           ' on line %d' % line)
@@ -259,9 +282,6 @@ class GenericEvaluator(object):
                 else:
                     args[i] = self.eval(args[i])
 
-                # next argument
-                i += 1
-
         return fn(*args)
 
     def eval(self, code):
@@ -304,40 +324,67 @@ class GenericEvaluator(object):
             raise PolicyError('Unknown function "%s" with no default handler'
                               ' on line %d' % (name, node.line))
 
+class Frame(object):
+    """
+    A single scope of the VariableStack.  Each frame links to the frame that
+    was active when it was entered.
+    """
+    __slots__ = ('vars', 'parent')
+
+    def __init__(self, parent=None):
+        self.vars = {}
+        self.parent = parent
+
 class VariableStack(object):
+    """
+    The VariableStack holds the variables visible to a running policy as a
+    chain of linked Frames, innermost first.  Entering and leaving a scope
+    only links or unlinks one frame.
+    """
     def __init__(self):
-        self.stack = []
+        self.top = None
 
     def enter_scope(self):
-        self.stack = [{}] + self.stack
+        self.top = Frame(self.top)
 
     def leave_scope(self):
-        self.stack = self.stack[1:]
+        self.top = self.top.parent
 
     def get(self, name, allow_undefined=False, line=None):
         # Split the name on '.' to handle object references
         parts = name.split('.')
-        obj = parts[0]
-        for scope in self.stack:
-            if obj in scope:
-                if len(parts) > 1:
-                    if hasattr(scope[obj], parts[1]):
-                        return getattr(scope[obj], parts[1])
-                else:
-                    return scope[obj]
+        attr = parts[1] if len(parts) > 1 else None
+        return self.lookup(self.top, parts[0], attr, name, allow_undefined,
+                           line)
+
+    def lookup(self, frame, obj, attr, name, allow_undefined=False,
+               line=None):
+        """
+        Search frame and its parents for the variable obj and, when attr is
+        given, an object reference obj.attr.  This is get() with the name
+        already split for code that resolves names ahead of time.
+        """
+        while frame is not None:
+            if obj in frame.vars:
+                if attr is None:
+                    return frame.vars[obj]
+                elif hasattr(frame.vars[obj], attr):
+                    return getattr(frame.vars[obj], attr)
+            frame = frame.parent
         if allow_undefined:
             return None
         raise PolicyError("undefined symbol %s on line %d" % (name, line))
 
     def set(self, name, value, alloc=False):
         if alloc:
-            self.stack[0].setdefault(name, value)
-            return self.stack[0][name]
+            return self.top.vars.setdefault(name, value)
 
-        for scope in self.stack:
-            if name in scope:
-                scope[name] = value
+        frame = self.top
+        while frame is not None:
+            if name in frame.vars:
+                frame.vars[name] = value
                 return value
+            frame = frame.parent
 
         raise PolicyError("undefined symbol %s" % name)
 
@@ -352,23 +399,51 @@ class Evaluator(GenericEvaluator):
                     'min': 'min', 'max': 'max', "null": "null",
                     "valid": "valid"}
 
-    def __init__(self):
+    def __init__(self, variables=None, funcs=None):
+        """
+        Create an Evaluator with a clean stack.  A prepared global
+        environment (see Program) can be passed in as variables and funcs,
+        both are copied so the evaluation cannot change them.
+        """
         GenericEvaluator.__init__(self)
         self.stack = VariableStack()
-        self.funcs = {}
+        # The ProfileRun recording timings, see Compiler
+        self.profile = None
+        # Results of pure user functions, see Compiler.is_pure
+        self.memo = {}
         self.stack.enter_scope()
-        self.import_externs()
+        if variables is None:
+            self.import_externs()
+        else:
+            self.stack.top.vars.update(variables)
+        self.funcs = dict(funcs) if funcs else {}
+
+    def get_externs(self):
+        """
+        Return the ExternalFunctions as a dict of name to function.  It is
+        built once per Evaluator class.
+        """
+        cls = type(self)
+        externs = cls.__dict__.get('extern_table')
+        if externs is None:
+            externs = {}
+            for i in dir(ExternalFunctions):
+                if not re.match("__", i):
+                    externs[i] = getattr(ExternalFunctions, i)
+            cls.extern_table = externs
+        return externs
 
     def import_externs(self):
-        for i in dir(ExternalFunctions):
-            if not re.match("__", i):
-                self.stack.set(i, getattr(ExternalFunctions, i), True)
+        self.stack.top.vars.update(self.get_externs())
 
     def eval_symbol(self, name, line):
         return self.stack.get(name, line=line)
 
     def eval_number(self, token):
-        if token.type == 'float':
+        if token.type == 'constant':
+            # A value computed by the Optimizer when the policy was loaded
+            return token.value
+        elif token.type == 'float':
             return float(token.value)
         elif token.type in ('integer', 'hex', 'octal'):
             return int(token.value, 0)
@@ -537,16 +612,1031 @@ class Evaluator(GenericEvaluator):
         except TypeError:
             return False
 
+def _fail(error):
+    """
+    Return compiled code that raises error when it is evaluated.  Problems
+    found while compiling are reported at evaluation time, exactly where the
+    tree-walking evaluator would have reported them.
+    """
+    def fail(e):
+        raise error
+    return fail
+
+def _constant(value):
+    return lambda e: value
+
+def _call(fn, args):
+    """
+    Bind fn and its compiled arguments into a single call.  The common small
+    arities are spelled out to avoid building an argument list on every call.
+    """
+    if len(args) == 0:
+        return lambda e: fn(e)
+    elif len(args) == 1:
+        a, = args
+        return lambda e: fn(e, a(e))
+    elif len(args) == 2:
+        a, b = args
+        return lambda e: fn(e, a(e), b(e))
+    elif len(args) == 3:
+        a, b, c = args
+        return lambda e: fn(e, a(e), b(e), c(e))
+    return lambda e: fn(e, *[arg(e) for arg in args])
+
+def _definitions(code, forms, names):
+    """
+    Append the name defined by every form in forms (like 'defvar') found in
+    code, however deeply nested, to the list names.
+    """
+    if isinstance(code, list):
+        if len(code) > 1 and isinstance(code[0], Token) and \
+                code[0].kind == 'symbol' and code[0].value in forms and \
+                isinstance(code[1], Token) and code[1].kind == 'symbol':
+            names.append(code[1].value)
+        for item in code:
+            _definitions(item, forms, names)
+    return names
+
+def _timed(key, fn):
+    """
+    Wrap compiled code to account its time to key when the Evaluator it
+    runs with has a ProfileRun.
+    """
+    def timed(e):
+        if e.profile is None:
+            return fn(e)
+        return e.profile.call(key, fn, e)
+    return timed
+
+def _line(code):
+    while isinstance(code, list) and len(code) > 0:
+        code = code[0]
+    return code.line if isinstance(code, Token) else 0
+
+def _label(origin, line, text=None):
+    """
+    Describe a place in the policy for the profiler.
+    """
+    label = "line %d" % line if origin is None else "%s:%d" % (origin, line)
+    if text is not None:
+        label = "%s %s" % (label, text)
+    return label
+
+def _item_name(item, index):
+    """
+    Name a guest of a with loop for the profiler, by its index when it has
+    no name property.
+    """
+    properties = getattr(item, 'properties', None)
+    if isinstance(properties, dict) and properties.get('name') is not None:
+        return str(properties['name'])
+    return '#%d' % index
+
+def _defvars(code):
+    return set(_definitions(code, ('defvar',), []))
+
+def _symbols(code, names):
+    """
+    Add every variable or function name that code refers to to the set names.
+    """
+    if isinstance(code, list):
+        for item in code:
+            _symbols(item, names)
+    elif isinstance(code, Token) and code.kind == 'symbol':
+        names.add(code.value.split('.')[0])
+    return names
+
+class Scope(object):
+    """
+    The compile time view of a Frame that let, with or a function call will
+    push at runtime.  names are bound as soon as the frame exists, defvars
+    may or may not be bound depending on what the code does.  An opaque
+    scope stands for a frame whose names are not known when compiling.
+    """
+    __slots__ = ('names', 'defvars', 'opaque')
+
+    def __init__(self, names=(), defvars=(), opaque=False):
+        self.names = set(names)
+        self.defvars = set(defvars)
+        self.opaque = opaque
+
+class Compiler(object):
+    """
+    The Compiler translates the code returned by get_code into a tree of
+    Python closures.  Every closure takes the Evaluator to run against as its
+    only argument and returns the value of its expression, so a policy can be
+    compiled once and then evaluated many times with fresh Evaluators.  The
+    results are identical to running the same code through Evaluator.eval.
+    """
+    # Methods of the host and guest Entities that only read their snapshot
+    pure_methods = ('Stat', 'StatAvg', 'StatMin', 'StatMax', 'StatEwma',
+                    'StatDelta', 'StatRate', 'Prop')
+    # ExternalFunctions without side effects
+    pure_externs = ('abs',)
+
+    def __init__(self, e, vectorize=False, profile=False, preset=None):
+        """
+        preset lists the names the caller sets on the stack before every
+        run, like Host and Guests, and tells that every run uses a new
+        Evaluator.  User functions only reading those names, their arguments
+        and their own variables then have their results memoized for the
+        duration of a run.
+        """
+        self.evaluator = e
+        self.memoize = preset is not None
+        self.preset = set(preset or ())
+        # Add timing wrappers for the profiler
+        self.profile = profile
+        # The name of the policy being compiled, for profile labels
+        self.origin = None
+        # Run with loops through the vector evaluator when NumPy is there
+        self.vector = None
+        if vectorize:
+            from . import Vector
+            if Vector.available():
+                self.vector = Vector
+        # Names that policy code can bind on the stack.  A builtin is only
+        # resolved at compile time when nothing can shadow it at runtime.
+        self.externs = set(e.get_externs())
+        self.bound = set(self.externs)
+        # Names bound or set by the policy itself
+        self.assigned = set()
+        # The (params, code) of every def of a function name
+        self.definitions = {}
+        # Purity of user functions indexed by id() of their code
+        self.purity = {}
+        # Compiled user function bodies indexed by id() of their code
+        self.functions = {}
+        # Scopes of the code being compiled, innermost last.  Only scopes
+        # within the current function body are listed since callers are
+        # not known until runtime.
+        self.scopes = []
+
+    def compile(self, code, origins=None):
+        """
+        Compile a list of top-level expressions.  origins optionally names
+        the policy every expression comes from.
+        Return: A list of compiled expressions
+        """
+        self.scan_bindings(code)
+        compiled = []
+        for i, expr in enumerate(code):
+            if origins is not None:
+                self.origin = origins[i]
+            compiled.append(self.compile_expr(expr))
+        return compiled
+
+    def timed(self, kind, name, fn):
+        if not self.profile:
+            return fn
+        return _timed((kind, name), fn)
+
+    def scan_bindings(self, code):
+        if not isinstance(code, list) or len(code) == 0:
+            return
+        node = code[0]
+        if isinstance(node, Token) and node.kind == 'symbol':
+            if node.value == 'defvar' and len(code) > 1:
+                self._bind(code[1])
+            elif node.value in ('set', 'setq') and len(code) > 1 and \
+                    isinstance(code[1], Token):
+                self.assigned.add(code[1].value)
+            elif node.value == 'let' and len(code) > 1 and \
+                    isinstance(code[1], list):
+                for sym in code[1]:
+                    if isinstance(sym, list) and len(sym) > 0:
+                        self._bind(sym[0])
+            elif node.value == 'with' and len(code) > 2:
+                self._bind(code[2])
+            elif node.value in ('def', 'defun') and len(code) > 2 and \
+                    isinstance(code[2], list):
+                for param in code[2]:
+                    self._bind(param)
+                if len(code) == 4 and isinstance(code[1], Token):
+                    self.definitions.setdefault(code[1].value, []).append(
+                        (code[2], code[3]))
+        for item in code:
+            self.scan_bindings(item)
+
+    def _bind(self, token):
+        if isinstance(token, Token) and token.kind == 'symbol':
+            self.bound.add(token.value)
+            self.assigned.add(token.value)
+
+    def resolve(self, name):
+        """
+        Find the frame that holds name when the code being compiled runs.
+        Return: The number of frames to skip from the top of the stack or
+                None if the name must be searched for at runtime
+        """
+        for depth, scope in enumerate(reversed(self.scopes)):
+            if scope.opaque or name in scope.defvars:
+                return None
+            if name in scope.names:
+                return depth
+        return None
+
+    def compile_lookup(self, name, line, allow_undefined=False):
+        """
+        Compile a variable reference.  Names bound by an enclosing let, with
+        or function parameter are read straight from their frame, everything
+        else is searched for on the stack like VariableStack.get does.
+        """
+        parts = name.split('.')
+        obj = parts[0]
+        attr = parts[1] if len(parts) > 1 else None
+        depth = self.resolve(obj)
+
+        if depth is None:
+            def lookup(e):
+                stack = e.stack
+                return stack.lookup(stack.top, obj, attr, name,
+                                    allow_undefined, line)
+            return lookup
+
+        def lookup(e):
+            frame = e.stack.top
+            for i in range(depth):
+                frame = frame.parent
+            value = frame.vars[obj]
+            if attr is None:
+                return value
+            try:
+                return getattr(value, attr)
+            except AttributeError:
+                # Like VariableStack.get, keep looking in outer frames
+                return e.stack.lookup(frame.parent, obj, attr, name,
+                                      allow_undefined, line)
+        return lookup
+
+    def builtin(self, name):
+        return getattr(type(self.evaluator), 'c_%s' % name, None)
+
+    def compile_expr(self, code):
+        if isinstance(code, Token):
+            return self.compile_token(code)
+
+        if len(code) == 0:
+            return _fail(PolicyError('Empty expression'))
+
+        node = code[0]
+        if not isinstance(node, Token):
+            return _fail(PolicyError('Expected simple token as arg 1'))
+
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator':
+            name = self.evaluator.operator_map[node.value]
+        else:
+            return _fail(PolicyError('Unexpected token type in arg 1 "%s"'
+                                     ' on line %d' % (node.kind, node.line)))
+
+        args = code[1:]
+        if name not in self.bound:
+            if hasattr(self, 'form_%s' % name):
+                return self.timed('builtin', name, getattr(
+                    self, 'form_%s' % name)(args, node.line))
+            fn = self.builtin(name)
+            if fn is not None:
+                return self.timed('builtin', name,
+                                  self.compile_builtin(name, args, node.line))
+        return self.compile_call(name, args, node.line)
+
+    def compile_token(self, token):
+        if token.kind == 'number':
+            try:
+                return _constant(self.evaluator.eval_number(token))
+            except PolicyError as e:
+                return _fail(e)
+        elif token.kind == 'string':
+            return _constant(token.value[1:-1])
+        elif token.kind == 'symbol':
+            if token.value == "nil":
+                return _constant(None)
+            return self.compile_lookup(token.value, token.line)
+        return _fail(PolicyError('Unexpected token type "%s" on line %d' %
+                                 (token.kind, token.line)))
+
+    def compile_builtin(self, name, args, line):
+        """
+        Compile a call to one of the c_* builtins of the Evaluator.
+        """
+        fn = self.builtin(name)
+        signature = self.evaluator.get_signature('c_%s' % name)
+        if signature is None:
+            return _call(fn, [self.compile_expr(arg) for arg in args])
+
+        error = signature.check_arity(len(args), line)
+        if error is not None:
+            return _fail(error)
+
+        compiled = []
+        for i, arg in enumerate(args):
+            kind = signature.kind(i)
+            if kind == 'code':
+                # Only the special forms know how to run compiled code
+                return lambda e: e._dispatch(getattr(e, 'c_%s' % name),
+                                             args, line)
+            elif kind == 'symbol':
+                if not isinstance(arg, Token) or arg.kind != 'symbol':
+                    return _fail(PolicyError('malformed expression'
+                                             ' on line %d' % line))
+                compiled.append(_constant(arg.value))
+            else:
+                compiled.append(self.compile_expr(arg))
+        return _call(fn, compiled)
+
+    def compile_call(self, name, args, line):
+        """
+        Compile a call to something that is only known at runtime: a Python
+        callable stored on the stack or a user function defined with def.
+        """
+        compiled = [self.compile_expr(arg) for arg in args]
+        if self.builtin(name) is not None:
+            fallback = self.compile_builtin(name, args, line)
+        else:
+            fallback = self.compile_user_call(name, args, line)
+        lookup = self.compile_lookup(name, line, allow_undefined=True)
+        key = ('call', name) if self.profile else None
+
+        def call(e):
+            func = lookup(e)
+            if func is not None:
+                values = [arg(e) for arg in compiled]
+                if key is not None and e.profile is not None:
+                    return e.profile.call(key, func, *values)
+                return func(*values)
+            return fallback(e)
+        return call
+
+    def compile_user_call(self, name, args, line):
+        if name == 'eval':
+            return self.compile_block([self.compile_expr(arg) for arg in args])
+
+        # The arguments are evaluated in the frame of the function, after
+        # the parameters before them are bound.  Those names are not known
+        # until runtime so nothing can be resolved through that frame.
+        self.scopes.append(Scope(opaque=True))
+        compiled = [self.compile_expr(arg) for arg in args]
+        self.scopes.pop()
+
+        def call(e):
+            params, code = e.funcs[name]
+            if len(params) != len(compiled):
+                raise PolicyError('Function "%s" invoked with incorrect arity'
+                                  ' on line %d' % (name, line))
+            return self.function(params, code)(e, compiled)
+        return self.timed('function', name, call)
+
+    def compile_block(self, compiled):
+        if len(compiled) == 0:
+            return _fail(PolicyError('Empty expression'))
+        *init, last = compiled
+        def block(e):
+            for expr in init:
+                expr(e)
+            return last(e)
+        return block
+
+    def function(self, params, code):
+        """
+        Get the compiled form of a user function.  Functions are defined at
+        runtime so their bodies are compiled on first use and then reused.
+        """
+        try:
+            cached_code, invoke = self.functions[id(code)]
+            if cached_code is code:
+                return invoke
+        except KeyError:
+            pass
+
+        names = []
+        for param in params:
+            if not isinstance(param, Token) or param.kind != 'symbol':
+                def invoke(e, args):
+                    raise PolicyError('Expecting list of (symbol value)'
+                                      ' in let')
+                break
+            names.append(param.value)
+        else:
+            scopes = self.scopes
+            self.scopes = [Scope(names, _defvars(code))]
+            body = self.compile_expr(code)
+            self.scopes = scopes
+
+            def invoke(e, args):
+                # Arguments are bound one by one in the new scope just like
+                # the let form generated by Evaluator.default
+                e.stack.enter_scope()
+                for name, arg in zip(names, args):
+                    e.stack.set(name, arg(e), True)
+                result = body(e)
+                e.stack.leave_scope()
+                return result
+
+            if self.memoize and self.is_pure(params, code):
+                invoke = self.memoized(names, body)
+        self.functions[id(code)] = (code, invoke)
+        return invoke
+
+    def memoized(self, names, body):
+        """
+        Return an invoke function that caches the results of a pure user
+        function in the Evaluator, by the type and value of its arguments.
+        """
+        key = object()
+        def invoke(e, args):
+            e.stack.enter_scope()
+            values = []
+            for name, arg in zip(names, args):
+                values.append(e.stack.set(name, arg(e), True))
+            memo = e.memo.get(key)
+            if memo is None:
+                memo = e.memo[key] = {}
+            args_key = tuple((type(v), v) for v in values)
+            try:
+                result = memo.get(args_key, memo)
+            except TypeError:
+                # Some argument cannot be hashed
+                result = body(e)
+            else:
+                if result is memo:
+                    result = memo[args_key] = body(e)
+            e.stack.leave_scope()
+            return result
+        return invoke
+
+    def is_pure(self, params, code):
+        """
+        Check whether a user function always returns the same result for
+        the same arguments during a run and has no side effects.  Its body
+        may only read its parameters, the variables it binds itself and the
+        preset names, and call pure builtins, pure Entity methods and other
+        pure user functions.  set is only allowed on its own variables.
+        """
+        key = id(code)
+        if key not in self.purity:
+            # Recursive calls are assumed pure while the body is checked
+            self.purity[key] = True
+            names = set()
+            for param in params:
+                if not isinstance(param, Token) or param.kind != 'symbol':
+                    self.purity[key] = False
+                    return False
+                names.add(param.value)
+            self.purity[key] = self._pure(code, names, True)
+        return self.purity[key]
+
+    def _pure_name(self, name, local):
+        obj = name.split('.')[0]
+        return obj in local or (obj in self.preset and
+                                obj not in self.assigned)
+
+    def _pure_block(self, code, local, definite):
+        """
+        Check a sequence of expressions run in the same frame.  A defvar
+        that always runs binds its name for the expressions after it.
+        """
+        for expr in code:
+            if not self._pure(expr, local, definite):
+                return False
+            if definite and isinstance(expr, list) and len(expr) == 3 and \
+                    expr[0] == 'symbol' and expr[0].value == 'defvar' and \
+                    isinstance(expr[1], Token) and expr[1].kind == 'symbol':
+                local.add(expr[1].value)
+        return True
+
+    def _pure(self, code, local, definite):
+        """
+        Check one expression.  local holds the names certainly bound in the
+        function or its inner scopes and definite tells if code always runs
+        when the frame it is in runs.
+        """
+        if isinstance(code, Token):
+            if code.kind == 'symbol' and code.value != 'nil':
+                return self._pure_name(code.value, local)
+            return code.kind in ('number', 'string', 'symbol')
+        if len(code) == 0 or not isinstance(code[0], Token) or \
+                code[0].kind not in ('symbol', 'operator'):
+            return False
+        node = code[0]
+        if node.kind == 'operator':
+            name = self.evaluator.operator_map[node.value]
+        else:
+            name = node.value
+        args = code[1:]
+
+        if name in self.bound or '.' in name:
+            # A Python callable on the stack
+            if '.' in name:
+                obj, method = name.split('.', 1)
+                pure = method in self.pure_methods and \
+                    self._pure_name(obj, local)
+            else:
+                pure = name in self.pure_externs and \
+                    name not in self.assigned
+            return pure and all(self._pure(arg, local, definite)
+                                for arg in args)
+
+        if name == 'eval':
+            return self._pure_block(args, local, definite)
+        elif name == 'if' and len(args) == 3:
+            return self._pure(args[0], local, definite) and \
+                self._pure(args[1], local, False) and \
+                self._pure(args[2], local, False)
+        elif name in ('set', 'setq', 'defvar') and len(args) == 2:
+            if not isinstance(args[0], Token) or args[0].kind != 'symbol':
+                return False
+            if name != 'defvar' and args[0].value not in local:
+                return False
+            return self._pure(args[1], local, definite)
+        elif name == 'let' and len(args) > 1 and type(args[0]) == list:
+            inner = set(local)
+            for sym in args[0]:
+                if type(sym) != list or len(sym) != 2 or \
+                        not isinstance(sym[0], Token) or \
+                        not self._pure(sym[1], inner, definite):
+                    return False
+                inner.add(sym[0].value)
+            return self._pure_block(args[1:], inner, definite)
+        elif name == 'with' and len(args) == 3:
+            iterable, iterator, body = args
+            if not isinstance(iterable, Token) or \
+                    not isinstance(iterator, Token) or \
+                    not self._pure_name(iterable.value, local):
+                return False
+            return self._pure_block([body], local | {iterator.value},
+                                    definite)
+        elif name in Program.pure:
+            return all(self._pure(arg, local, definite) for arg in args)
+        elif self.builtin(name) is not None or \
+                len(self.definitions.get(name, ())) != 1:
+            return False
+
+        # A user function call, its arguments are evaluated in its frame
+        # so their defvars do not bind anything here
+        params, body = self.definitions[name][0]
+        return type(params) == list and len(params) == len(args) and \
+            self.is_pure(params, body) and \
+            all(self._pure(arg, local, False) for arg in args)
+
+    def check_form(self, name, args, line):
+        signature = self.evaluator.get_signature('c_%s' % name)
+        return signature.check_arity(len(args), line)
+
+    def form_eval(self, args, line):
+        return self.compile_block([self.compile_expr(arg) for arg in args])
+
+    def form_if(self, args, line):
+        error = self.check_form('if', args, line)
+        if error is not None:
+            return _fail(error)
+        cond, yes, no = [self.compile_expr(arg) for arg in args]
+        return lambda e: yes(e) if cond(e) else no(e)
+
+    def form_def(self, args, line):
+        error = self.check_form('def', args, line)
+        if error is not None:
+            return _fail(error)
+        name, params, code = args
+        if not isinstance(name, Token) or name.kind != 'symbol':
+            return _fail(PolicyError('malformed expression on line %d' % line))
+        if isinstance(params, list):
+            # Compile the body now so the first call does not pay for it
+            self.function(params, code)
+        fn = self.builtin('def')
+        return lambda e: fn(e, name.value, params, code)
+
+    form_defun = form_def
+
+    def form_let(self, args, line):
+        error = self.check_form('let', args, line)
+        if error is not None:
+            return _fail(error)
+        syms, code = args[0], args[1:]
+        if type(syms) != list:
+            return _fail(PolicyError('Expecting list as arg 1 in let'))
+
+        scope = Scope(defvars=_defvars(args))
+        self.scopes.append(scope)
+        bindings = []
+        for sym in syms:
+            if type(sym) != list or len(sym) != 2:
+                self.scopes.pop()
+                return _fail(PolicyError('Expecting list of tuples in arg1'
+                                         ' of let'))
+            name, value = sym
+            if not isinstance(name, Token) or name.kind != 'symbol':
+                self.scopes.pop()
+                return _fail(PolicyError('Expecting list of (symbol value)'
+                                         ' in let'))
+            # Each value sees the bindings before it, like c_let
+            bindings.append((name.value, self.compile_expr(value)))
+            scope.names.add(name.value)
+        body = self.compile_block([self.compile_expr(expr) for expr in code])
+        self.scopes.pop()
+
+        def let(e):
+            e.stack.enter_scope()
+            for name, value in bindings:
+                e.stack.set(name, value(e), True)
+            result = body(e)
+            e.stack.leave_scope()
+            return result
+        return let
+
+    def form_with(self, args, line):
+        error = self.check_form('with', args, line)
+        if error is not None:
+            return _fail(error)
+        iterable, iterator, code = args
+        for arg in (iterable, iterator):
+            if not isinstance(arg, Token) or arg.kind != 'symbol':
+                return _fail(PolicyError('malformed expression'
+                                         ' on line %d' % line))
+        items = self.compile_lookup(iterable.value, line)
+        iterator = iterator.value
+        self.scopes.append(Scope([iterator], _defvars(code)))
+        body = self.compile_expr(code)
+        self.scopes.pop()
+
+        def loop(e, values):
+            result = []
+            for item in values:
+                e.stack.enter_scope()
+                e.stack.set(iterator, item, True)
+                result.append(body(e))
+                e.stack.leave_scope()
+            return result
+
+        vector = self.vector
+        if vector is not None:
+            scalar = loop
+            def loop(e, values):
+                result = vector.run(e, values, iterator, code)
+                if result is None:
+                    result = scalar(e, values)
+                return result
+
+        if not self.profile:
+            if vector is None:
+                return lambda e: loop(e, items(e))
+            return lambda e: loop(e, list(items(e)))
+
+        label = _label(self.origin, line)
+        if vector is None:
+            # Time the body for each guest, a vectorized loop evaluates
+            # them all at once
+            def timed(e, values):
+                result = []
+                for index, item in enumerate(values):
+                    start = time.perf_counter()
+                    e.stack.enter_scope()
+                    e.stack.set(iterator, item, True)
+                    result.append(body(e))
+                    e.stack.leave_scope()
+                    e.profile.guest(label, _item_name(item, index),
+                                    time.perf_counter() - start)
+                return result
+        else:
+            timed = loop
+        def with_(e):
+            values = list(items(e))
+            if e.profile is None:
+                return loop(e, values)
+            start = time.perf_counter()
+            result = timed(e, values)
+            e.profile.loop(label, len(values), time.perf_counter() - start)
+            return result
+        return with_
+
+class Optimizer(object):
+    """
+    The Optimizer rewrites the code returned by get_code before it is
+    compiled.  Top-level defvars of constants that nothing else ever binds
+    or sets are substituted into the code that follows them, calls of pure
+    builtins with constant arguments are replaced by their result and if
+    forms with a constant condition are replaced by the branch they take.
+
+    Computed values are stored in NumericTokens of type 'constant' carrying
+    the line of the expression they replace.  Everything that is not folded
+    keeps its original tokens, so errors report the same lines as before.
+    Nothing is folded when evaluating it raises, the error then happens at
+    runtime as it would have without the Optimizer.
+    """
+    def __init__(self, e, preset=()):
+        """
+        Optimize code for Evaluators like e.  preset lists the names the
+        caller sets on the stack before every run, like Host and Guests.
+        """
+        self.evaluator = e
+        self.preset = set(preset) | set(e.get_externs())
+        # Names that policy code binds or sets and how many times
+        self.bindings = {}
+        # The top-level constants substituted so far
+        self.constants = {}
+
+    def optimize(self, code):
+        """
+        Return an optimized copy of the list of top-level expressions code.
+        The expressions are never removed, only rewritten.
+        """
+        self.bindings = {}
+        self.constants = {}
+        self.scan(code)
+        seen = set(self.preset)
+        result = []
+        for expr in code:
+            expr = self.fold(expr)
+            name = self.constant_definition(expr)
+            if name is not None and name not in seen:
+                self.constants[name] = expr[2]
+            _symbols(expr, seen)
+            result.append(expr)
+        return result
+
+    def scan(self, code):
+        if not isinstance(code, list) or len(code) == 0:
+            return
+        node = code[0]
+        if isinstance(node, Token) and node.kind == 'symbol':
+            if node.value in ('defvar', 'set', 'setq') and len(code) > 1:
+                self._bind(code[1])
+            elif node.value == 'let' and len(code) > 1 and \
+                    isinstance(code[1], list):
+                for sym in code[1]:
+                    if isinstance(sym, list) and len(sym) > 0:
+                        self._bind(sym[0])
+            elif node.value == 'with' and len(code) > 2:
+                self._bind(code[2])
+            elif node.value in ('def', 'defun') and len(code) > 2 and \
+                    isinstance(code[2], list):
+                for param in code[2]:
+                    self._bind(param)
+        for item in code:
+            self.scan(item)
+
+    def _bind(self, token):
+        if isinstance(token, Token) and token.kind == 'symbol':
+            self.bindings[token.value] = self.bindings.get(token.value, 0) + 1
+
+    def is_bound(self, name):
+        return name in self.bindings or name in self.preset
+
+    def constant_definition(self, expr):
+        """
+        Return the name defined by expr when it is a defvar of a constant
+        that is the only binding of that name, otherwise None.
+        """
+        if not isinstance(expr, list) or len(expr) != 3 or \
+                not isinstance(expr[0], Token) or \
+                expr[0].kind != 'symbol' or expr[0].value != 'defvar' or \
+                self.is_bound('defvar') or \
+                not isinstance(expr[1], Token) or expr[1].kind != 'symbol':
+            return None
+        name = expr[1].value
+        if '.' in name or self.bindings.get(name) != 1 or \
+                name in self.preset or not self.is_literal(expr[2]):
+            return None
+        return name
+
+    def is_literal(self, code):
+        return isinstance(code, Token) and \
+            (code.kind in ('number', 'string') or
+             (code.kind == 'symbol' and code.value == 'nil'))
+
+    def literal(self, value, line):
+        """
+        Return a token for value or None if value cannot be represented.
+        """
+        if value is None:
+            return Token('symbol', 'nil', line)
+        elif type(value) is str:
+            return Token('string', '"%s"' % value, line)
+        elif type(value) in (int, float, bool):
+            return NumericToken('constant', value, line)
+        return None
+
+    def fold(self, code):
+        if isinstance(code, Token):
+            if code.kind == 'symbol' and code.value in self.constants:
+                constant = self.constants[code.value]
+                return self.literal(self.evaluator.eval(constant), code.line)
+            return code
+
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return code
+        node = code[0]
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator':
+            name = self.evaluator.operator_map[node.value]
+        else:
+            return code
+
+        args = code[1:]
+        fn = getattr(type(self.evaluator), 'c_%s' % name, None)
+        if self.is_bound(name) or fn is None:
+            # A user function, a Python callable or a block
+            return [node] + [self.fold(arg) for arg in args]
+
+        signature = self.evaluator.get_signature('c_%s' % name)
+        if signature is None or \
+                signature.check_arity(len(args), node.line) is not None:
+            return code
+        if hasattr(self, 'fold_%s' % name):
+            return getattr(self, 'fold_%s' % name)(node, args)
+
+        folded = [node]
+        for i, arg in enumerate(args):
+            if signature.kind(i) == 'value':
+                folded.append(self.fold(arg))
+            else:
+                folded.append(arg)
+        if name in Program.pure and all(map(self.is_literal, folded[1:])):
+            try:
+                value = fn(self.evaluator,
+                           *[self.evaluator.eval(arg) for arg in folded[1:]])
+            except Exception:
+                return folded
+            literal = self.literal(value, node.line)
+            if literal is not None:
+                return literal
+        return folded
+
+    def fold_if(self, node, args):
+        cond, yes, no = args
+        cond = self.fold(cond)
+        if self.is_literal(cond):
+            return self.fold(yes if self.evaluator.eval(cond) else no)
+        return [node, cond, self.fold(yes), self.fold(no)]
+
+    def fold_def(self, node, args):
+        name, params, code = args
+        return [node, name, params, self.fold(code)]
+
+    fold_defun = fold_def
+
+    def fold_let(self, node, args):
+        syms, code = args[0], args[1:]
+        if type(syms) == list:
+            syms = [[sym[0], self.fold(sym[1])]
+                    if type(sym) == list and len(sym) == 2 else sym
+                    for sym in syms]
+        return [node, syms] + [self.fold(expr) for expr in code]
+
+    def fold_with(self, node, args):
+        iterable, iterator, code = args
+        return [node, iterable, iterator, self.fold(code)]
+
+class Program(object):
+    """
+    A compiled policy together with the global environment it starts from.
+    Top-level function definitions and defvars of constants are run once,
+    when the Program is built, and their results are stored in that
+    environment.  Each evaluation works on its own copy of it, so every run
+    still starts from a clean stack without redoing that work.
+    """
+    # Builtins whose result only depends on their arguments
+    pure = ('add', 'sub', 'mul', 'div', 'lt', 'gt', 'lte', 'gte', 'eq',
+            'neq', 'shl', 'shr', 'and', 'or', 'not', 'min', 'max', 'null',
+            'valid')
+
+    def __init__(self, e, code, preset=(), vectorize=False, profile=False,
+                 origins=None):
+        """
+        Compile code for Evaluators like e.  preset lists the names the
+        caller sets on the stack before every run, like Host and Guests.
+        vectorize enables the NumPy evaluation of with loops and profile
+        adds the timing wrappers used by the profiler.  origins optionally
+        names the policy every expression of code comes from.
+        """
+        self.evaluator_class = type(e)
+        code = optimize(e, code, preset)
+        compiler = Compiler(e, vectorize, profile, tuple(preset))
+        self.code = compiler.compile(code, origins)
+        self.variables = dict(e.get_externs())
+        self.funcs = {}
+        self.preload(compiler, code, set(preset))
+        if profile:
+            for i, expr in enumerate(code):
+                origin = origins[i] if origins is not None else None
+                text = None
+                if isinstance(expr, list) and len(expr) > 0 and \
+                        isinstance(expr[0], Token):
+                    text = "(%s" % expr[0].value
+                self.code[i] = _timed(('expression',
+                                       _label(origin, _line(expr), text)),
+                                      self.code[i])
+
+    def evaluator(self):
+        """
+        Return a new Evaluator holding a copy of the global environment.
+        """
+        return self.evaluator_class(self.variables, self.funcs)
+
+    def run(self, e):
+        return [expr(e) for expr in self.code]
+
+    def preload(self, compiler, code, preset):
+        """
+        Run the top-level definitions that give the same result whenever
+        they are run and store the result in the global environment.  A
+        definition is only moved when nothing before it mentions the name
+        it defines, so earlier code cannot tell the difference.
+        """
+        functions = _definitions(code, ('def', 'defun'), [])
+        seen = set(preset) | set(self.variables)
+        for i, expr in enumerate(code):
+            form = self.definition(compiler, expr)
+            if form is not None and expr[1].value not in seen:
+                name = expr[1].value
+                if form == 'defvar':
+                    try:
+                        value = self.constant(compiler, expr[2])
+                    except Exception:
+                        value = None
+                    if value is not None:
+                        self.variables[name] = value
+                        self.code[i] = _constant(value)
+                elif functions.count(name) == 1 and \
+                        isinstance(expr[2], list):
+                    self.funcs[name] = (expr[2], expr[3])
+                    self.code[i] = _constant(name)
+            _symbols(expr, seen)
+
+    def definition(self, compiler, expr):
+        """
+        Return 'def' or 'defvar' when expr is a well formed top-level
+        definition of that kind, otherwise None.
+        """
+        if not isinstance(expr, list) or len(expr) < 3 or \
+                not isinstance(expr[0], Token) or \
+                not isinstance(expr[1], Token) or expr[1].kind != 'symbol':
+            return None
+        form = expr[0].value
+        if expr[0].kind != 'symbol' or form in compiler.bound:
+            return None
+        if form in ('def', 'defun') and len(expr) == 4:
+            return 'def'
+        elif form == 'defvar' and len(expr) == 3:
+            return 'defvar'
+        return None
+
+    def constant(self, compiler, code):
+        """
+        Evaluate code if it is made of literals and pure builtins only.
+        Return: The value of code or None if it is not constant
+        """
+        if not self.is_constant(compiler, code):
+            return None
+        return compiler.compile_expr(code)(self.evaluator_class())
+
+    def is_constant(self, compiler, code):
+        if isinstance(code, Token):
+            return code.kind in ('number', 'string') or \
+                (code.kind == 'symbol' and code.value == 'nil')
+        if len(code) == 0 or not isinstance(code[0], Token):
+            return False
+        node = code[0]
+        if node.kind == 'operator':
+            name = compiler.evaluator.operator_map[node.value]
+        elif node.kind == 'symbol':
+            name = node.value
+        else:
+            return False
+        if name not in self.pure or name in compiler.bound:
+            return False
+        return all(self.is_constant(compiler, arg) for arg in code[1:])
+
+def compile_code(e, code, vectorize=False):
+    """
+    Compile code returned by get_code for evaluation with an Evaluator like e.
+    Return: A list of compiled top-level expressions
+    """
+    return Compiler(e, vectorize).compile(code)
+
+def optimize(e, code, preset=()):
+    """
+    Fold the constants of code returned by get_code, see Optimizer.
+    Return: An optimized copy of code
+    """
+    return Optimizer(e, preset).optimize(code)
+
 def get_code(e, string):
-    try:
-        scanner = Scanner(e.get_operators())
-        tokens = scanner.tokenize(string)
-        parser = Parser(start='value_list')
-        return parser.parse(tokens)
-    except SystemExit:
-        raise PolicyError("parse error")
+    return Reader(e.get_operators()).read(string)
 
 def eval(e, string):
+    code = compile_code(e, get_code(e, string))
+    results = []
+    for expr in code:
+        results.append(expr(e))
+    return results
+
+def interpret(e, string):
+    """
+    Evaluate string by walking its parsed code with Evaluator.eval.
+    """
     code = get_code(e, string)
     results = []
     for expr in code:
@@ -16,15 +16,44 @@
 
 import logging
 import threading
+from .Cache import PolicyCache
 from .Parser import Evaluator
 from .Parser import get_code
 from .Parser import PolicyError
+from .Parser import Program
+from .Profile import Profile
+from . import Vector
 
 DEFAULT_POLICY_NAME = "50_main_"
 
 class Policy:
-    def __init__(self):
+    """
+    The Policy holds the named policies and the compiled program built from
+    them.  Every named policy is parsed on its own and its code is cached,
+    so changing one policy only parses that policy.  The program is then
+    assembled from the cached pieces, compiled and published by replacing
+    self.program in a single assignment.  Evaluation only reads that
+    reference and never waits for policy updates.
+
+    When a cache directory is given, parsed policies are also kept there so
+    unchanged policies are not parsed again after a restart.
+    """
+    def __init__(self, vectorize=False, profile=False, cache_dir=None):
         self.logger = logging.getLogger('mom.Policy')
+        self.cache = None
+        if cache_dir:
+            try:
+                self.cache = PolicyCache(cache_dir)
+            except (OSError, IOError) as e:
+                self.logger.warning("Policy cache disabled: %s", e)
+        # Timings of the policy evaluations when profiling is enabled
+        self.profile = Profile() if profile else None
+        self.vectorize = vectorize
+        if vectorize and not Vector.available():
+            self.logger.warning("NumPy is not available, policy-vectorize"
+                                " is ignored")
+            self.vectorize = False
+        # Serializes policy updates, evaluation does not take it
         self.policy_sem = threading.Semaphore()
         self.clear_policy()
 
@@ -47,53 +76,136 @@ class Policy:
         keys = sorted(self.policy_strings.keys())
         return '\n'.join(self.policy_strings[k] for k in keys) or '0'
 
-    def set_policy(self, name, policyStr):
+    def _publish(self):
+        """
+        Assemble the cached code of all policies in name order, compile it
+        and make it the active program.
+        """
+        code = []
+        origins = []
+        for name in sorted(self.policy_code.keys()):
+            code.extend(self.policy_code[name])
+            origins.extend([name] * len(self.policy_code[name]))
+        self.program = Program(Evaluator(), code, ('Host', 'Guests'),
+                               self.vectorize, self.profile is not None,
+                               origins)
+
+    def _parse(self, policyStr):
+        if self.cache is not None:
+            code = self.cache.load(policyStr)
+            if code is not None:
+                return code
+        code = get_code(Evaluator(), policyStr)
+        if self.cache is not None:
+            self.cache.store(policyStr, code)
+        return code
+
+    def _update(self, name, policyStr):
+        """
+        Replace, add or delete (when policyStr is None) one named policy
+        without publishing it.
+        """
         if name is None:
             name = DEFAULT_POLICY_NAME
+        if policyStr is None:
+            if name in self.policy_strings:
+                del self.policy_strings[name]
+                del self.policy_code[name]
+                self.logger.info("Deleted policy '%s'", name)
+            return True
+        try:
+            code = self._parse(policyStr)
+        except PolicyError as e:
+            self.logger.warning("Unable to load policy: %s" % e)
+            return False
+        self.policy_strings[name] = policyStr
+        self.policy_code[name] = code
+        if policyStr:
+            self.logger.info("Loaded policy '%s'", name)
+        return True
+
+    def set_policy(self, name, policyStr):
         with self.policy_sem:
-            oldStr = self.policy_strings.get(name)
-            if policyStr is None:
-                try:
-                    del self.policy_strings[name]
-                    self.logger.info("Deleted policy '%s'", name)
-                except KeyError:
-                    pass
-            else:
-                self.policy_strings[name] = policyStr
-            try:
-                self.code = get_code(Evaluator(), self._cat_policies())
-            except PolicyError as e:
-                self.logger.warning("Unable to load policy: %s" % e)
-                if oldStr is None:
-                    del self.policy_strings[name]
-                else:
-                    self.policy_strings[name] = oldStr
+            if not self._update(name, policyStr):
                 return False
-            if policyStr:
-                self.logger.info("Loaded policy '%s'", name)
+            self._publish()
             return True
 
+    def set_policies(self, policies, clear=False):
+        """
+        Set several named policies, given as a dict of name to policy, and
+        publish them all at once.  When clear is True the policies replace
+        all existing ones, otherwise they are updated like set_policy does.
+        Policies that fail to load are skipped.
+        Return: True if all policies were loaded
+        """
+        with self.policy_sem:
+            if clear:
+                self.policy_strings = {}
+                self.policy_code = {}
+            ok = True
+            for name in sorted(policies, key=lambda n: (n is not None, n)):
+                ok = self._update(name, policies[name]) and ok
+            self._publish()
+            return ok
+
     def clear_policy(self):
         with self.policy_sem:
             self.policy_strings = {}
-            self.code = []
+            self.policy_code = {}
+            self.program = Program(Evaluator(), [])
+
+    def set_profiling(self, enabled):
+        """
+        Start or stop profiling the policy evaluation.  Starting keeps the
+        timings recorded so far, use reset_profile to clear them.
+        """
+        with self.policy_sem:
+            if enabled and self.profile is None:
+                self.profile = Profile()
+            elif not enabled:
+                self.profile = None
+            self._publish()
+            self.logger.info("Policy profiling %s",
+                             "enabled" if enabled else "disabled")
+            return True
+
+    def get_profile(self):
+        profile = self.profile
+        if profile is None:
+            return {'enabled': False}
+        report = profile.report()
+        report['enabled'] = True
+        return report
+
+    def reset_profile(self):
+        profile = self.profile
+        if profile is not None:
+            profile.reset()
+        return True
 
     def evaluate(self, host, guest_list):
-        results = []
+        # Take the current program once, updates publish a new one
+        program = self.program
+        profile = self.profile
+
         # each run needs separate evaluator so the stack is clean
-        evaluator = Evaluator()
+        evaluator = program.evaluator()
         evaluator.stack.set('Host', host, alloc=True)
         evaluator.stack.set('Guests', guest_list, alloc=True)
+        if profile is not None:
+            evaluator.profile = profile.start()
 
-        with self.policy_sem:
-            try:
-                for expr in self.code:
-                    results.append(evaluator.eval(expr))
-                self.logger.debug("Results: %s" % results)
-            except PolicyError as e:
-                self.logger.error("Policy error: %s" % e)
-                return False
-            except Exception as e:
-                self.logger.error("Unexpected error when evaluating policy: %s" % e)
-                return False
+        try:
+            results = program.run(evaluator)
+            self.logger.debug("Results: %s" % results)
+        except PolicyError as e:
+            self.logger.error("Policy error: %s" % e)
+            return False
+        except Exception as e:
+            self.logger.error("Unexpected error when evaluating policy: %s" % e)
+            return False
+        finally:
+            if profile is not None:
+                profile.add(evaluator.profile)
         return True
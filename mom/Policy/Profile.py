@@ -0,0 +1,145 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+
+class ProfileRun(object):
+    """
+    The timings of a single policy evaluation.  Only the thread evaluating
+    the policy uses it, so it needs no locking.
+    """
+    def __init__(self):
+        # (kind, name) -> [calls, total time, self time]
+        self.stats = {}
+        # name -> [runs, guests, total time]
+        self.loops = {}
+        # (loop name, guest name) -> [runs, total time]
+        self.guests = {}
+        # Time spent in the callees of every active call
+        self.children = []
+
+    def call(self, key, fn, *args):
+        """
+        Call fn with args and account the time it took to key.
+        """
+        self.children.append(0.0)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self.children.pop()
+            if self.children:
+                self.children[-1] += elapsed
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += elapsed - children
+
+    def loop(self, name, guests, elapsed):
+        entry = self.loops.get(name)
+        if entry is None:
+            entry = self.loops[name] = [0, 0, 0.0]
+        entry[0] += 1
+        entry[1] += guests
+        entry[2] += elapsed
+
+    def guest(self, name, guest, elapsed):
+        entry = self.guests.get((name, guest))
+        if entry is None:
+            entry = self.guests[name, guest] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+
+class Profile(object):
+    """
+    Policy evaluation timings aggregated across ticks.  Every evaluation
+    records into its own ProfileRun which is then added here, report() and
+    reset() may be called from any thread.
+
+    Timings are kept for user functions, builtins (including the special
+    forms like if and let), Python callables called from the policy (like
+    guest.StatAvg), top-level expressions and with loops, along with the
+    time each guest took in the loops that are not vectorized.  Self time
+    excludes the time spent in other profiled calls.
+    """
+    kinds = {'function': 'functions', 'builtin': 'builtins',
+             'call': 'calls', 'expression': 'expressions'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.ticks = 0
+            self.stats = {}
+            self.loops = {}
+            self.guests = {}
+
+    def start(self):
+        return ProfileRun()
+
+    def add(self, run):
+        with self.lock:
+            self.ticks += 1
+            for key, (calls, total, own) in run.stats.items():
+                entry = self.stats.get(key)
+                if entry is None:
+                    entry = self.stats[key] = [0, 0.0, 0.0]
+                entry[0] += calls
+                entry[1] += total
+                entry[2] += own
+            for name, (runs, guests, total) in run.loops.items():
+                entry = self.loops.get(name)
+                if entry is None:
+                    entry = self.loops[name] = [0, 0, 0.0]
+                entry[0] += runs
+                entry[1] += guests
+                entry[2] += total
+            for key, (runs, total) in run.guests.items():
+                entry = self.guests.get(key)
+                if entry is None:
+                    entry = self.guests[key] = [0, 0.0]
+                entry[0] += runs
+                entry[1] += total
+
+    def report(self):
+        """
+        Return the timings in a form that can be sent over XML-RPC.  Times
+        are in seconds.
+        """
+        report = dict((kind, {}) for kind in self.kinds.values())
+        report['loops'] = {}
+        with self.lock:
+            report['ticks'] = self.ticks
+            for (kind, name), (calls, total, own) in self.stats.items():
+                report[self.kinds[kind]][name] = {'calls': calls,
+                                                  'total': total,
+                                                  'self': own}
+            for name, (runs, guests, total) in self.loops.items():
+                report['loops'][name] = {
+                    'runs': runs,
+                    'guests': guests,
+                    'total': total,
+                    'per_guest': total / guests if guests else 0.0,
+                    'by_guest': {}}
+            for (name, guest), (runs, total) in self.guests.items():
+                report['loops'][name]['by_guest'][guest] = {'runs': runs,
+                                                            'total': total}
+        return report
@@ -0,0 +1,603 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Evaluate the body of a (with Guests guest ...) loop once for all guests.
+
+Every value is either a plain Python value, the same for all guests, or a
+NumPy array holding one value per guest.  Numeric data uses native arrays;
+anything else (strings, mixed int and float values, integers that could
+overflow) falls back to object arrays, where NumPy applies the Python
+operators to each element, so results match the scalar evaluator.  Both
+sides of an if are evaluated with a mask of the guests that take them.
+guest.Control calls are recorded and only made, guest by guest, once the
+whole body was evaluated.
+
+Anything the vector evaluator does not handle raises Unsupported and the
+caller runs the loop on the scalar path instead.
+"""
+
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .Parser import ExternalFunctions
+from .Parser import PolicyError
+from .Parser import Token
+
+# Below this many guests the scalar loop is faster
+MIN_ITEMS = 32
+
+# Largest integer magnitude kept in an int64 array
+INT_LIMIT = 2**62
+
+# Entity methods that only read data and can be called once per guest
+PURE_METHODS = ('Prop', 'Stat', 'StatAvg', 'StatMin', 'StatMax', 'StatEwma',
+                'StatDelta', 'StatRate')
+
+ARITHMETIC = {'add': 'add', 'sub': 'subtract', 'mul': 'multiply',
+              'div': 'true_divide', 'shl': 'left_shift',
+              'shr': 'right_shift'}
+COMPARISON = {'lt': 'less', 'gt': 'greater', 'lte': 'less_equal',
+              'gte': 'greater_equal', 'eq': 'equal', 'neq': 'not_equal'}
+
+def available():
+    return numpy is not None
+
+class Unsupported(Exception):
+    pass
+
+class Guests(object):
+    """
+    The value of the loop variable: all guests at once.  Attributes and
+    method results are turned into arrays the first time they are used.
+    """
+    def __init__(self, items):
+        self.items = items
+        self.columns = {}
+
+    def attribute(self, attr):
+        key = (attr,)
+        if key not in self.columns:
+            values = []
+            for item in self.items:
+                if not hasattr(item, attr):
+                    # The scalar path would look in the outer scopes
+                    raise Unsupported("guest without attribute %s" % attr)
+                values.append(getattr(item, attr))
+            self.columns[key] = _array(values)
+        return self.columns[key]
+
+    def call(self, method, args):
+        key = (method,) + tuple(args)
+        if key not in self.columns:
+            self.columns[key] = _array([getattr(item, method)(*args)
+                                        for item in self.items])
+        return self.columns[key]
+
+class Method(object):
+    """
+    A method of the guests, like guest.StatAvg, used as a call head.
+    """
+    def __init__(self, guests, name):
+        self.guests = guests
+        self.name = name
+
+class Control(object):
+    """
+    A recorded guest.Control call.  returns is filled in when the calls are
+    made.
+    """
+    def __init__(self, name, values, mask):
+        self.name = name
+        self.values = values
+        self.mask = mask
+        self.returns = {}
+
+class Choice(object):
+    """
+    The value of an if whose branches are not plain data.
+    """
+    def __init__(self, cond, yes, no):
+        self.cond = cond
+        self.yes = yes
+        self.no = no
+
+class Frame(object):
+    """
+    A scope of the vector evaluator.  Every variable maps to its value and
+    the mask of guests it is defined for, None meaning all of them.
+    """
+    __slots__ = ('vars', 'parent')
+
+    def __init__(self, parent=None):
+        self.vars = {}
+        self.parent = parent
+
+def _is_data(value):
+    return not isinstance(value, (Guests, Method, Control, Choice))
+
+def _array(values):
+    """
+    Turn a list of per-guest values into the best suited array.
+    """
+    types = set(type(v) for v in values)
+    if types == set([int]):
+        if max(values) < INT_LIMIT and min(values) > -INT_LIMIT:
+            return numpy.array(values, dtype=numpy.int64)
+    elif types == set([float]):
+        return numpy.array(values, dtype=numpy.float64)
+    elif types == set([bool]):
+        return numpy.array(values, dtype=numpy.bool_)
+    array = numpy.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+def _native(value):
+    """
+    Check if value can take part in native NumPy arithmetic.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.dtype.kind in 'bif'
+    if type(value) == int:
+        return -INT_LIMIT < value < INT_LIMIT
+    return type(value) in (float, bool)
+
+def _kind(value):
+    if isinstance(value, numpy.ndarray):
+        return value.dtype.kind
+    return {bool: 'b', int: 'i', float: 'f'}.get(type(value), 'O')
+
+def _magnitude(value):
+    if isinstance(value, numpy.ndarray):
+        return int(numpy.abs(value).max()) if len(value) else 0
+    return abs(int(value))
+
+def _numeric(value):
+    """
+    Python does arithmetic on bools as ints, NumPy does not.
+    """
+    if isinstance(value, numpy.ndarray) and value.dtype.kind == 'b':
+        return value.astype(numpy.int64)
+    if type(value) == bool:
+        return int(value)
+    return value
+
+class VectorEvaluator(object):
+    """
+    Run the body of a with loop over all guests at once.  e is the scalar
+    Evaluator running the policy, it provides the builtins, the user
+    functions and the variables outside of the loop.
+    """
+    max_depth = 32
+
+    def __init__(self, e, items):
+        self.evaluator = e
+        self.outer = e.stack.top
+        self.count = len(items)
+        self.guests = Guests(items)
+        self.actions = []
+        self.depth = 0
+
+    def evaluate(self, iterator, code):
+        """
+        Evaluate code with iterator bound to all guests.  No guest.Control
+        call is made yet.
+        Return: The value of code
+        """
+        frame = Frame()
+        frame.vars[iterator] = [self.guests, None]
+        mask = numpy.ones(self.count, dtype=numpy.bool_)
+        with numpy.errstate(divide='raise', over='raise', invalid='raise',
+                            under='ignore'):
+            return self.eval(code, frame, mask)
+
+    def apply(self, value):
+        """
+        Make the recorded guest.Control calls in the order the scalar loop
+        would make them.
+        Return: The list of per-guest results, like the scalar with loop
+        """
+        items = self.guests.items
+        for i, item in enumerate(items):
+            for action in self.actions:
+                if action.mask[i]:
+                    action.returns[i] = item.Control(action.name,
+                                                     action.values[i])
+
+        if isinstance(value, numpy.ndarray):
+            return value.tolist()
+        elif _is_data(value):
+            return [value] * self.count
+        lists = {}
+        return [self.resolve(value, i, lists) for i in range(self.count)]
+
+    def resolve(self, value, i, lists):
+        while isinstance(value, Choice):
+            value = value.yes if value.cond[i] else value.no
+        if isinstance(value, Control):
+            return value.returns[i]
+        elif isinstance(value, Guests):
+            return value.items[i]
+        elif isinstance(value, numpy.ndarray):
+            if id(value) not in lists:
+                lists[id(value)] = value.tolist()
+            return lists[id(value)][i]
+        return value
+
+    def broadcast(self, value):
+        if isinstance(value, numpy.ndarray):
+            return value.tolist()
+        return [value] * self.count
+
+    def truth(self, value):
+        if isinstance(value, numpy.ndarray):
+            if value.dtype.kind == 'b':
+                return value
+            elif value.dtype.kind in 'if':
+                return value != 0
+            return numpy.array([bool(v) for v in value.tolist()],
+                               dtype=numpy.bool_)
+        elif not _is_data(value):
+            raise Unsupported("condition is not plain data")
+        return bool(value)
+
+    def each(self, fn, args):
+        """
+        Apply the scalar function fn to the values of every guest.
+        """
+        columns = [self.broadcast(arg) for arg in args]
+        return _array([fn(*values) for values in zip(*columns)])
+
+    def where(self, cond, yes, no):
+        if not _is_data(yes) or not _is_data(no):
+            return Choice(cond, yes, no)
+        if _kind(yes) == _kind(no) and _kind(yes) in 'bif':
+            return numpy.where(cond, yes, no)
+        return self.each(lambda c, y, n: y if c else n, (cond, yes, no))
+
+    def eval(self, code, frame, mask):
+        e = self.evaluator
+        if isinstance(code, Token):
+            if code.kind == 'number':
+                return e.eval_number(code)
+            elif code.kind == 'string':
+                return code.value[1:-1]
+            elif code.kind == 'symbol':
+                if code.value == "nil":
+                    return None
+                value = self.lookup(code.value, frame, mask, code.line)
+                if isinstance(value, Method):
+                    raise Unsupported("guest method used as a value")
+                return value
+            raise Unsupported("token type %s" % code.kind)
+
+        if len(code) == 0 or not isinstance(code[0], Token):
+            raise Unsupported("malformed expression")
+        node, args = code[0], code[1:]
+        if node.kind == 'symbol':
+            name = node.value
+        elif node.kind == 'operator':
+            name = e.operator_map[node.value]
+        else:
+            raise Unsupported("token type %s" % node.kind)
+
+        func = self.find(name, frame, mask, node.line)
+        if func is not None:
+            return self.call_value(name, func, args, frame, mask)
+        elif hasattr(self, 'form_%s' % name):
+            return getattr(self, 'form_%s' % name)(args, frame, mask)
+        elif name in ARITHMETIC or name in COMPARISON or \
+                hasattr(self, 'op_%s' % name):
+            values = [self.eval(arg, frame, mask) for arg in args]
+            signature = e.get_signature('c_%s' % name)
+            error = signature.check_arity(len(values), node.line)
+            if error is not None:
+                raise error
+            return self.builtin(name, values)
+        elif hasattr(e, 'c_%s' % name):
+            raise Unsupported("builtin %s" % name)
+        return self.call_function(name, args, frame, mask, node.line)
+
+    def find(self, name, frame, mask, line):
+        """
+        Look up the callable a call head refers to, if it is a variable.
+        """
+        if '.' not in name and not self.bound(name, frame, mask):
+            return self.evaluator.stack.lookup(self.outer, name, None, name,
+                                               True, line)
+        return self.lookup(name, frame, mask, line, True)
+
+    def bound(self, name, frame, mask):
+        while frame is not None:
+            if self.defined(frame, name, mask):
+                return True
+            frame = frame.parent
+        return False
+
+    def defined(self, frame, name, mask):
+        if name not in frame.vars:
+            return False
+        defined = frame.vars[name][1]
+        if defined is None:
+            return True
+        lanes = defined[mask]
+        if lanes.all():
+            return True
+        elif lanes.any():
+            raise Unsupported("%s is only defined for some guests" % name)
+        return False
+
+    def lookup(self, name, frame, mask, line, allow_undefined=False):
+        parts = name.split('.')
+        obj = parts[0]
+        attr = parts[1] if len(parts) > 1 else None
+        while frame is not None:
+            if self.defined(frame, obj, mask):
+                value = frame.vars[obj][0]
+                if attr is None:
+                    return value
+                elif isinstance(value, Guests):
+                    if attr in PURE_METHODS or attr == 'Control':
+                        return Method(value, attr)
+                    return value.attribute(attr)
+                elif isinstance(value, numpy.ndarray) or \
+                        not _is_data(value):
+                    raise Unsupported("attribute of a per-guest value")
+                elif hasattr(value, attr):
+                    return getattr(value, attr)
+            frame = frame.parent
+        return self.evaluator.stack.lookup(self.outer, obj, attr, name,
+                                           allow_undefined, line)
+
+    def call_value(self, name, func, args, frame, mask):
+        """
+        Call something found on the stack: a guest method or one of the
+        ExternalFunctions.  Other callables may have side effects and are
+        left to the scalar path.
+        """
+        if isinstance(func, Method):
+            guests, method = func.guests, func.name
+            values = [self.eval(arg, frame, mask) for arg in args]
+            if method == 'Control':
+                if len(values) != 2 or isinstance(values[0], numpy.ndarray) \
+                        or not _is_data(values[1]):
+                    raise Unsupported("guest.Control arguments")
+                action = Control(values[0], self.broadcast(values[1]),
+                                 mask.copy())
+                self.actions.append(action)
+                return action
+            if not all(_is_data(v) and not isinstance(v, numpy.ndarray)
+                       for v in values):
+                raise Unsupported("per-guest arguments to %s" % method)
+            return guests.call(method, values)
+
+        if func is ExternalFunctions.abs:
+            values = [self.eval(arg, frame, mask) for arg in args]
+            if len(values) != 1:
+                raise Unsupported("abs arguments")
+            value = values[0]
+            if not isinstance(value, numpy.ndarray):
+                return func(value)
+            elif value.dtype.kind in 'if':
+                return numpy.abs(value)
+            return self.each(func, values)
+
+        # The method of an Entity outside of the loop, like Host.StatAvg
+        if getattr(func, '__name__', None) in PURE_METHODS:
+            values = [self.eval(arg, frame, mask) for arg in args]
+            if not all(_is_data(v) and not isinstance(v, numpy.ndarray)
+                       for v in values):
+                raise Unsupported("per-guest arguments to %s" % name)
+            return func(*values)
+        raise Unsupported("call to %s" % name)
+
+    def call_function(self, name, args, frame, mask, line):
+        """
+        Inline a user function.  Like the scalar evaluator, the arguments
+        are evaluated in the new frame as the parameters are bound.
+        """
+        params, code = self.evaluator.funcs[name]
+        if len(params) != len(args):
+            raise PolicyError('Function "%s" invoked with incorrect arity'
+                              ' on line %d' % (name, line))
+        if self.depth >= self.max_depth:
+            raise Unsupported("recursion in %s" % name)
+
+        inner = Frame(frame)
+        for param, arg in zip(params, args):
+            if not isinstance(param, Token) or param.kind != 'symbol':
+                raise Unsupported("malformed parameters of %s" % name)
+            value = self.eval(arg, inner, mask)
+            if param.value not in inner.vars:
+                inner.vars[param.value] = [value, None]
+        self.depth += 1
+        try:
+            return self.eval(code, inner, mask)
+        finally:
+            self.depth -= 1
+
+    def builtin(self, name, values):
+        if all(_is_data(v) and not isinstance(v, numpy.ndarray)
+               for v in values):
+            # Nothing differs between guests, this is scalar code
+            return getattr(self.evaluator, 'c_%s' % name)(*values)
+        if not all(_is_data(v) for v in values):
+            raise Unsupported("%s of a guest or a control" % name)
+
+        fn = getattr(self.evaluator, 'c_%s' % name)
+        if not all(_native(v) for v in values):
+            return self.each(fn, values)
+        if name in ARITHMETIC:
+            x, y = [_numeric(v) for v in values]
+            if not self.fits(name, x, y):
+                return self.each(fn, values)
+            return getattr(numpy, ARITHMETIC[name])(x, y)
+        elif name in COMPARISON:
+            return getattr(numpy, COMPARISON[name])(*values)
+        return getattr(self, 'op_%s' % name)(fn, values)
+
+    def fits(self, name, x, y):
+        """
+        Check that an integer operation cannot overflow int64.
+        """
+        if _kind(x) != 'i' or _kind(y) != 'i':
+            return True
+        if name in ('add', 'sub'):
+            return max(_magnitude(x), _magnitude(y)) < INT_LIMIT
+        elif name == 'mul':
+            return _magnitude(x) * _magnitude(y) < INT_LIMIT
+        elif name == 'shl':
+            return _magnitude(y) < 62 and \
+                _magnitude(x) << _magnitude(y) < INT_LIMIT
+        return True
+
+    def op_and(self, fn, values):
+        if len(set(_kind(v) for v in values)) != 1:
+            return self.each(fn, values)
+        result = values[-1]
+        for value in reversed(values[:-1]):
+            result = numpy.where(self.truth(value), result, value)
+        return result
+
+    def op_or(self, fn, values):
+        if len(set(_kind(v) for v in values)) != 1:
+            return self.each(fn, values)
+        result = values[-1]
+        for value in reversed(values[:-1]):
+            result = numpy.where(self.truth(value), value, result)
+        return result
+
+    def op_not(self, fn, values):
+        return numpy.logical_not(self.truth(values[0]))
+
+    def op_min(self, fn, values):
+        return self.extreme(fn, numpy.minimum, values)
+
+    def op_max(self, fn, values):
+        return self.extreme(fn, numpy.maximum, values)
+
+    def extreme(self, fn, ufunc, values):
+        # Python min and max return the first of equal values, so the
+        # result type can only be predicted when the types agree.  NaN
+        # makes the outcome depend on the order of the arguments.
+        if len(set(_kind(v) for v in values)) != 1 or \
+                any(_kind(v) == 'f' and numpy.isnan(v).any() for v in values):
+            return self.each(fn, values)
+        return ufunc.reduce(numpy.broadcast_arrays(*values))
+
+    def form_eval(self, args, frame, mask):
+        if len(args) == 0:
+            raise Unsupported("empty block")
+        for arg in args:
+            result = self.eval(arg, frame, mask)
+        return result
+
+    def form_if(self, args, frame, mask):
+        if len(args) != 3:
+            raise Unsupported("if arguments")
+        cond = self.truth(self.eval(args[0], frame, mask))
+        if not isinstance(cond, numpy.ndarray):
+            return self.eval(args[1] if cond else args[2], frame, mask)
+
+        yes_mask = mask & cond
+        no_mask = mask & ~cond
+        if not no_mask.any():
+            return self.eval(args[1], frame, mask)
+        elif not yes_mask.any():
+            return self.eval(args[2], frame, mask)
+        yes = self.eval(args[1], frame, yes_mask)
+        no = self.eval(args[2], frame, no_mask)
+        return self.where(cond, yes, no)
+
+    def form_defvar(self, args, frame, mask):
+        if len(args) != 2 or not isinstance(args[0], Token) or \
+                args[0].kind != 'symbol':
+            raise Unsupported("defvar arguments")
+        name = args[0].value
+        value = self.eval(args[1], frame, mask)
+        if not _is_data(value):
+            raise Unsupported("defvar of a guest or a control")
+
+        if name not in frame.vars:
+            frame.vars[name] = [value, None if mask.all() else mask.copy()]
+            return value
+        entry = frame.vars[name]
+        defined = entry[1]
+        if defined is None:
+            return entry[0]
+        entry[0] = self.where(mask & ~defined, value, entry[0])
+        entry[1] = defined | mask
+        if entry[1].all():
+            entry[1] = None
+        return entry[0]
+
+    def form_set(self, args, frame, mask):
+        if len(args) != 2 or not isinstance(args[0], Token) or \
+                args[0].kind != 'symbol':
+            raise Unsupported("set arguments")
+        name = args[0].value
+        value = self.eval(args[1], frame, mask)
+        if not _is_data(value):
+            raise Unsupported("set of a guest or a control")
+        while frame is not None:
+            if self.defined(frame, name, mask):
+                entry = frame.vars[name]
+                if mask.all():
+                    entry[0] = value
+                else:
+                    entry[0] = self.where(mask, value, entry[0])
+                return value
+            frame = frame.parent
+        # Changing variables outside of the loop is left to the scalar path
+        raise Unsupported("set of %s outside of the loop" % name)
+
+    form_setq = form_set
+
+    def form_let(self, args, frame, mask):
+        if len(args) < 2 or type(args[0]) != list:
+            raise Unsupported("let arguments")
+        inner = Frame(frame)
+        for sym in args[0]:
+            if type(sym) != list or len(sym) != 2 or \
+                    not isinstance(sym[0], Token) or sym[0].kind != 'symbol':
+                raise Unsupported("let bindings")
+            value = self.eval(sym[1], inner, mask)
+            if sym[0].value not in inner.vars:
+                inner.vars[sym[0].value] = [value, None]
+        for expr in args[1:]:
+            result = self.eval(expr, inner, mask)
+        return result
+
+def run(e, items, iterator, code):
+    """
+    Evaluate the body of a with loop over items with the vector evaluator.
+    Return: The per-item results or None if the scalar path must be used
+    """
+    if numpy is None or len(items) < MIN_ITEMS:
+        return None
+    evaluator = VectorEvaluator(e, items)
+    try:
+        value = evaluator.evaluate(iterator, code)
+    except Exception as error:
+        # Errors are reported by the scalar path, exactly as before
+        logging.getLogger('mom.Policy.Vector').debug(
+            "Using the scalar path: %s", error)
+        return None
+    return evaluator.apply(value)
@@ -38,23 +38,33 @@ class PolicyEngine(threading.Thread):
             'guest_manager': guest_manager,
         }
 
-        self.policy = Policy()
+        self.policy = Policy(config.getboolean('main', 'policy-vectorize'),
+                             config.getboolean('main', 'policy-profile'),
+                             config.get('main', 'policy-cache-dir'))
         self.load_policy()
         self.start()
 
-    def load_policy(self):
-        def read_policy(file_name, policy_name):
+    def load_policy(self, clear=False):
+        """
+        Load the configured policy files.  All of them are published at
+        once, when clear is True they replace the current policies.
+        """
+        def read_policy(file_name):
             try:
                 with open(file_name, 'r') as f:
-                    policyStr = f.read()
+                    return f.read()
             except IOError as e:
                 self.logger.warning("Unable to read policy file: %s" % e)
-                return False
-            return self.policy.set_policy(policy_name, policyStr)
+                return None
 
         fname = self.config.get('main', 'policy')
         if fname:
-            return read_policy(fname, None)
+            policyStr = read_policy(fname)
+            if policyStr is None:
+                if clear:
+                    self.policy.clear_policy()
+                return False
+            return self.policy.set_policies({None: policyStr}, clear)
 
         policy_dir = self.config.get('main', 'policy-dir')
         if policy_dir:
@@ -63,17 +73,24 @@ class PolicyEngine(threading.Thread):
             except OSError as e:
                 self.logger.warning("Unable to read directory '%s': %s" % (
                                     policy_dir, e.strerror))
+                if clear:
+                    self.policy.clear_policy()
                 return False
+            policies = {}
             for name in names:
                 if name.startswith('.') or not name.endswith('.policy'):
                     continue
-                fname = os.path.join(policy_dir, name)
-                read_policy(fname, name.split('.policy')[0])
+                policyStr = read_policy(os.path.join(policy_dir, name))
+                if policyStr is not None:
+                    policies[name.split('.policy')[0]] = policyStr
+            self.policy.set_policies(policies, clear)
             return True
 
+        if clear:
+            self.policy.clear_policy()
+
     def rpc_reset_policy(self):
-        self.policy.clear_policy()
-        return self.load_policy()
+        return self.load_policy(clear=True)
 
     def rpc_get_policy(self):
         return self.policy.get_string()
@@ -88,6 +105,15 @@ class PolicyEngine(threading.Thread):
     def rpc_set_named_policy(self, name, policyStr):
         return self.policy.set_policy(name, policyStr)
 
+    def rpc_get_policy_profile(self):
+        return self.policy.get_profile()
+
+    def rpc_reset_policy_profile(self):
+        return self.policy.reset_profile()
+
+    def rpc_set_policy_profiling(self, enabled):
+        return self.policy.set_profiling(enabled)
+
     def get_controllers(self):
         """
         Initialize the Controllers called for in the config file.
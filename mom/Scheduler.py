@@ -0,0 +1,196 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+# Spreads the phases of successive jobs evenly over the interval
+GOLDEN_RATIO = 0.6180339887498949
+
+class Job(object):
+    __slots__ = ('key', 'fn', 'interval', 'removed')
+
+    def __init__(self, key, fn, interval):
+        self.key = key
+        self.fn = fn
+        self.interval = interval
+        self.removed = False
+
+class Scheduler(object):
+    """
+    Run periodic jobs, like the collections of the GuestMonitors, on a fixed
+    number of worker threads.
+
+    Every job has a deadline, the time it should next start.  A dispatcher
+    thread queues jobs when their deadline is reached and the workers run
+    them in that order.  A job is only scheduled again once its run is over,
+    so the same job never runs twice at a time, and its next deadline keeps
+    the phase of the first one.  Deadlines missed while the job was running
+    are skipped.  New jobs start at different fractions of their interval so
+    the jobs do not all wake up together.
+
+    A job returning False is not run again.
+    """
+    def __init__(self, workers, name='Scheduler'):
+        self.logger = logging.getLogger('mom.Scheduler')
+        self.cond = threading.Condition()
+        self.jobs = {}
+        # (deadline, sequence, job) in deadline order
+        self.heap = []
+        self.sequence = itertools.count()
+        self.added = 0
+        self.queue = queue.Queue()
+        self._stopping = False
+        # Workers running a job
+        self.busy = 0
+        self.reset_stats()
+
+        self.threads = [threading.Thread(target=self._dispatch,
+                                         name='%s-dispatch' % name)]
+        for i in range(max(workers, 1)):
+            self.threads.append(threading.Thread(target=self._work,
+                                                 name='%s-%d' % (name, i)))
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stop dispatching jobs and let the workers end once their current job
+        is over.  Does not wait for them.
+        """
+        with self.cond:
+            self._stopping = True
+            self.cond.notify()
+        for i in range(len(self.threads) - 1):
+            self.queue.put(None)
+
+    def add(self, key, fn, interval):
+        """
+        Run fn every interval seconds, replacing any job of the same key.
+        """
+        job = Job(key, fn, interval)
+        with self.cond:
+            self.remove(key)
+            self.jobs[key] = job
+            phase = (self.added * GOLDEN_RATIO) % 1.0
+            self.added += 1
+            self._push(time.monotonic() + phase * interval, job)
+
+    def remove(self, key):
+        with self.cond:
+            job = self.jobs.pop(key, None)
+            if job is not None:
+                job.removed = True
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def _push(self, deadline, job):
+        heapq.heappush(self.heap, (deadline, next(self.sequence), job))
+        self.cond.notify()
+
+    def _dispatch(self):
+        with self.cond:
+            while not self._stopping:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, seq, job = self.heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                if job.removed:
+                    continue
+                self.queue.put((job, deadline))
+                self.max_queue_depth = max(self.max_queue_depth,
+                                           self.queue.qsize())
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            job, deadline = item
+            start = time.monotonic()
+            with self.cond:
+                self.busy += 1
+                self._account_lateness(start - deadline)
+            try:
+                again = job.fn() is not False
+            except Exception:
+                self.logger.exception("Job %s failed", job.key)
+                again = True
+            with self.cond:
+                self.busy -= 1
+                self.runs += 1
+                if job.removed or self._stopping:
+                    continue
+                if not again:
+                    self.remove(job.key)
+                    continue
+                deadline += job.interval
+                now = time.monotonic()
+                if deadline < now:
+                    missed = int((now - deadline) // job.interval) + 1
+                    self.skipped += missed
+                    deadline += missed * job.interval
+                self._push(deadline, job)
+
+    def _account_lateness(self, lateness):
+        self.started += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.last_lateness = lateness
+
+    def reset_stats(self):
+        with self.cond:
+            self.runs = 0
+            self.skipped = 0
+            self.max_queue_depth = 0
+            self.started = 0
+            self.total_lateness = 0.0
+            self.max_lateness = 0.0
+            self.last_lateness = 0.0
+
+    def stats(self):
+        """
+        Return the scheduler metrics in a form that can be sent over XML-RPC.
+        Lateness is how long after its deadline a job started, in seconds,
+        skipped counts the deadlines missed because a job ran longer than
+        its interval.  Queue depth counts the jobs waiting for a worker.
+        """
+        with self.cond:
+            return {'workers': len(self.threads) - 1,
+                    'busy': self.busy,
+                    'jobs': len(self.jobs),
+                    'runs': self.runs,
+                    'skipped': self.skipped,
+                    'queue_depth': self.queue.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'lateness': {
+                        'last': self.last_lateness,
+                        'max': self.max_lateness,
+                        'mean': self.total_lateness / self.started
+                                if self.started else 0.0}}
@@ -105,12 +105,21 @@ class MOM:
         self.config.set('main', 'policy-engine-interval', '10')
         self.config.set('main', 'sample-history-length', '10')
         self.config.set('main', 'libvirt-hypervisor-uri', '')
+        self.config.set('main', 'libvirt-events', 'true')
         self.config.set('main', 'controllers', 'Balloon')
         self.config.set('main', 'plot-dir', '')
         self.config.set('main', 'rpc-port', '-1')
         self.config.set('main', 'policy', '')
         self.config.set('main', 'policy-dir', '')
         self.config.set('main', 'guest-manager-multi-thread', 'true')
+        self.config.set('main', 'guest-monitor-workers', '0')
+        self.config.set('main', 'guest-manager-asyncio', 'false')
+        self.config.set('main', 'guest-manager-events', 'false')
+        self.config.set('main', 'guest-manager-reconcile-interval', '60')
+        self.config.set('main', 'guest-collector-timeout', '10')
+        self.config.set('main', 'policy-vectorize', 'false')
+        self.config.set('main', 'policy-profile', 'false')
+        self.config.set('main', 'policy-cache-dir', '')
         self.config.add_section('logging')
         self.config.set('logging', 'log', 'stdio')
         self.config.set('logging', 'verbosity', 'info')
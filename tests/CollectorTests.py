@@ -0,0 +1,239 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import asyncio
+import os
+import shutil
+import subprocess
+import threading
+from unittest import mock
+
+import pytest
+from mom.Collectors.Collector import Collector
+from mom.Collectors.Collector import CollectionError
+from mom.Collectors.GuestNetworkDaemon import GuestNetworkDaemon
+from mom.Collectors.HostKSM import HostKSM
+from mom.GuestManager import GuestData
+from mom.GuestManager import GuestManager
+from mom.GuestMonitor import GuestMonitor
+from mom.Monitor import Monitor
+from TestHelpers import Interface
+from TestHelpers import make_config
+
+
+class Sync(Collector):
+    def __init__(self, data, delay=None):
+        self.data = data
+        self.delay = delay
+        self.calls = 0
+
+    def collect(self):
+        self.calls += 1
+        if self.delay is not None:
+            self.delay.wait()
+        return dict(self.data)
+
+    def getFields(self):
+        return set(self.data)
+
+
+class Async(Sync):
+    async def collect_async(self):
+        self.thread = threading.current_thread()
+        return self.collect()
+
+
+def make_monitor(collectors):
+    config = make_config()
+    monitor = Monitor(config, 'test')
+    monitor.config = config
+    monitor.collectors = collectors
+    return monitor
+
+
+def test_collect_async():
+    collectors = [Async({'a': 1}), Sync({'a': 2, 'b': 2})]
+    monitor = make_monitor(collectors)
+    assert asyncio.run(monitor.collect_async()) == {'a': 1, 'b': 2}
+    assert collectors[0].thread is threading.current_thread()
+    assert monitor.collect() == {'a': 1, 'b': 2}
+    assert monitor.interrogate().b == 2
+
+
+def test_collect_async_timeout():
+    delay = threading.Event()
+    slow = Sync({'b': 2}, delay)
+    monitor = make_monitor([Sync({'a': 1}), slow])
+
+    async def collect():
+        assert await monitor.collect_async(0.05) is None
+        # The first call is still running, the next one does not start
+        assert await monitor.collect_async(0.05) is None
+        assert slow.calls == 1
+        delay.set()
+        await asyncio.sleep(0.05)
+        return await monitor.collect_async(0.05)
+
+    with mock.patch.object(monitor, '_disp_collection_error') as errors:
+        assert asyncio.run(collect()) == {'a': 1, 'b': 2}
+    messages = [call[0][0] for call in errors.call_args_list]
+    assert 'timed out after 0.05 seconds' in messages[0]
+    assert "Incomplete data: missing {'b'}" in messages[1]
+    assert 'Sync is still collecting' in messages[2]
+
+
+def test_network_daemon_async():
+    stats = b'mem_available:100,mem_unused:50,major_fault:1,minor_fault:2,' \
+            b'swap_in:3,swap_out:4,other:5\n'
+    requests = []
+
+    async def serve(reader, writer):
+        while True:
+            request = await reader.readline()
+            if not request:
+                break
+            requests.append(request)
+            writer.write(stats)
+            await writer.drain()
+        writer.close()
+
+    async def collect():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        collector = GuestNetworkDaemon({'name': 'test', 'config': {}})
+        collector.ip = '127.0.0.1'
+        collector.port = server.sockets[0].getsockname()[1]
+        try:
+            first = await collector.collect_async()
+            second = await collector.collect_async()
+        finally:
+            collector.writer.close()
+            server.close()
+        return first, second
+
+    first, second = asyncio.run(collect())
+    assert first == second == {'mem_available': 100, 'mem_unused': 50,
+                               'major_fault': 1, 'minor_fault': 2,
+                               'swap_in': 3, 'swap_out': 4}
+    # The connection is kept between collections
+    assert requests == [b'stats\n', b'stats\n']
+
+
+def test_network_daemon_async_errors():
+    collector = GuestNetworkDaemon({'name': 'test', 'config': {}})
+    with pytest.raises(CollectionError):
+        asyncio.run(collector.collect_async())
+    assert collector.state == 'dead'
+    assert asyncio.run(collector.collect_async()) == {}
+
+
+def test_guest_manager_asyncio():
+    config = make_config(guest_manager_asyncio='true')
+    collected = threading.Event()
+
+    class Stop(Sync):
+        def collect(self):
+            config.set('__int__', 'running', '0')
+            collected.set()
+            return Sync.collect(self)
+
+    with mock.patch('mom.Collectors.Collector.get_collectors',
+                    side_effect=lambda *args: [Stop({'x': 1})]):
+        manager = GuestManager(config, Interface(['a', 'b']))
+        manager.run()
+    assert collected.is_set()
+    assert sorted(manager.guests) == ['a', 'b']
+    assert all(guest.thread is None for guest in manager.guests.values())
+
+
+def make_guest_manager(iface, uuids):
+    config = make_config(guest_manager_multi_thread='false')
+    config.set('guest', 'collectors', 'GuestMemoryOptional, GuestBalloon')
+    manager = GuestManager(config, iface)
+    for uuid in uuids:
+        monitor = GuestMonitor(config, {'name': uuid, 'uuid': uuid}, iface)
+        manager._register_guest(uuid, GuestData(monitor, None))
+    return manager
+
+
+def test_collect_many():
+    uuids = ['a', 'bb', 'broken']
+    iface = Interface()
+    manager = make_guest_manager(iface, uuids)
+    manager._collect_from_guest_monitors()
+    assert [call for call in iface.calls if call[0].startswith('getAll')] == \
+           [('getAllVmMemoryStats', tuple(uuids))]
+    # Without a bulk method for it, the balloon info is read guest by guest
+    assert [call for call in iface.calls if call[0] == 'getVmBalloonInfo'] \
+           == [('getVmBalloonInfo', uuid) for uuid in uuids]
+
+    # The same result as collecting each guest on its own
+    bulk = manager.interrogate()
+    single = make_guest_manager(Interface(), uuids)
+    for guest in single.guests.values():
+        guest.monitor.collect()
+    for uuid, entity in single.interrogate().items():
+        assert entity.statistics[-1] == bulk[uuid].statistics[-1]
+    assert bulk['bb'].mem_available == 2
+    assert bulk['broken'].mem_available is None
+
+
+def test_collect_with_bulk_results():
+    # Collectors are listed before and after the ones collected in bulk
+    first, bulk, last = Sync({'x': 1}), Sync({'y': 2}), Sync({'z': 3})
+    monitor = make_monitor([first, bulk, last])
+    assert monitor.collect({bulk: {'y': 5}}) == {'x': 1, 'y': 5, 'z': 3}
+    assert (first.calls, bulk.calls, last.calls) == (1, 0, 1)
+
+
+def test_collect_none_before_bulk_results():
+    class Empty(Sync):
+        def collect(self):
+            Sync.collect(self)
+            return None
+
+    empty, bulk = Empty({}), Sync({'y': 2})
+    monitor = make_monitor([empty, bulk])
+    assert monitor.collect({bulk: {'y': 5}}) == {'y': 5}
+    # Incomplete data, not an error from the None of the first collector
+    assert monitor.collect({bulk: CollectionError("no data")}) is None
+    assert (empty.calls, bulk.calls) == (2, 0)
+
+
+def test_collect_many_without_bulk_interface():
+    iface = mock.Mock(spec=['getVmMemoryStats', 'getVmBalloonInfo',
+                            'startVmMemoryStats'])
+    iface.getVmMemoryStats.side_effect = lambda uuid: {'mem_available': 1}
+    iface.getVmBalloonInfo.side_effect = lambda uuid: dict.fromkeys(
+        ['balloon_cur', 'balloon_max', 'balloon_min'], 2)
+    manager = make_guest_manager(iface, ['a', 'b'])
+    manager._collect_from_guest_monitors()
+    assert iface.getVmMemoryStats.call_count == 2
+    assert manager.interrogate()['b'].balloon_cur == 2
+
+
+@pytest.mark.skipif(not os.path.isdir('/sys/kernel/mm/ksm') or
+                    shutil.which('ps') is None,
+                    reason="needs KSM and ps")
+def test_host_ksm_shareable():
+    ksm = HostKSM({'interval': 5})
+    pid = os.getpid()
+    with mock.patch.object(ksm.pid_index, 'qemu_pids', return_value=[pid]):
+        vsz = ksm.get_shareable_mem()
+    # The same as the ps based estimate
+    out = subprocess.check_output(['ps', '-ovsz', 'h', str(pid)])
+    assert abs(vsz - int(out)) < 64 * 1024
+    assert ksm.get_process_mem(2**22 + 1) == 0
+
+    ksm.estimate = 'anonymous'
+    assert 0 < ksm.get_process_mem(pid) <= vsz
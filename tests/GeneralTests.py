@@ -105,6 +105,7 @@ def test_query(mom_instance):
     assert mom_instance.ping() is True, "MOM should respond to ping"
     assert 'host' in mom_instance.getStatistics()
     assert isinstance(mom_instance.getActiveGuests(),list)
+    assert mom_instance.getSchedulerStats() == {}
 
 def test_policy_api(mom_instance):
     assert mom_instance.getPolicy() == '0'
@@ -133,6 +134,14 @@ def test_multiple_policies(mom_instance):
     policies = mom_instance.getNamedPolicies()
     assert "20_test" not in policies
 
+def test_policy_profile(mom_instance):
+    assert mom_instance.getPolicyProfile() == {'enabled': False}
+    assert mom_instance.setPolicyProfiling(True) is True
+    assert mom_instance.getPolicyProfile()['enabled'] is True
+    assert mom_instance.resetPolicyProfile() is True
+    assert mom_instance.setPolicyProfiling(False) is True
+    assert mom_instance.getPolicyProfile() == {'enabled': False}
+
 def test_multiple_policies_with_config(mom_with_config):
     policies = mom_with_config.getNamedPolicies()
     assert policies['01_foo'] == '(+ 1 1)'
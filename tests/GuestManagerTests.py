@@ -0,0 +1,104 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import time
+
+from mom.GuestManager import GuestManager
+from mom.HypervisorInterfaces.HypervisorInterface import HypervisorInterface
+from TestHelpers import Interface
+from TestHelpers import make_config
+from TestHelpers import wait_for
+
+
+def test_vm_events():
+    iface = Interface()
+    config = make_config(guest_manager_multi_thread='false',
+                         guest_manager_events='true')
+    manager = GuestManager(config, iface)
+    assert manager._start_events() == 60
+
+    iface.event('a', True)
+    iface.event('b', True)
+    manager._wait(0.05)
+    assert sorted(manager.guests) == ['a', 'b']
+    monitor = manager.guests['a'].monitor
+
+    iface.event('a', False)
+    iface.event('unknown', False)
+    manager._wait(0.05)
+    assert sorted(manager.guests) == ['b']
+    assert not monitor.should_run()
+
+
+def test_vm_events_unsupported():
+    manager = GuestManager(make_config(guest_manager_events='true',
+                                       guest_manager_interval='3'),
+                           HypervisorInterface())
+    assert manager._start_events() == 3
+    assert manager._events is None
+
+
+def test_vm_events_asyncio():
+    config = make_config(guest_manager_asyncio='true',
+                         guest_manager_events='true')
+    iface = Interface(['a'])
+    manager = GuestManager(config, iface)
+    manager.start()
+    try:
+        wait_for(lambda: 'a' in manager.guests)
+        start = time.monotonic()
+        iface.event('b', True)
+        wait_for(lambda: 'b' in manager.guests)
+        iface.event('a', False)
+        wait_for(lambda: 'a' not in manager.guests)
+        # Without waiting for the next listing
+        assert time.monotonic() - start < 1
+        assert iface.listings == 1
+    finally:
+        config.set('__int__', 'running', '0')
+        manager.join(5)
+    assert not manager.is_alive()
+
+
+def test_worker_pool_restarts_monitor():
+    config = make_config(guest_monitor_workers='2')
+    manager = GuestManager(config, Interface(['a']))
+    manager._spawn_guest_monitors(['a'])
+    monitor = manager.guests['a'].monitor
+    assert manager._scheduled_collect('a', monitor)
+
+    # The monitor stopped after a fatal collector error
+    monitor.terminate()
+    assert not manager._scheduled_collect('a', monitor)
+    assert 'a' not in manager.guests
+    assert len(manager._scheduler) == 0
+    manager._spawn_guest_monitors(['a'])
+    assert manager.guests['a'].monitor is not monitor
+    assert len(manager._scheduler) == 1
+
+
+def test_asyncio_restarts_monitor():
+    config = make_config(guest_manager_asyncio='true')
+    manager = GuestManager(config, Interface(['a']))
+    manager.start()
+    try:
+        wait_for(lambda: 'a' in manager.guests)
+        monitor = manager.guests['a'].monitor
+        monitor.terminate()
+        wait_for(lambda: 'a' in manager.guests and
+                 manager.guests['a'].monitor is not monitor)
+    finally:
+        config.set('__int__', 'running', '0')
+        manager.join(5)
+    assert not manager.is_alive()
@@ -0,0 +1,270 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import configparser
+import random
+import sys
+import threading
+
+import pytest
+from mom.Entity import EntityError
+from mom.History import History
+from mom.Monitor import Monitor
+
+HISTORY = 5
+
+
+@pytest.fixture
+def monitor():
+    config = configparser.ConfigParser()
+    config.add_section('main')
+    config.set('main', 'sample-history-length', str(HISTORY))
+    config.add_section('__int__')
+    config.set('__int__', 'plot-subdir', '')
+    monitor = Monitor(config, 'test')
+    monitor.config = config
+    monitor.fields = {'ints', 'floats', 'mixed'}
+    monitor.optional_fields = {'optional'}
+    monitor.ready = True
+    return monitor
+
+
+def sample(rand):
+    return {'ints': rand.randint(-100, 100),
+            'floats': rand.uniform(0, 1),
+            'mixed': rand.choice([rand.randint(0, 9), rand.uniform(0, 9)]),
+            'optional': rand.choice([None, rand.randint(0, 9)])}
+
+
+def test_rolling_statistics(monitor):
+    rand = random.Random(0)
+    alpha = 2.0 / (HISTORY + 1)
+    ewma = {}
+    for i in range(50):
+        data = sample(rand)
+        monitor._add_sample(data)
+        for key, val in data.items():
+            if val is not None:
+                ewma[key] = val if key not in ewma else \
+                    ewma[key] + alpha * (val - ewma[key])
+
+        entity = monitor.interrogate()
+        assert len(entity.statistics) == min(i + 1, HISTORY)
+        for key in data:
+            values = [row[key] for row in entity.statistics
+                      if row[key] is not None]
+            # Summed in sample order like the history based computation
+            total = 0
+            for val in values:
+                total = total + val
+            if values:
+                assert entity.StatAvg(key) == float(total / len(values))
+                assert entity.StatMin(key) == min(values)
+                assert entity.StatMax(key) == max(values)
+                assert entity.StatEwma(key) == pytest.approx(ewma[key])
+            else:
+                assert entity.StatAvg(key) == 0.0
+                assert entity.StatMin(key) is None
+
+            rows = entity.statistics
+            if len(rows) > 1 and None not in (rows[-1][key], rows[-2][key]):
+                assert entity.StatDelta(key) == rows[-1][key] - rows[-2][key]
+            else:
+                assert entity.StatDelta(key) is None
+
+
+def test_statistics_without_aggregates(monitor):
+    rand = random.Random(1)
+    for i in range(8):
+        monitor._add_sample(sample(rand))
+    entity = monitor.interrogate()
+    aggregates = entity.aggregates
+    entity._set_aggregates({})
+    for key in ('ints', 'floats', 'mixed', 'optional'):
+        assert entity.StatAvg(key) == pytest.approx(
+            aggregates[key][0] / aggregates[key][1])
+        assert entity.StatMin(key) == aggregates[key][2]
+        assert entity.StatMax(key) == aggregates[key][3]
+
+
+def test_statistics_errors(monitor):
+    monitor._add_sample({'ints': 'text', 'floats': 1.0, 'mixed': 2})
+    entity = monitor.interrogate()
+    with pytest.raises(KeyError):
+        entity.StatMin('unknown')
+    # Values that are not numbers are left to the history based computation
+    assert entity.aggregates['ints'] is None
+    with pytest.raises(TypeError):
+        entity.StatAvg('ints')
+
+    entity._set_statistics([])
+    with pytest.raises(EntityError):
+        entity.StatEwma('floats')
+
+
+def test_history_keeps_types():
+    history = History(3)
+    history.append({'i': 1, 'f': 0.5, 'm': 1, 'b': True, 'big': 2**70})
+    history.append({'i': 2, 'f': 1.5, 'm': 2.5, 'b': None, 'big': 3})
+    view = history.view()
+    assert list(view) == [
+        {'i': 1, 'f': 0.5, 'm': 1, 'b': True, 'big': 2**70},
+        {'i': 2, 'f': 1.5, 'm': 2.5, 'b': None, 'big': 3}]
+    assert [type(v) for v in view.values('m')] == [int, float]
+    assert view.value('b', 0) is True
+    assert view.value('unknown', -1, 'default') == 'default'
+
+
+def test_views_are_snapshots():
+    history = History(3)
+    history.append({'a': 0})
+    views = [history.view()]
+    for i in range(1, 20):
+        history.append({'a': i})
+        views.append(history.view())
+    for i, view in enumerate(views):
+        assert list(view.values('a')) == list(range(max(0, i - 2), i + 1))
+        assert view[-1] == {'a': i}
+    # Only the views still covered by the ring share it
+    assert sum(view.history is history for view in views) == 2
+
+
+def test_history_length_change(monitor):
+    for i in range(HISTORY):
+        monitor._add_sample({'ints': i})
+    monitor.config.set('main', 'sample-history-length', '2')
+    monitor._add_sample({'ints': 10})
+    entity = monitor.interrogate()
+    assert list(entity.statistics.values('ints')) == [HISTORY - 1, 10]
+    assert entity.StatAvg('ints') == (HISTORY - 1 + 10) / 2.0
+    assert entity.StatMin('ints') == HISTORY - 1
+
+
+def test_stat_rate(monitor):
+    monitor._add_sample({'ints': 100}, 10.0)
+    monitor._add_sample({'ints': 160}, 14.0)
+    entity = monitor.interrogate()
+    assert entity.StatDelta('ints') == 60
+    assert entity.StatRate('ints') == 15.0
+    assert entity.StatRate('floats') is None
+
+    entity._set_statistics([{'ints': 1}, {'ints': 2}])
+    assert entity.StatDelta('ints') == 1
+    assert entity.StatRate('ints') is None
+
+
+def test_interrogate_shares_snapshot(monitor):
+    monitor.properties['name'] = 'test'
+    monitor._add_sample({'ints': 1, 'floats': 0.5, 'mixed': 1,
+                         'optional': None})
+    first, second = monitor.interrogate(), monitor.interrogate()
+    assert first.snapshot is second.snapshot
+    assert first.ints == 1 and first.optional is None
+    with pytest.raises(AttributeError):
+        first.unknown
+
+    # Changes made by one Entity are not seen by the others
+    first.SetVar('var', 1)
+    first._set_property('name', 'changed')
+    assert second.GetVar('var') is None
+    assert second.Prop('name') == 'test'
+    assert monitor.properties['name'] == 'test'
+
+    # Nor are changes of the Monitor until they are published
+    monitor.properties['name'] = 'renamed'
+    monitor._add_sample({'ints': 2, 'floats': 1.5, 'mixed': 2})
+    third = monitor.interrogate()
+    assert third.snapshot.version == second.snapshot.version + 1
+    assert (second.ints, second.Prop('name')) == (1, 'test')
+    assert (third.ints, third.Prop('name')) == (2, 'renamed')
+    assert len(second.statistics) == 1 and len(third.statistics) == 2
+
+
+def test_store_variables(monitor):
+    monitor._add_sample({'ints': 1, 'floats': 0.5, 'mixed': 1})
+    entity = monitor.interrogate()
+    version = entity.snapshot.version
+    entity._store_variables()
+    assert monitor.snapshot.version == version
+
+    entity.SetVar('var', 1)
+    entity._store_variables()
+    latest = monitor.interrogate()
+    assert latest.GetVar('var') == 1
+    assert latest.snapshot.version == version + 1
+    assert latest.statistics is entity.statistics
+
+
+def test_entity_fields(monitor):
+    monitor.optional_fields = {'optional', 'controls'}
+    monitor._add_sample({'ints': 1, 'floats': 0.5, 'controls': 3,
+                         'unknown': 4})
+    first, second = monitor.interrogate(), monitor.interrogate()
+    assert type(first) is type(second)
+    assert not hasattr(first, '__dict__')
+    assert first.ints == 1 and first.floats == 0.5
+    assert not hasattr(first, 'unknown')
+    # Statistics named like an Entity member are only available with Stat
+    assert first.controls == {}
+    assert first.Stat('controls') == 3
+
+    monitor._add_sample({'ints': 2, 'floats': 1.5, 'controls': 5})
+    third = monitor.interrogate()
+    assert type(third) is type(first)
+    assert (first.ints, third.ints) == (1, 2)
+
+
+def test_valid_fields_cached(monitor):
+    valid = monitor.valid_fields
+    assert valid == {'ints', 'floats', 'mixed', 'optional'}
+    assert monitor.valid_fields is valid
+    monitor.optional_fields = set()
+    assert monitor.valid_fields == {'ints', 'floats', 'mixed'}
+
+
+def test_interrogate_while_collecting(monitor):
+    # Switch threads often to interleave the reader with every append
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                entity = monitor.interrogate()
+                if entity is None:
+                    continue
+                list(entity.statistics.fields())
+                # Kept across appends, the view is detached while read
+                for i in range(3):
+                    for row in entity.statistics:
+                        values = set(v for v in row.values() if v is not None)
+                        assert len(values) == 1, row
+        except Exception as e:
+            errors.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for n in range(300):
+            # Every sample brings a new optional statistic
+            with monitor.data_lock:
+                monitor._add_sample({'ints': n, 'floats': float(n),
+                                     'mixed': n, 'new%d' % n: n})
+    finally:
+        done.set()
+        reader.join()
+        sys.setswitchinterval(interval)
+    assert errors == []
@@ -20,6 +20,17 @@ from mom.Policy import Parser
 def evaluator():
     return Parser.Evaluator()
 
+def optimized(e, string):
+    code = Parser.optimize(e, Parser.get_code(e, string), e.stack.top.vars)
+    return [expr(e) for expr in Parser.compile_code(e, code)]
+
+@pytest.fixture(params=[Parser.eval, Parser.interpret, optimized],
+                ids=['compiled', 'interpreted', 'optimized'])
+def evaluate(request):
+    """Run every policy through the compiler, the interpreter and the
+    optimizer"""
+    return request.param
+
 @pytest.fixture
 def entity():
     class TestEntity(object):
@@ -66,28 +77,28 @@ def valid_guest():
 
     return Guest(0)
 
-def verify_policy(evaluator, policy, expected):
-    results = Parser.eval(evaluator, policy)
+def verify_policy(evaluate, evaluator, policy, expected):
+    results = evaluate(evaluator, policy)
     assert results == expected
 
-def test_comments(evaluator):
+def test_comments(evaluate, evaluator):
     pol = """
     # This is a full-line pound comment
     12 # A partial-line comment with (+ 23 43) keywords
     (+ 3 # An expression with embedded comments
     2)
     """
-    results = Parser.eval(evaluator, pol)
+    results = evaluate(evaluator, pol)
     assert results == [ 12, 5 ]
 
-def test_whitespace(evaluator):
+def test_whitespace(evaluate, evaluator):
     pol = """
     (+ 1
     2)  (- 10 2)
     """
-    verify_policy(evaluator, pol, [ 3, 8 ])
+    verify_policy(evaluate, evaluator, pol, [ 3, 8 ])
 
-def test_string(evaluator):
+def test_string(evaluate, evaluator):
     pol = """
     "foo" "bar"
 
@@ -95,9 +106,9 @@ def test_string(evaluator):
     (+ "Hello " "World!")
     (+ (* 3 "Hey ") "!")
     """
-    verify_policy(evaluator, pol, [ "foo", "bar", "Hello World!", "Hey Hey Hey !" ])
+    verify_policy(evaluate, evaluator, pol, [ "foo", "bar", "Hello World!", "Hey Hey Hey !" ])
 
-def test_basic_math(evaluator):
+def test_basic_math(evaluate, evaluator):
     pol = """
     10
     0o0                  # Octal
@@ -115,10 +126,10 @@ def test_basic_math(evaluator):
     (+ 0xa 10)          # Numeric type mixing
     (+ 10.0e3 100e-2)   # Scientific notation for integers and floats
     """
-    verify_policy(evaluator, pol, [ 10, 0, 0.3, 0, 3, 5.5, 5.5, 18, -8, 18, 4, 256, 18, 20,
+    verify_policy(evaluate, evaluator, pol, [ 10, 0, 0.3, 0, 3, 5.5, 5.5, 18, -8, 18, 4, 256, 18, 20,
                 10001.0 ])
 
-def test_compare(evaluator):
+def test_compare(evaluate, evaluator):
     pol = """
     (< 5 4)
     (> 1 0)
@@ -128,9 +139,9 @@ def test_compare(evaluator):
     (!= "foo" "foo")
     (== 0x0 0)
     """
-    verify_policy(evaluator, pol, [ False, True, True, False, True, False, True ])
+    verify_policy(evaluate, evaluator, pol, [ False, True, True, False, True, False, True ])
 
-def test_logic(evaluator):
+def test_logic(evaluate, evaluator):
     pol = """           # Again, these bahave according to Python rules
     (and 1 "")          # "" evaluates to false
     (and 0 1)           #   as does 0 -- the first false value is returned
@@ -140,9 +151,9 @@ def test_logic(evaluator):
     (not "")            # The only false values are: 0 and ""
     (not -0)
     """
-    verify_policy(evaluator, pol, [ "", 0, 2, 17, "", True, True ])
+    verify_policy(evaluate, evaluator, pol, [ "", 0, 2, 17, "", True, True ])
 
-def test_extended_logic(evaluator):
+def test_extended_logic(evaluate, evaluator):
     pol = """           # Again, these bahave according to Python rules
     (and 1 1 "")          # "" evaluates to false
     (and 0 0 1)           #   as does 0 -- the first false value is returned
@@ -152,9 +163,9 @@ def test_extended_logic(evaluator):
     (and 1 2 3 4 5 6 7 8 9 0)
     (or 0)
     """
-    verify_policy(evaluator, pol, [ "", 0, 2, 17, "", 0, 0 ])
+    verify_policy(evaluate, evaluator, pol, [ "", 0, 2, 17, "", 0, 0 ])
 
-def test_vars(evaluator):
+def test_vars(evaluate, evaluator):
     pol = """
     (defvar foo "bar")
     (defvar a 5)
@@ -166,9 +177,9 @@ def test_vars(evaluator):
     (defvar e3 7)
     (+ 1 e3)        # Make sure e3 is not mistaken for scientific notation
     """
-    verify_policy(evaluator, pol, [ 'bar', 5, 6, 11, 8, 14, "barbar", 7, 8 ])
+    verify_policy(evaluate, evaluator, pol, [ 'bar', 5, 6, 11, 8, 14, "barbar", 7, 8 ])
 
-def test_funcs(evaluator):
+def test_funcs(evaluate, evaluator):
     pol = """
     (def foo () 10)
     (def bar (a)
@@ -183,9 +194,9 @@ def test_funcs(evaluator):
     })
     (foo 9)
     """
-    verify_policy(evaluator, pol, [ 'foo', 'bar', 1, 'baz',  -22, 'foo', 10 ])
+    verify_policy(evaluate, evaluator, pol, [ 'foo', 'bar', 1, 'baz',  -22, 'foo', 10 ])
 
-def test_let(evaluator):
+def test_let(evaluate, evaluator):
     pol = """
     (def foo (a) (+ 2 a))
     (defvar a 2)
@@ -193,18 +204,18 @@ def test_let(evaluator):
     a                               # Value of 'a' unaffected by let
     (let ((a 1) (b 2)) a b)         # multiple expressions in let
     """
-    verify_policy(evaluator, pol, [ 'foo', 2, 3, 2, 2 ])
+    verify_policy(evaluate, evaluator, pol, [ 'foo', 2, 3, 2, 2 ])
 
-def test_minmax(evaluator):
+def test_minmax(evaluate, evaluator):
     pol = """
     (min 1 2 3 0)
     (defvar a 8)
     (defvar c (min 8 7 6 5))
     (max 0 c a 3)
     """
-    verify_policy(evaluator, pol, [ 0, 8, 5, 8 ])
+    verify_policy(evaluate, evaluator, pol, [ 0, 8, 5, 8 ])
 
-def test_if(evaluator):
+def test_if(evaluate, evaluator):
     pol = """
     (defvar a 1)
     (defvar b 0)
@@ -216,9 +227,9 @@ def test_if(evaluator):
     (if b 1 0)
     (f (> 2 1))
     """
-    verify_policy(evaluator, pol, [ 1, 0, 'f', 4, 0, "yes"])
+    verify_policy(evaluate, evaluator, pol, [ 1, 0, 'f', 4, 0, "yes"])
 
-def test_scope(evaluator):
+def test_scope(evaluate, evaluator):
     pol = """
     (defvar a 10)
     (def foo (b) (set a b))         # set affects the global 'a'
@@ -233,9 +244,25 @@ def test_scope(evaluator):
     (if (== a 5) (defvar a 4) 0)    # if creates a local 'a'
     a
     """
-    verify_policy(evaluator, pol, [ 10, 'foo', 2, 2, 'foo', 4, 2, 5, 4, 5, 5, 5 ])
+    verify_policy(evaluate, evaluator, pol, [ 10, 'foo', 2, 2, 'foo', 4, 2, 5, 4, 5, 5, 5 ])
 
-def test_multi_statements(evaluator):
+def test_nested_scope(evaluate, evaluator, entity):
+    evaluator.stack.set('obj', entity, True)
+    pol = """
+    (defvar x 1)
+    (let ((x 2) (y x)) y)           # later bindings see earlier ones
+    (let ((x 2)) (let ((y 3)) x))   # outer let seen through inner let
+    (let ((z 2)) (if 1 (defvar x 3) 0) x)   # defvar shadows the global
+    (def f (a b) b)
+    (let ((a 5)) (f 1 a))           # arguments see earlier parameters
+    (def g () x)
+    (let ((x 7)) (g))               # callees see the caller's variables
+    (let ((obj 3)) obj.a)           # attribute lookups skip to outer frames
+    """
+    verify_policy(evaluate, evaluator, pol,
+                  [ 1, 2, 2, 3, 'f', 1, 'g', 7, 12 ])
+
+def test_multi_statements(evaluate, evaluator):
     pol = """
     { 10 4 }                # A multi-statement evaluates to the last value
     (def f (a b) {          # Use them for function bodies
@@ -257,9 +284,9 @@ def test_multi_statements(evaluator):
     })
     (- q 10)
     """
-    verify_policy(evaluator, pol, [ 4, 'f', 10, 11, 1, 12, 2 ])
+    verify_policy(evaluate, evaluator, pol, [ 4, 'f', 10, 11, 1, 12, 2 ])
 
-def test_multi_statements_lisp(evaluator):
+def test_multi_statements_lisp(evaluate, evaluator):
     pol = """
     (def f (a b) (let ()           # Use them for function bodies
         (defvar c (+ a b))
@@ -282,9 +309,9 @@ def test_multi_statements_lisp(evaluator):
     ))
     (- q 10)
     """
-    verify_policy(evaluator, pol, [ 'f', 10, 11, 1, 11, 12, 2 ])
+    verify_policy(evaluate, evaluator, pol, [ 'f', 10, 11, 1, 11, 12, 2 ])
 
-def test_entity_write(evaluator, entity):
+def test_entity_write(evaluate, evaluator, entity):
     evaluator.stack.set('Entity', entity, True)
     pol = """
     (set Entity.a 1)
@@ -292,51 +319,51 @@ def test_entity_write(evaluator, entity):
     # Direct modification of Entity attributes is explicitly not enabled
     #  - but may be in the future if needed.
     with pytest.raises(Exception):
-        Parser.eval(evaluator, pol)
+        evaluate(evaluator, pol)
 
-def test_entities(evaluator, entity):
+def test_entities(evaluate, evaluator, entity):
     evaluator.stack.set('Entity', entity, True)
     pol = """
     Entity.a                    # Read variables
     Entity.b
     (Entity.mod Entity.b 4)     # Call functions
     """
-    verify_policy(evaluator, pol, [ 12, 7, 3 ])
+    verify_policy(evaluate, evaluator, pol, [ 12, 7, 3 ])
     assert entity.a == 3 # The 'mod' function changes Entity.a
 
-def test_externals(evaluator):
+def test_externals(evaluate, evaluator):
     pol = """
     (+ (abs -21) (abs 21))
     """
-    verify_policy(evaluator, pol, [ 42 ])
+    verify_policy(evaluate, evaluator, pol, [ 42 ])
 
-def test_syntax_error(evaluator):
+def test_syntax_error(evaluate, evaluator):
     pol = """
     (+ 2 2
     """
     with pytest.raises(Parser.PolicyError):
-        Parser.eval(evaluator, pol)
+        evaluate(evaluator, pol)
 
-def test_not_null(evaluator):
+def test_not_null(evaluate, evaluator):
     pol = """
     (null 0 1 2 "")
     """
-    verify_policy(evaluator, pol, [False])
+    verify_policy(evaluate, evaluator, pol, [False])
 
-def test_parse_error(evaluator):
+def test_parse_error(evaluate, evaluator):
     pol = """
     (2 + 2)
     """
     with pytest.raises(Parser.PolicyError):
-        Parser.eval(evaluator, pol)
+        evaluate(evaluator, pol)
 
-def test_null(evaluator):
+def test_null(evaluate, evaluator):
     pol = """
     (null nil)
     """
-    verify_policy(evaluator, pol, [True])
+    verify_policy(evaluate, evaluator, pol, [True])
 
-def test_multiple_defvar(evaluator):
+def test_multiple_defvar(evaluate, evaluator):
     pol = """
     (defvar balloonEnabled 1)
     (defvar balloonEnabled 0)  # second defvar in the same scope does not
@@ -344,9 +371,9 @@ def test_multiple_defvar(evaluator):
     (defvar balloonEnabled 2)
     balloonEnabled
     """
-    verify_policy(evaluator, pol, [1, 1, 1, 1, 1])
+    verify_policy(evaluate, evaluator, pol, [1, 1, 1, 1, 1])
 
-def test_setq(evaluator):
+def test_setq(evaluate, evaluator):
     pol = """
     (defvar balloonEnabled 1)
     balloonEnabled
@@ -355,15 +382,15 @@ def test_setq(evaluator):
     (set balloonEnabled 3)
     balloonEnabled
     """
-    verify_policy(evaluator, pol, [1, 1, 2, 2, 3, 3])
+    verify_policy(evaluate, evaluator, pol, [1, 1, 2, 2, 3, 3])
 
-def test_debug(evaluator):
+def test_debug(evaluate, evaluator):
     pol = """
     (debug "test" 1 nil "lala")
     """
-    verify_policy(evaluator, pol, ["lala"])
+    verify_policy(evaluate, evaluator, pol, ["lala"])
 
-def test_valid(evaluator):
+def test_valid(evaluate, evaluator):
     evaluator.stack.set('empty', [], True)
     pol = """
     (valid "test" 1 nil "lala")
@@ -372,41 +399,41 @@ def test_valid(evaluator):
     (valid nil)
     (valid 0 "" empty)
     """
-    verify_policy(evaluator, pol, [False, True, True, False, True])
+    verify_policy(evaluate, evaluator, pol, [False, True, True, False, True])
 
-def test_not_enough_arguments(evaluator):
+def test_not_enough_arguments(evaluate, evaluator):
     pol = """
     (and)
     """
     with pytest.raises(Parser.PolicyError) as result:
-        verify_policy(evaluator, pol, [None])
+        verify_policy(evaluate, evaluator, pol, [None])
 
     assert str(result.value) == \
         "not enough arguments for 'c_and' on line 2"
 
-def test_bad_arity(evaluator):
+def test_bad_arity(evaluate, evaluator):
     pol = """
     (not)
     """
     with pytest.raises(Parser.PolicyError) as result:
-        verify_policy(evaluator, pol, [None])
+        verify_policy(evaluate, evaluator, pol, [None])
 
     assert str(result.value) == \
         "arity mismatch in doc parsing of 'c_not' on line 2"
 
-def test_bad_syntax_number(evaluator):
+def test_bad_syntax_number(evaluate, evaluator):
     pol = """
     156
     125f56
     """
 
     with pytest.raises(Parser.PolicyError) as result:
-        verify_policy(evaluator, pol, [156, None])
+        verify_policy(evaluate, evaluator, pol, [156, None])
 
     assert str(result.value) == \
         "undefined symbol f56 on line 3"
 
-def test_bad_arity_def(evaluator):
+def test_bad_arity_def(evaluate, evaluator):
     pol = """
     (def test (x y) {
     })
@@ -414,12 +441,12 @@ def test_bad_arity_def(evaluator):
     """
 
     with pytest.raises(Parser.PolicyError) as result:
-        verify_policy(evaluator, pol, [None])
+        verify_policy(evaluate, evaluator, pol, [None])
 
     assert str(result.value) == \
         "Function \"test\" invoked with incorrect arity on line 4"
 
-def test_guest_list(guest_list, evaluator):
+def test_guest_list(guest_list, evaluate, evaluator):
     evaluator.stack.set('Guests', guest_list, True)
     pol = """
     (def guestName (guest) (+ "This guest's name is " (guest.name)))
@@ -427,21 +454,21 @@ def test_guest_list(guest_list, evaluator):
     """
     # The results of 'with' are returned in their own list
     # This means that (with ...) cannot be evaluated yet
-    verify_policy(evaluator, pol, [ "guestName",
+    verify_policy(evaluate, evaluator, pol, [ "guestName",
                        [ "This guest's name is Guest-1",
                          "This guest's name is Guest-2",
                          "This guest's name is Guest-4" ] ])
 
-def test_nil_attribute(empty_guest, evaluator):
+def test_nil_attribute(empty_guest, evaluate, evaluator):
     evaluator.stack.set('guest', empty_guest, True)
     pol = """
     guest.num
     (== guest.num nil)
     (== guest.num 0)
     """
-    verify_policy(evaluator, pol, [None, True, False])
+    verify_policy(evaluate, evaluator, pol, [None, True, False])
 
-def test_valid_nil_attribute(evaluator, empty_guest, valid_guest):
+def test_valid_nil_attribute(evaluate, evaluator, empty_guest, valid_guest):
     evaluator.stack.set('guest', empty_guest, True)
     evaluator.stack.set('guest2', valid_guest, True)
 
@@ -450,4 +477,109 @@ def test_valid_nil_attribute(evaluator, empty_guest, valid_guest):
     (valid guest.num)
     (valid guest2.num)
     """
-    verify_policy(evaluator, pol, [None, False, True])
+    verify_policy(evaluate, evaluator, pol, [None, False, True])
+
+def test_signatures(evaluator):
+    signature = evaluator.get_signature('c_let')
+    assert signature.kinds == ('code', 'code')
+    assert signature.variadic is True
+    assert signature.kind(5) == 'code'
+
+    signature = evaluator.get_signature('c_null')
+    assert signature.kinds == ()
+    assert signature.kind(0) == 'value'
+
+    # The table is built once for the whole class
+    assert Parser.Evaluator().get_signature('c_add') is \
+        evaluator.get_signature('c_add')
+
+def test_line_numbers(evaluator):
+    pol = """
+    # A comment
+    (defvar a 1)    # Another comment
+    "a string spanning
+    two lines"
+    undefined
+    """
+    with pytest.raises(Parser.PolicyError) as result:
+        Parser.eval(evaluator, pol)
+
+    assert str(result.value) == "undefined symbol undefined on line 6"
+
+def test_unbalanced(evaluator):
+    with pytest.raises(Parser.PolicyError) as result:
+        Parser.get_code(evaluator, "(+ 1 2))")
+    assert str(result.value) == "parse error: unexpected ')' on line 1"
+
+    with pytest.raises(Parser.PolicyError) as result:
+        Parser.get_code(evaluator, "\n(+ 1 {\n 2)")
+    assert str(result.value) == \
+        "parse error: ')' on line 3 does not match '{' on line 2"
+
+def test_unexpected_character(evaluator):
+    with pytest.raises(Parser.PolicyError) as result:
+        Parser.get_code(evaluator, "(+ 1 2)\n(+ 1 @)")
+    assert str(result.value) == "unexpected character '@' on line 2"
+
+def test_code_structure(evaluator):
+    code = Parser.get_code(evaluator, "{ (<= 1 -2.5) [a.b 'c'] }")
+    assert code == [['symbol', ['operator', 'number', 'number'],
+                     ['symbol', 'string']]]
+    block = code[0]
+    assert block[0].value == 'eval'
+    assert block[1][0].value == '<='
+    assert block[1][2].type == 'float'
+    assert block[2][1].value == "'c'"
+
+def test_constant_folding(evaluator):
+    pol = """
+    (defvar threshold 0.20)
+    (defvar scale (* 4 1024))
+    (defvar counter 0)
+    (set counter 1)
+    (def f (x) (+ x (* threshold scale)))
+    (if (> threshold 0.5) (undefined) (f counter))
+    (+ counter (- scale 1))
+    (/ scale 0)
+    """
+    code = Parser.optimize(evaluator, Parser.get_code(evaluator, pol))
+    assert len(code) == 8
+    # Constants and pure builtins are folded, the dead branch is gone
+    assert code[1][2].type == 'constant' and code[1][2].value == 4096
+    assert code[4][3][2].value == 0.20 * 4096
+    assert code[5][0].value == 'f'
+    assert code[5][1] == 'symbol' and code[5][1].value == 'counter'
+    # counter is set, so it is not a constant
+    assert code[6][1].value == 'counter' and code[6][2].value == 4095
+    # Errors are left for runtime
+    assert code[7][0].value == '/'
+
+    results = [expr(evaluator) for expr in
+               Parser.compile_code(evaluator, code[:7])]
+    assert results == [0.20, 4096, 0, 1, 'f', 1 + 0.20 * 4096, 4096]
+
+def test_folding_keeps_line_numbers(evaluator):
+    pol = """
+    (defvar a 2)
+    (if (< a 1)
+        0
+        (+ (* a 3)
+           undefined))
+    """
+    code = Parser.optimize(evaluator, Parser.get_code(evaluator, pol))
+    assert code[1][1].line == 5
+    with pytest.raises(Parser.PolicyError) as result:
+        [expr(evaluator) for expr in Parser.compile_code(evaluator, code)]
+    assert str(result.value) == "undefined symbol undefined on line 6"
+
+@pytest.mark.parametrize('pol', [
+    # Rebound by let, a with loop or a function parameter
+    "(defvar a 1) (let ((a 2)) a)",
+    "(defvar a 1) (def f (a) a) (f 5)",
+    "(defvar a 1) (def f () (defvar a 2)) a",
+    # Used before it is defined
+    "(def f () a) (defvar a 1) (f)",
+])
+def test_rebound_constants_are_not_folded(evaluator, pol):
+    code = Parser.get_code(evaluator, pol)
+    assert repr(Parser.optimize(evaluator, code)) == repr(code)
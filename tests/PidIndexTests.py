@@ -0,0 +1,129 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+from unittest import mock
+
+import pytest
+from mom.PidIndex import FULL_SCAN_EVERY
+from mom.PidIndex import PidIndex
+
+
+def add_process(proc, pid, args, start=100):
+    directory = proc / str(pid)
+    directory.mkdir()
+    (directory / 'cmdline').write_bytes(b'\0'.join(args) + b'\0')
+    (directory / 'stat').write_text(
+        '%d (%s) S%s %d 0\n' % (pid, 'qemu kvm', ' 0' * 18, start))
+
+
+def add_guest(proc, pid, uuid, start=100):
+    add_process(proc, pid, [b'/usr/bin/qemu-kvm', b'-name', b'guest=g',
+                            b'-uuid', uuid.encode(), b'-m', b'1024'], start)
+
+
+@pytest.fixture
+def proc(tmp_path):
+    proc = tmp_path / 'proc'
+    proc.mkdir()
+    (proc / 'self').mkdir()
+    add_process(proc, 1, [b'/sbin/init'])
+    add_process(proc, 2, [])
+    return proc
+
+
+def test_scan_shared(proc):
+    for i in range(10):
+        add_guest(proc, 100 + i, 'uuid-%d' % i)
+    index = PidIndex(str(proc), ())
+    assert [index.lookup('uuid-%d' % i) for i in range(10)] == \
+           list(range(100, 110))
+    assert index.scans == 1
+    assert sorted(index.qemu_pids()) == list(range(100, 110))
+
+    # Guests started later are found with a new scan
+    add_guest(proc, 200, 'uuid-new')
+    assert index.lookup('uuid-new') == 200
+    assert index.scans == 2
+
+
+def test_incremental_scan(proc):
+    add_guest(proc, 100, 'uuid-a')
+    index = PidIndex(str(proc), ())
+    assert index.qemu_pids() == [100]
+    add_guest(proc, 101, 'uuid-b')
+    with mock.patch.object(index, '_uuid_of', wraps=index._uuid_of) as read:
+        assert sorted(index.qemu_pids(refresh=True)) == [100, 101]
+    # Only the command line of the new process was read
+    assert read.call_args_list == [mock.call(101)]
+    (proc / '101' / 'cmdline').write_bytes(b'/bin/sh\0')
+    for i in range(FULL_SCAN_EVERY):
+        index.qemu_pids(refresh=True)
+    assert index.qemu_pids() == [100]
+
+
+def test_scan_exec_and_reuse(proc):
+    # A child of libvirt scanned between its fork and its exec of qemu
+    add_process(proc, 100, [b'/usr/sbin/virtqemud'])
+    (proc / '100' / 'stat').write_text('100 (rpc-virtqemud) S' + ' 0' * 18 +
+                                       ' 100 0\n')
+    index = PidIndex(str(proc), ())
+    assert index.qemu_pids() == []
+    (proc / '100').rename(proc / 'old')
+    add_guest(proc, 100, 'uuid-a')
+    assert index.qemu_pids(refresh=True) == [100]
+
+    # The pid reused by another qemu process
+    (proc / '100').rename(proc / 'older')
+    add_guest(proc, 100, 'uuid-b', start=200)
+    index.refresh()
+    assert index.lookup('uuid-b') == 100
+    assert index.scans == 3
+
+
+def test_pidfile(proc, tmp_path):
+    add_guest(proc, 100, 'uuid-a')
+    add_guest(proc, 101, 'uuid-b')
+    run = tmp_path / 'run'
+    run.mkdir()
+    (run / 'a.pid').write_text('100')
+    # A stale pidfile pointing at another guest is not trusted
+    (run / 'b.pid').write_text('100')
+    index = PidIndex(str(proc), [str(run)])
+    assert index.lookup('uuid-a', 'a') == 100
+    assert index.scans == 0
+    assert index.lookup('uuid-b', 'b') == 101
+    assert index.scans == 1
+
+
+def test_pid_reuse(proc):
+    add_guest(proc, 100, 'uuid-a', start=100)
+    index = PidIndex(str(proc), ())
+    assert index.lookup('uuid-a') == 100
+    assert index.cache['uuid-a'] == (100, 100)
+
+    # The guest restarted and got another pid, its old one was reused
+    (proc / '100' / 'cmdline').write_bytes(b'/bin/sh\0')
+    (proc / '100' / 'stat').write_text('100 (sh) S' + ' 0' * 18 + ' 500 0\n')
+    add_guest(proc, 300, 'uuid-a', start=400)
+    index.refresh()
+    assert index.lookup('uuid-a') == 300
+
+
+def test_ambiguous(proc):
+    add_guest(proc, 100, 'uuid-a')
+    add_guest(proc, 101, 'uuid-a')
+    index = PidIndex(str(proc), ())
+    assert index.lookup('uuid-a') is None
+    assert index.lookup('uuid-missing') is None
+    assert 'uuid-a' not in index.cache
@@ -0,0 +1,502 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+"""
+Policy engine micro benchmarks.
+
+  eval   Compare the tree-walking evaluator with the compiled policy form
+  parse  Time reading the doc/*.rules policies concatenated N times
+  with   Time a (with Guests guest ...) loop calling a helper function
+  vector Compare the scalar and the NumPy evaluation of with loops
+  suite  Time Policy.set_policy and Policy.evaluate of every doc/*.rules
+         policy with real Entity objects and write the results as JSON
+  memory Measure the memory used by the Entities of a tick and by the
+         parsed doc/*.rules policies
+
+Usage: python tests/PolicyBenchmark.py eval [--guests N] [--ticks N]
+       python tests/PolicyBenchmark.py parse [--scale N]
+       python tests/PolicyBenchmark.py with [--guests N] [--ticks N]
+       python tests/PolicyBenchmark.py vector [--guests N] [--ticks N]
+       python tests/PolicyBenchmark.py suite [--guests N,N,...] [--ticks N]
+                                             [--vectorize] [--output FILE]
+       python tests/PolicyBenchmark.py memory [--guests N]
+"""
+import argparse
+import configparser
+import datetime
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from mom.Collectors.GuestBalloon import GuestBalloon
+from mom.Collectors.GuestMemory import GuestMemory
+from mom.Collectors.HostKSM import HostKSM
+from mom.Collectors.HostMemory import HostMemory
+from mom.Monitor import Monitor
+from mom.Policy import Parser
+from mom.Policy.Policy import Policy
+
+DOC_DIR = os.path.join(os.path.dirname(__file__), '..', 'doc')
+
+
+class FakeEntity(object):
+    def __init__(self, stats):
+        self.stats = stats
+        self.controls = {}
+        for key, val in stats.items():
+            setattr(self, key, val)
+
+    def Stat(self, name):
+        return self.stats[name]
+
+    def StatAvg(self, name):
+        return float(self.stats[name])
+
+    def Control(self, name, val):
+        self.controls[name] = val
+
+
+def make_host():
+    return FakeEntity({'mem_available': 64 * 2**20,
+                       'mem_free': 8 * 2**20})
+
+
+def make_guests(count):
+    return [FakeEntity({'balloon_cur': 2**20 + i * 1024,
+                        'balloon_max': 2**21,
+                        'balloon_min': 2**19,
+                        'mem_unused': 2**18 + i * 512})
+            for i in range(count)]
+
+
+def read_policy(name):
+    with open(os.path.join(DOC_DIR, name)) as f:
+        return f.read()
+
+
+def run(policy, guests, ticks, compiled):
+    """
+    Evaluate policy for the given number of ticks.
+    Return: The median time per tick and the controls set on the guests
+    """
+    controls = None
+    elapsed = []
+    for i in range(ticks):
+        host = make_host()
+        guest_list = make_guests(guests)
+        start = time.time()
+        e = Parser.Evaluator()
+        e.stack.set('Host', host, True)
+        e.stack.set('Guests', guest_list, True)
+        if compiled:
+            for expr in policy:
+                expr(e)
+        else:
+            for expr in policy:
+                e.eval(expr)
+        elapsed.append(time.time() - start)
+        controls = [g.controls for g in guest_list]
+    return statistics.median(elapsed), controls
+
+
+def bench_eval(args):
+    e = Parser.Evaluator()
+    code = Parser.get_code(e, read_policy('balloon.rules'))
+    compiled = Parser.compile_code(e, code)
+
+    interpreted_time, interpreted = run(code, args.guests, args.ticks, False)
+    compiled_time, result = run(compiled, args.guests, args.ticks, True)
+    if result != interpreted:
+        print("Results differ between the interpreter and the compiler!")
+        return 1
+
+    print("balloon.rules with %d guests, %d ticks" % (args.guests, args.ticks))
+    print("  interpreted: %8.2f ms/tick" % (interpreted_time * 1000))
+    print("  compiled:    %8.2f ms/tick" % (compiled_time * 1000))
+    print("  speedup:     %8.2fx" % (interpreted_time / compiled_time))
+    return 0
+
+
+def bench_parse(args):
+    sources = [read_policy(name) for name in
+               sorted(os.path.basename(f) for f in
+                      glob.glob(os.path.join(DOC_DIR, '*.rules')))]
+    policy = '\n'.join(sources * args.scale)
+
+    e = Parser.Evaluator()
+    start = time.time()
+    code = Parser.get_code(e, policy)
+    elapsed = time.time() - start
+
+    print("doc/*.rules x %d: %d bytes, %d lines, %d expressions" %
+          (args.scale, len(policy), policy.count('\n') + 1, len(code)))
+    print("  parse: %8.2f ms" % (elapsed * 1000))
+    return 0
+
+
+WITH_POLICY = """
+(defvar factor 0.95)
+(def target (guest)
+{
+    (defvar size (* guest.balloon_cur factor))
+    (let ((floor guest.balloon_min))
+        (max size floor))
+})
+(with Guests guest (guest.Control "balloon_target" (target guest)))
+"""
+
+
+def bench_with(args):
+    e = Parser.Evaluator()
+    compiled = Parser.compile_code(e, Parser.get_code(e, WITH_POLICY))
+    elapsed, controls = run(compiled, args.guests, args.ticks, True)
+
+    print("with loop over %d guests, %d ticks" % (args.guests, args.ticks))
+    print("  compiled: %8.2f ms/tick" % (elapsed * 1000))
+    return 0
+
+
+def bench_vector(args):
+    from mom.Policy import Vector
+    if not Vector.available():
+        print("NumPy is not available")
+        return 1
+
+    e = Parser.Evaluator()
+    code = Parser.get_code(e, read_policy('balloon.rules'))
+    scalar = Parser.compile_code(e, code)
+    vector = Parser.compile_code(e, code, vectorize=True)
+
+    scalar_time, scalar_result = run(scalar, args.guests, args.ticks, True)
+    vector_time, vector_result = run(vector, args.guests, args.ticks, True)
+    if scalar_result != vector_result:
+        print("Results differ between the scalar and the vector evaluation!")
+        return 1
+
+    print("balloon.rules with %d guests, %d ticks" % (args.guests, args.ticks))
+    print("  scalar: %8.2f ms/tick" % (scalar_time * 1000))
+    print("  vector: %8.2f ms/tick" % (vector_time * 1000))
+    print("  speedup: %7.2fx" % (scalar_time / vector_time))
+    return 0
+
+
+HISTORY_LENGTH = 10
+SUITE_GUESTS = '1,10,100,1000,5000'
+
+
+def make_config():
+    config = configparser.ConfigParser()
+    config.add_section('main')
+    config.set('main', 'sample-history-length', str(HISTORY_LENGTH))
+    config.add_section('__int__')
+    config.set('__int__', 'plot-subdir', '')
+    return config
+
+
+def make_monitor(config, name, collectors, properties, sample):
+    """
+    Create a Monitor holding a full statistics history, as if its collectors
+    had been running for sample-history-length intervals.  sample(i) returns
+    the data of the i-th collection.
+    """
+    monitor = Monitor(config, name)
+    monitor.config = config
+    monitor.fields = set()
+    monitor.optional_fields = set()
+    for c in collectors:
+        monitor.fields |= c.getFields(None)
+        monitor.optional_fields |= c.getOptionalFields(None)
+    monitor.optional_fields -= monitor.fields
+    monitor.properties.update(properties)
+    for i in range(HISTORY_LENGTH):
+        data = dict.fromkeys(monitor.valid_fields)
+        data.update(sample(i))
+        monitor._add_sample(data)
+    monitor.ready = True
+    return monitor
+
+
+def make_host_monitor(config, rand):
+    total = 256 * 2**20
+
+    def sample(i):
+        free = rand.randint(total // 20, total // 4)
+        return {'mem_available': total,
+                'mem_unused': free,
+                'mem_free': free + rand.randint(0, 2**20),
+                'swap_in': rand.randint(0, 100),
+                'swap_out': rand.randint(0, 100),
+                'anon_pages': rand.randint(total // 4, total // 2),
+                'swap_total': 8 * 2**20,
+                'swap_usage': rand.randint(0, 2**20),
+                'ksm_run': 1,
+                'ksm_pages_to_scan': 64 * (i + 1),
+                'ksm_sleep_millisecs': 10,
+                'ksm_full_scans': i,
+                'ksm_pages_shared': rand.randint(0, 2**20),
+                'ksm_pages_sharing': rand.randint(0, 2**21),
+                'ksm_pages_unshared': rand.randint(0, 2**20),
+                'ksm_pages_volatile': rand.randint(0, 2**16),
+                'ksm_merge_across_nodes': 1,
+                'ksm_shareable': rand.randint(total // 4, total // 2),
+                'ksmd_cpu_usage': rand.randint(0, 100)}
+
+    return make_monitor(config, 'host', [HostMemory, HostKSM], {}, sample)
+
+
+def make_guest_monitor(config, rand, i):
+    balloon_max = rand.choice([2**20, 2**21, 2**22, 2**23])
+    balloon_min = balloon_max // 8
+
+    def sample(n):
+        balloon_cur = rand.randint(balloon_max // 2, balloon_max)
+        unused = rand.randint(0, balloon_cur // 2)
+        return {'mem_available': balloon_cur,
+                'mem_unused': unused,
+                'mem_free': unused + rand.randint(0, 2**16),
+                'major_fault': rand.randint(0, 1000),
+                'minor_fault': rand.randint(0, 100000),
+                'swap_in': rand.randint(0, 100),
+                'swap_out': rand.randint(0, 100),
+                'balloon_cur': balloon_cur,
+                'balloon_max': balloon_max,
+                'balloon_min': balloon_min}
+
+    name = '%s-%d' % (rand.choice(['web', 'db', 'nomad', 'batch']), i)
+    properties = {'name': name, 'id': i, 'pid': 1000 + i,
+                  'uuid': '%032x' % i}
+    return make_monitor(config, name, [GuestMemory, GuestBalloon],
+                        properties, sample)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {'min': samples[0],
+            'median': statistics.median(samples),
+            'mean': statistics.mean(samples),
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max': samples[-1]}
+
+
+def bench_policy(name, text, count, args):
+    """
+    Time parsing and evaluating one policy with count guests.  Times are in
+    seconds, allocations in bytes.
+    """
+    config = make_config()
+    rand = random.Random(count)
+    host_monitor = make_host_monitor(config, rand)
+    guest_monitors = [make_guest_monitor(config, rand, i)
+                      for i in range(count)]
+
+    parse = []
+    for i in range(args.parse_runs):
+        policy = Policy(args.vectorize)
+        start = time.perf_counter()
+        if not policy.set_policy(name, text):
+            raise RuntimeError("Unable to load policy %s" % name)
+        parse.append(time.perf_counter() - start)
+
+    def entities():
+        return (host_monitor.interrogate(),
+                [m.interrogate() for m in guest_monitors])
+
+    # Warm up so every measured tick runs the same code
+    policy.evaluate(*entities())
+
+    latency = []
+    results = set()
+    for i in range(args.ticks):
+        host, guests = entities()
+        start = time.perf_counter()
+        results.add(policy.evaluate(host, guests))
+        latency.append(time.perf_counter() - start)
+
+    # Tracing slows everything down, so measure allocations separately
+    peak = []
+    retained = []
+    blocks = []
+    tracemalloc.start()
+    try:
+        for i in range(args.alloc_ticks):
+            host, guests = entities()
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            policy.evaluate(host, guests)
+            current, top = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            peak.append(top - base)
+            retained.append(current - base)
+            blocks.append(sum(max(0, s.count_diff) for s in
+                              after.compare_to(before, 'filename')))
+            del before, after
+    finally:
+        tracemalloc.stop()
+
+    return {'policy': name,
+            'guests': count,
+            'ok': results == {True},
+            'parse': summarize(parse),
+            'evaluate': summarize(latency),
+            'evaluate_per_guest': statistics.median(latency) / count,
+            'allocations': {'peak_bytes': statistics.median(peak),
+                            'retained_bytes': statistics.median(retained),
+                            'new_blocks': statistics.median(blocks)}}
+
+
+def bench_suite(args):
+    # The policy reports evaluation errors through logging only
+    logging.basicConfig(level=logging.ERROR)
+    counts = [int(c) for c in args.guests.split(',')]
+    names = sorted(os.path.basename(f) for f in
+                   glob.glob(os.path.join(DOC_DIR, '*.rules')))
+    if args.policies:
+        names = [n for n in names if n in args.policies.split(',')]
+
+    report = {
+        'benchmark': 'policy-suite',
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'vectorize': args.vectorize,
+        'ticks': args.ticks,
+        'sample_history_length': HISTORY_LENGTH,
+        'results': [],
+    }
+    for name in names:
+        text = read_policy(name)
+        for count in counts:
+            result = bench_policy(name, text, count, args)
+            report['results'].append(result)
+            sys.stderr.write("%-22s %5d guests: %9.3f ms/tick%s\n" %
+                             (name, count, result['evaluate']['median'] * 1000,
+                              '' if result['ok'] else ' (failed)'))
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0 if all(r['ok'] for r in report['results']) else 1
+
+
+def traced(fn):
+    """
+    Return the result of fn and the bytes it allocated and kept.
+    """
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+
+
+def count_nodes(code):
+    if isinstance(code, list):
+        return sum(count_nodes(item) for item in code)
+    return 1
+
+
+def bench_memory(args):
+    config = make_config()
+    rand = random.Random(0)
+    monitors, size = traced(lambda: [make_guest_monitor(config, rand, i)
+                                     for i in range(args.guests)])
+    print("Guest monitor:  %7d bytes/guest" % (size // args.guests))
+    entities, size = traced(lambda: [m.interrogate() for m in monitors])
+    print("Guest entity:   %7d bytes/guest" % (size // args.guests))
+
+    e = Parser.Evaluator()
+    for name in sorted(os.path.basename(f) for f in
+                       glob.glob(os.path.join(DOC_DIR, '*.rules'))):
+        text = read_policy(name)
+        # Leave out the allocations of the first parse, like lexer tables
+        Parser.get_code(e, text)
+        code, size = traced(lambda: Parser.get_code(e, text))
+        nodes = count_nodes(code)
+        print("%-22s %5d nodes %7.1f bytes/node" %
+              (name, nodes, size / float(nodes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Policy engine benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('eval', help="compiled vs. interpreted policy")
+    cmd.add_argument('--guests', type=int, default=500)
+    cmd.add_argument('--ticks', type=int, default=10)
+    cmd.set_defaults(func=bench_eval)
+
+    cmd = commands.add_parser('parse', help="policy parsing time")
+    cmd.add_argument('--scale', type=int, default=100)
+    cmd.set_defaults(func=bench_parse)
+
+    cmd = commands.add_parser('with', help="guest loop and scope handling")
+    cmd.add_argument('--guests', type=int, default=1000)
+    cmd.add_argument('--ticks', type=int, default=20)
+    cmd.set_defaults(func=bench_with)
+
+    cmd = commands.add_parser('vector', help="scalar vs. NumPy with loops")
+    cmd.add_argument('--guests', type=int, default=500)
+    cmd.add_argument('--ticks', type=int, default=20)
+    cmd.set_defaults(func=bench_vector)
+
+    cmd = commands.add_parser('suite', help="JSON report for doc/*.rules")
+    cmd.add_argument('--guests', default=SUITE_GUESTS,
+                     help="comma separated guest counts")
+    cmd.add_argument('--policies', help="comma separated doc/*.rules names")
+    cmd.add_argument('--ticks', type=int, default=20)
+    cmd.add_argument('--parse-runs', type=int, default=20)
+    cmd.add_argument('--alloc-ticks', type=int, default=3)
+    cmd.add_argument('--vectorize', action='store_true')
+    cmd.add_argument('--output', default='-', help="file name or - for stdout")
+    cmd.set_defaults(func=bench_suite)
+
+    cmd = commands.add_parser('memory', help="Entity and policy footprint")
+    cmd.add_argument('--guests', type=int, default=1000)
+    cmd.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
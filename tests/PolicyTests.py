@@ -0,0 +1,260 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import configparser
+import logging
+from unittest import mock
+
+import pytest
+from mom.Policy import Parser
+from mom.Policy import Policy as PolicyModule
+from mom.Policy.Policy import Policy
+from mom.PolicyEngine import PolicyEngine
+
+
+class Host(object):
+    def __init__(self):
+        self.controls = {}
+
+    def Control(self, name, val):
+        self.controls[name] = val
+
+
+@pytest.fixture
+def policy():
+    return Policy()
+
+
+def test_named_policies_order(policy):
+    assert policy.set_policy('20_second', '(Host.Control "order" 2)')
+    assert policy.set_policy('10_first', '(Host.Control "order" 1)')
+
+    host = Host()
+    assert policy.evaluate(host, [])
+    assert host.controls == {'order': 2}
+
+
+def test_only_changed_policy_is_parsed(policy):
+    policy.set_policy('10_a', '(defvar a 1)')
+    policy.set_policy('20_b', '(Host.Control "a" a)')
+
+    with mock.patch.object(PolicyModule, 'get_code',
+                           wraps=PolicyModule.get_code) as get_code:
+        policy.set_policy('20_b', '(Host.Control "a" (+ a 1))')
+    assert get_code.call_count == 1
+    assert get_code.call_args[0][1] == '(Host.Control "a" (+ a 1))'
+
+    host = Host()
+    assert policy.evaluate(host, [])
+    assert host.controls == {'a': 2}
+
+
+def test_bad_policy_keeps_program(policy):
+    policy.set_policy('10_a', '(Host.Control "a" 1)')
+    program = policy.program
+
+    assert policy.set_policy('10_a', '(Host.Control "a"') is False
+    assert policy.program is program
+    assert policy.get_strings('10_a') == '(Host.Control "a" 1)'
+
+
+def test_delete_policy(policy):
+    policy.set_policy('10_a', '(Host.Control "a" 1)')
+    policy.set_policy('10_a', None)
+    assert policy.get_strings() == {}
+    assert policy.program.code == []
+
+
+def test_set_policies(policy):
+    policy.set_policy('10_a', '(Host.Control "a" 1)')
+    with mock.patch.object(PolicyModule, 'Program',
+                           wraps=PolicyModule.Program) as program:
+        assert policy.set_policies({'20_b': '(Host.Control "b" 2)',
+                                    '30_c': '(Host.Control "c"'}) is False
+    # Published once, the bad policy is skipped
+    assert program.call_count == 1
+    assert sorted(policy.get_strings()) == ['10_a', '20_b']
+
+    assert policy.set_policies({None: '(Host.Control "d" 4)'}, clear=True)
+    host = Host()
+    assert policy.evaluate(host, [])
+    assert host.controls == {'d': 4}
+
+
+def test_cache(tmpdir):
+    policy_str = '(defvar a 3) (Host.Control "a" (+ a 0.5)) "text"'
+    policy = Policy(cache_dir=str(tmpdir))
+    assert policy.set_policy('10_a', policy_str)
+    assert len(tmpdir.listdir()) == 1
+
+    # A new instance, like after a restart, does not parse the policy
+    policy = Policy(cache_dir=str(tmpdir))
+    with mock.patch.object(PolicyModule, 'get_code',
+                           wraps=PolicyModule.get_code) as get_code:
+        assert policy.set_policy('10_a', policy_str)
+        assert policy.set_policy('20_b', '(Host.Control "b" 1)')
+    assert get_code.call_count == 1
+    assert len(tmpdir.listdir()) == 2
+
+    host = Host()
+    assert policy.evaluate(host, [])
+    assert host.controls == {'a': 3.5, 'b': 1}
+
+
+def test_cache_errors(tmpdir):
+    policy = Policy(cache_dir=str(tmpdir))
+    policy.set_policy('10_a', '(Host.Control "a" 1)')
+    tmpdir.listdir()[0].write('{"broken')
+
+    policy = Policy(cache_dir=str(tmpdir))
+    assert policy.set_policy('10_a', '(Host.Control "a" 1)')
+    host = Host()
+    assert policy.evaluate(host, [])
+    assert host.controls == {'a': 1}
+
+
+def test_evaluate_does_not_wait_for_updates(policy):
+    policy.set_policy('10_a', '(Host.Control "a" 1)')
+
+    host = Host()
+    with policy.policy_sem:
+        assert policy.evaluate(host, [])
+    assert host.controls == {'a': 1}
+
+
+def test_definitions_are_preloaded(policy):
+    policy.set_policy('10_a', """
+    (defvar limit (* 2 8))
+    (def bump (x) (+ x 1))
+    (set limit (bump limit))
+    (Host.Control "limit" limit)
+    """)
+    assert policy.program.variables['limit'] == 16
+    assert 'bump' in policy.program.funcs
+
+    # Changes made while evaluating do not leak into the next run
+    for i in range(2):
+        host = Host()
+        assert policy.evaluate(host, [])
+        assert host.controls == {'limit': 17}
+    assert policy.program.variables['limit'] == 16
+
+
+def test_definitions_used_early_are_not_preloaded(policy):
+    policy.set_policy('10_a', """
+    (def show () limit)
+    (defvar limit 16)
+    (def Host (x) x)
+    (defvar computed (Host.Control "limit" (show)))
+    """)
+    assert 'limit' not in policy.program.variables
+    assert 'computed' not in policy.program.variables
+    assert list(policy.program.funcs) == ['show']
+
+    host = Host()
+    assert policy.evaluate(host, [])
+    assert host.controls == {'limit': 16}
+
+
+class Stats(Host):
+    def __init__(self):
+        Host.__init__(self)
+        self.calls = 0
+
+    def StatAvg(self, name):
+        self.calls += 1
+        return 10
+
+
+@pytest.mark.parametrize('body, calls', [
+    # f is called three times, 3 and 3.0 are different arguments
+    ('(h.StatAvg "a")', 2),
+    ('(let ((b (* x 2))) { (defvar c b) (set c (+ c 1)) (h.StatAvg c) })', 2),
+    ('(twice x (h.StatAvg "a"))', 2),
+    ('(* (Host.StatAvg "a") x)', 2),
+    # Impure: reads a global, a variable it may not bind, sets a global
+    ('(+ (h.StatAvg "a") counter)', 3),
+    ('{ (if x (defvar y 1) 0) (h.StatAvg y) }', 3),
+    ('{ (set counter x) (h.StatAvg "a") }', 3),
+    ('{ (h.Control "a" 1) (h.StatAvg "a") }', 3),
+])
+def test_pure_functions_are_memoized(policy, body, calls):
+    policy.set_policy('10_a', """
+    (defvar counter 0)
+    (set counter 1)
+    (def twice (a b) (* 2 b))
+    (def f (h x) %s)
+    (def g (h) (+ (f h 3) (f h 3)))
+    (Host.Control "result" (+ (g Host) (f Host 3.0)))
+    """ % body)
+    for i in range(2):
+        host = Stats()
+        assert policy.evaluate(host, [])
+        assert host.calls == calls
+    result = host.controls['result']
+
+    with mock.patch.object(Parser.Compiler, 'is_pure', return_value=False):
+        policy.set_policy('10_a', policy.get_strings('10_a'))
+    host = Stats()
+    assert policy.evaluate(host, [])
+    assert host.calls == 3
+    assert host.controls['result'] == result
+
+
+def test_profile(policy):
+    assert policy.get_profile() == {'enabled': False}
+
+    policy.set_policy('10_a', """
+    (def double (x) (* x 2))
+    (with Guests guest (guest.Control "a" (double 3)))
+    """)
+    assert policy.set_profiling(True)
+    guests = [Host(), Host()]
+    for i in range(3):
+        assert policy.evaluate(Host(), guests)
+    assert guests[0].controls == {'a': 6}
+
+    profile = policy.get_profile()
+    assert profile['enabled']
+    assert profile['ticks'] == 3
+    assert profile['functions']['double']['calls'] == 6
+    # double is pure, so its body only runs once per tick
+    assert profile['builtins']['mul']['calls'] == 3
+    assert profile['calls']['guest.Control']['calls'] == 6
+    assert set(profile['expressions']) == {'10_a:2 (def', '10_a:3 (with'}
+    assert profile['loops']['10_a:3']['guests'] == 6
+    # Guests without a name are told apart by their index
+    assert sorted(profile['loops']['10_a:3']['by_guest']) == ['#0', '#1']
+    assert profile['loops']['10_a:3']['by_guest']['#1']['runs'] == 3
+    function = profile['functions']['double']
+    assert function['self'] <= function['total']
+
+    policy.reset_profile()
+    assert policy.get_profile()['ticks'] == 0
+
+    policy.set_profiling(False)
+    assert policy.get_profile() == {'enabled': False}
+
+
+def test_reset_unreadable_policy_dir(policy, tmpdir):
+    config = configparser.ConfigParser()
+    config.read_dict({'main': {'policy': '',
+                               'policy-dir': str(tmpdir.join('missing'))}})
+    engine = PolicyEngine.__new__(PolicyEngine)
+    engine.config = config
+    engine.logger = logging.getLogger('test')
+    engine.policy = policy
+    assert policy.set_policy('10_a', '(Host.Control "a" 1)')
+    assert not engine.rpc_reset_policy()
+    assert policy.get_strings() == {}
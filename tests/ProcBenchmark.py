@@ -0,0 +1,192 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+"""
+Micro benchmarks of the host side process lookups.
+
+  pids   Time finding the qemu pid of every guest of a fake /proc with the
+         PidIndex, compared to running ps axww once per guest
+  ksm    Time the HostKSM shareable memory estimate with fake qemu processes
+         running, compared to running pgrep and ps
+
+Usage: python tests/ProcBenchmark.py pids [--guests N] [--others N]
+       python tests/ProcBenchmark.py ksm [--guests N] [--runs N]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid as uuidlib
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+from mom.Collectors.HostKSM import HostKSM
+from mom.PidIndex import PidIndex
+
+
+def add_process(proc, pid, args, start=100):
+    directory = os.path.join(proc, str(pid))
+    os.mkdir(directory)
+    with open(os.path.join(directory, 'cmdline'), 'wb') as f:
+        f.write(b'\0'.join(args) + b'\0')
+    with open(os.path.join(directory, 'stat'), 'w') as f:
+        f.write('%d (%s) S%s %d 0\n' % (pid, args[0][-15:].decode(),
+                                        ' 0' * 18, start))
+
+
+def make_proc(root, guests, others):
+    """
+    Create a fake /proc with a qemu process per guest among other processes
+    and the libvirt pidfiles of half of the guests.
+    """
+    proc = os.path.join(root, 'proc')
+    run = os.path.join(root, 'run')
+    os.mkdir(proc)
+    os.mkdir(run)
+    domains = []
+    pid = 1000
+    for i in range(others):
+        add_process(proc, pid, [b'/usr/bin/daemon', b'--option=%d' % i])
+        pid += 1
+    for i in range(guests):
+        uuid = str(uuidlib.uuid4())
+        name = 'guest-%d' % i
+        args = [b'/usr/libexec/qemu-kvm', b'-name', b'guest=' + name.encode()]
+        args += [b'-machine', b'pc-q35,accel=kvm', b'-m', b'4096']
+        args += [b'-uuid', uuid.encode(), b'-smp', b'4']
+        args += [b'-drive', b'file=/var/lib/images/%s.qcow2' % name.encode()]
+        add_process(proc, pid, args)
+        if i % 2:
+            with open(os.path.join(run, name + '.pid'), 'w') as f:
+                f.write(str(pid))
+        domains.append((uuid, name, pid))
+        pid += 1
+    return proc, run, domains
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def ps_lookup(uuid):
+    # The lookup libvirtInterface made before the PidIndex
+    out = subprocess.Popen(["ps", "axww"], stdout=subprocess.PIPE) \
+        .communicate()[0].decode("utf-8")
+    return re.findall(r"^\s*(\d+)\s+.*" + uuid, out, re.M)
+
+
+def bench_pids(args):
+    with tempfile.TemporaryDirectory() as root:
+        proc, run, domains = make_proc(root, args.guests, args.others)
+
+        def lookup_all(index, names=True):
+            for uuid, name, pid in domains:
+                assert index.lookup(uuid, name if names else None) == pid
+
+        index = PidIndex(proc, ())
+        scan, _ = timed(lambda: lookup_all(index, False))
+        cached, _ = timed(lambda: lookup_all(index, False))
+        index = PidIndex(proc, [run])
+        pidfiles, _ = timed(lambda: lookup_all(index))
+        assert index.scans == 1
+
+    # Against the real process table, which the fake one does not replace
+    count = min(args.guests, 20)
+    ps, _ = timed(lambda: [ps_lookup(uuid) for uuid, _, _ in
+                           domains[:count]])
+    ps = ps / count * args.guests
+
+    print("%d guests among %d other processes" % (args.guests, args.others))
+    print("  ps axww per guest (%d run):        %8.2f ms" %
+          (count, ps * 1000))
+    print("  PidIndex, one /proc scan:          %8.2f ms" % (scan * 1000))
+    print("  PidIndex, half from pidfiles:      %8.2f ms" % (pidfiles * 1000))
+    print("  PidIndex, cached:                  %8.2f ms" % (cached * 1000))
+
+
+def spawn_guests(root, count):
+    """
+    Start processes looking like qemu to pgrep and to the PidIndex: a shell
+    named qemu-kvm with a -uuid argument, waiting for a sleep.
+    """
+    qemu = os.path.join(root, 'qemu-kvm')
+    os.symlink('/bin/sh', qemu)
+    return [subprocess.Popen([qemu, '-c', 'sleep 600; :', '-uuid',
+                              str(uuidlib.uuid4())],
+                             start_new_session=True)
+            for i in range(count)]
+
+
+def pgrep_estimate():
+    # The estimate HostKSM made before the PidIndex
+    pids = subprocess.Popen(["pgrep", "qemu"], stdout=subprocess.PIPE) \
+        .communicate()[0].split()
+    if len(pids) == 0:
+        return 0
+    out = subprocess.Popen(["ps", "-ovsz", "h"] + pids,
+                           stdout=subprocess.PIPE).communicate()[0]
+    return sum(int(mem) for mem in out.split())
+
+
+def bench_ksm(args):
+    try:
+        ksm = HostKSM({'interval': 5})
+    except Exception as e:
+        print("HostKSM unavailable: %s" % getattr(e, 'msg', e))
+        return 1
+    with tempfile.TemporaryDirectory() as root:
+        guests = spawn_guests(root, args.guests)
+        try:
+            time.sleep(0.5)
+            old, old_value = timed(lambda: [pgrep_estimate()
+                                            for i in range(args.runs)])
+            new, new_value = timed(lambda: [ksm.get_shareable_mem()
+                                            for i in range(args.runs)])
+        finally:
+            for guest in guests:
+                os.killpg(guest.pid, 15)
+                guest.wait()
+
+    print("%d qemu processes, %d runs" % (args.guests, args.runs))
+    print("  pgrep and ps:       %8.2f ms/run  %d kB" %
+          (old * 1000 / args.runs, old_value[-1]))
+    print("  statm:              %8.2f ms/run  %d kB" %
+          (new * 1000 / args.runs, new_value[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process lookup benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('pids', help="qemu pid lookups")
+    cmd.add_argument('--guests', type=int, default=500)
+    cmd.add_argument('--others', type=int, default=300)
+    cmd.set_defaults(func=bench_pids)
+
+    cmd = commands.add_parser('ksm', help="KSM shareable memory estimate")
+    cmd.add_argument('--guests', type=int, default=200)
+    cmd.add_argument('--runs', type=int, default=20)
+    cmd.set_defaults(func=bench_ksm)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
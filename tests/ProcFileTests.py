@@ -0,0 +1,101 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import os
+from unittest import mock
+
+import pytest
+from mom.Collectors import GuestNetworkDaemon
+from mom.Collectors.HostMemory import HostMemory
+from mom.Collectors.ProcFile import ProcFile
+from mom.Collectors.ProcFile import open_shared
+from mom.Collectors.ProcFile import parse_fields
+
+MEMINFO = """MemTotal:        8048280 kB
+MemFree:          553968 kB
+MemAvailable:    4215380 kB
+Active(anon):    2016908 kB
+HugePages_Total:       0
+Hugepagesize:       2048 kB
+"""
+
+VMSTAT = """nr_free_pages 138492
+pgfault 1234567890123
+pswpin 0
+"""
+
+
+def test_parse_fields():
+    assert parse_fields(MEMINFO) == parse_fields(MEMINFO.encode()) == {
+        'MemTotal': 8048280, 'MemFree': 553968, 'MemAvailable': 4215380,
+        'Active(anon)': 2016908, 'HugePages_Total': 0, 'Hugepagesize': 2048}
+    assert parse_fields(VMSTAT) == {'nr_free_pages': 138492,
+                                    'pgfault': 1234567890123, 'pswpin': 0}
+    assert parse_fields('') == {}
+
+
+def test_read(tmp_path):
+    path = tmp_path / 'meminfo'
+    path.write_text(MEMINFO * 10)
+    procfile = ProcFile(str(path), 16)
+    # The buffer grows to fit the file
+    assert procfile.read() == (MEMINFO * 10).encode()
+    path.write_text(VMSTAT)
+    assert procfile.read() == VMSTAT.encode()
+    assert procfile.fields() == parse_fields(VMSTAT)
+
+    value = tmp_path / 'pages_to_scan'
+    value.write_text('100\n')
+    assert ProcFile(str(value)).read_int() == 100
+    procfile.close()
+    procfile.close()
+
+
+def test_shared_fields(tmp_path):
+    path = tmp_path / 'vmstat'
+    path.write_text(VMSTAT)
+    procfile = open_shared(str(path))
+    assert open_shared(str(path)) is procfile
+    fields = procfile.fields(60)
+    path.write_text('pswpin 5\n')
+    assert procfile.fields(60) is fields
+    assert procfile.fields() == {'pswpin': 5}
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/meminfo'),
+                    reason="needs /proc")
+def test_host_memory():
+    collector = HostMemory({})
+    data = collector.collect()
+    assert set(data) == collector.getFields() | \
+        collector.getOptionalFields()
+    assert data['swap_in'] == data['swap_out'] == 0
+    assert 0 < data['mem_unused'] <= data['mem_free'] <= data['mem_available']
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/vmstat'), reason="needs /proc")
+def test_network_daemon_stats():
+    server = GuestNetworkDaemon._Server.__new__(GuestNetworkDaemon._Server)
+    server.socket = mock.Mock()
+    server.collector = HostMemory(None)
+    server.vmstat = open_shared('/proc/vmstat')
+    conn = mock.Mock()
+    conn.send.side_effect = len
+    server.send_stats(conn)
+    stats = dict(item.split(':')
+                 for item in conn.send.call_args[0][0].decode().split(','))
+    # The faults come from the vmstat HostMemory just parsed
+    vmstat = server.vmstat.fields(60)
+    assert int(stats['minor_fault']) == vmstat['pgfault']
+    assert int(stats['major_fault']) == vmstat['pgmajfault']
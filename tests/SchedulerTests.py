@@ -0,0 +1,98 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import threading
+import time
+
+import pytest
+from mom.Scheduler import Scheduler
+from TestHelpers import wait_for
+
+INTERVAL = 0.05
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler(2, 'Test')
+    scheduler.start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_periodic(scheduler):
+    runs = []
+    scheduler.add('a', lambda: runs.append(time.monotonic()), INTERVAL)
+    wait_for(lambda: len(runs) >= 4)
+    gaps = [b - a for a, b in zip(runs, runs[1:])]
+    assert min(gaps) > INTERVAL / 2
+    stats = scheduler.stats()
+    assert stats['workers'] == 2 and stats['jobs'] == 1
+    assert stats['runs'] >= 3
+    assert 0.0 <= stats['lateness']['mean'] <= stats['lateness']['max']
+
+
+def test_never_concurrent(scheduler):
+    lock = threading.Lock()
+    active = []
+    overlaps = []
+
+    def slow():
+        with lock:
+            overlaps.append(len(active))
+            active.append(1)
+        time.sleep(INTERVAL * 2.5)
+        with lock:
+            active.pop()
+
+    scheduler.add('slow', slow, INTERVAL)
+    wait_for(lambda: len(overlaps) >= 3)
+    assert overlaps == [0] * len(overlaps)
+    assert scheduler.stats()['skipped'] >= 2
+
+
+def test_phases_are_staggered():
+    scheduler = Scheduler(1)
+    start = time.monotonic()
+    for i in range(8):
+        scheduler.add(i, lambda: None, 1.0)
+    deadlines = sorted(deadline - start for deadline, seq, job in
+                       scheduler.heap)
+    assert deadlines[-1] < 1.0
+    assert min(b - a for a, b in zip(deadlines, deadlines[1:])) > 0.05
+
+
+def test_job_end(scheduler):
+    runs = {'once': 0, 'removed': 0, 'failing': 0}
+
+    def once():
+        runs['once'] += 1
+        return False
+
+    def removed():
+        runs['removed'] += 1
+
+    def failing():
+        runs['failing'] += 1
+        raise RuntimeError("collection failed")
+
+    scheduler.add('once', once, INTERVAL)
+    scheduler.add('removed', removed, INTERVAL)
+    scheduler.add('failing', failing, INTERVAL)
+    wait_for(lambda: runs['removed'] and runs['failing'] >= 2)
+    scheduler.remove('removed')
+    count = runs['removed']
+    time.sleep(INTERVAL * 3)
+    assert runs['once'] == 1
+    assert runs['removed'] <= count + 1
+    assert sorted(scheduler.jobs) == ['failing']
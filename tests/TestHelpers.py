@@ -0,0 +1,96 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+"""
+The configuration, hypervisor interface and waiting helpers shared by the
+GuestManager and Collector tests.
+"""
+import configparser
+import threading
+import time
+
+from mom.HypervisorInterfaces.HypervisorInterface import HypervisorInterface
+from mom.HypervisorInterfaces.HypervisorInterface import \
+    HypervisorInterfaceError
+from mom.HypervisorInterfaces.HypervisorInterface import call_each
+
+
+def make_config(**main):
+    """
+    Return a configuration with short intervals and no guest collectors, the
+    keyword arguments set [main] options with '-' spelled '_'.
+    """
+    config = configparser.ConfigParser()
+    config.read_dict({'main': {'sample-history-length': '5',
+                               'guest-manager-multi-thread': 'true',
+                               'guest-manager-interval': '1',
+                               'guest-manager-reconcile-interval': '60',
+                               'guest-monitor-interval': '1'},
+                      'guest': {'collectors': ''},
+                      '__int__': {'running': '1', 'plot-subdir': ''}})
+    for key, value in main.items():
+        config.set('main', key.replace('_', '-'), value)
+    return config
+
+
+class Interface(HypervisorInterface):
+    """
+    A hypervisor interface running the guests given, which records the
+    statistics calls made and reports guest events through event().  The
+    memory statistics of the guest 'broken' are not available.
+    """
+    def __init__(self, guests=()):
+        self.guests = list(guests)
+        self.handler = None
+        self.listings = 0
+        self.calls = []
+
+    def registerVmEventHandler(self, handler):
+        self.handler = handler
+        return True
+
+    def getVmList(self):
+        self.listings += 1
+        return list(self.guests)
+
+    def getVmInfo(self, id):
+        return {'name': id, 'uuid': id}
+
+    def getVmMemoryStats(self, uuid):
+        self.calls.append(('getVmMemoryStats', uuid))
+        if uuid == 'broken':
+            raise HypervisorInterfaceError("no guest agent")
+        return {'mem_available': len(uuid)}
+
+    def getVmBalloonInfo(self, uuid):
+        self.calls.append(('getVmBalloonInfo', uuid))
+        return dict.fromkeys(['balloon_cur', 'balloon_max', 'balloon_min'],
+                             len(uuid))
+
+    def getAllVmMemoryStats(self, uuids):
+        self.calls.append(('getAllVmMemoryStats', tuple(uuids)))
+        return call_each(self.getVmMemoryStats, uuids)
+
+    def event(self, id, running):
+        # Events come from a thread of the interface
+        thread = threading.Thread(target=self.handler, args=(id, running))
+        thread.start()
+        thread.join()
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
@@ -0,0 +1,154 @@
+# Memory Overcommitment Manager
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+import logging
+import os
+import random
+
+import pytest
+from mom.Policy import Parser
+from mom.Policy import Vector
+
+pytest.importorskip('numpy')
+
+DOC_DIR = os.path.join(os.path.dirname(__file__), '..', 'doc')
+
+
+class Guest(object):
+    def __init__(self, stats, props):
+        self.stats = stats
+        self.props = props
+        self.controls = {}
+        for key, val in stats.items():
+            setattr(self, key, val)
+
+    def Stat(self, name):
+        return self.stats[name]
+
+    def StatAvg(self, name):
+        return float(self.stats[name])
+
+    def Prop(self, name):
+        return self.props[name]
+
+    def Control(self, name, val):
+        self.controls[name] = val
+
+
+def make_guests(seed, count=40):
+    rand = random.Random(seed)
+    guests = []
+    for i in range(count):
+        balloon_max = rand.choice([2**20, 2**21, 2**22])
+        balloon_cur = rand.randint(balloon_max // 4, balloon_max)
+        guests.append(Guest({'balloon_cur': balloon_cur,
+                             'balloon_max': balloon_max,
+                             'balloon_min': rand.randint(0, balloon_cur),
+                             'mem_unused': rand.randint(0, balloon_cur),
+                             'mem_free': rand.randint(0, balloon_cur)},
+                            {'name': rand.choice(['web', 'nomad'])}))
+    return guests
+
+
+def make_host(seed):
+    rand = random.Random(seed)
+    return Guest({'mem_available': 2**24,
+                  'mem_free': rand.randint(0, 2**24)}, {})
+
+
+def evaluate(policy, seed, vectorize):
+    e = Parser.Evaluator()
+    code = Parser.compile_code(e, Parser.get_code(e, policy), vectorize)
+    guests = make_guests(seed)
+    e.stack.set('Host', make_host(seed), True)
+    e.stack.set('Guests', guests, True)
+    try:
+        results = [expr(e) for expr in code]
+    except Exception as error:
+        results = repr(error)
+    return results, [guest.controls for guest in guests]
+
+
+def verify_same(policy, seeds=range(10)):
+    for seed in seeds:
+        assert evaluate(policy, seed, True) == evaluate(policy, seed, False)
+
+
+@pytest.mark.parametrize('name', ['balloon.rules', 'balloon-qos.rules',
+                                  'guest-specific.rules'])
+def test_doc_policies(name, caplog):
+    with open(os.path.join(DOC_DIR, name)) as f:
+        policy = f.read()
+    with caplog.at_level(logging.DEBUG, logger='mom.Policy.Vector'):
+        verify_same(policy)
+    assert "scalar path" not in caplog.text
+
+
+@pytest.mark.parametrize('body', [
+    '(guest.Control "a" (- guest.balloon_cur (* 0.1 guest.mem_free)))',
+    '(if (< guest.mem_free guest.mem_unused)'
+    ' (guest.Control "b" (/ guest.mem_free 3)) (max 1 2.5 guest.balloon_min))',
+    '(and (> guest.balloon_cur 0) (min guest.mem_free 7))',
+    '(or (< guest.balloon_cur 0) (== (guest.Prop "name") "nomad"))',
+    '(let ((a (* (* guest.balloon_cur guest.balloon_cur) guest.balloon_cur)))'
+    ' (<< a 3))',
+    '(if (> guest.mem_free 500000) (defvar z 1) (defvar z 2.5))',
+    '(not (abs (- guest.mem_free guest.balloon_cur)))',
+])
+def test_same_results(body, caplog):
+    policy = """
+    (def f (guest x) {
+        (defvar y (* x 2))
+        (if (> y 1000000) (set y (- y 7)) 0)
+        (+ y guest.mem_free)
+    })
+    (with Guests guest (guest.Control "f" (f guest guest.balloon_cur)))
+    (with Guests guest %s)
+    """ % body
+    with caplog.at_level(logging.DEBUG, logger='mom.Policy.Vector'):
+        verify_same(policy)
+    assert "scalar path" not in caplog.text
+
+
+@pytest.mark.parametrize('body', [
+    '(/ 100 (- guest.mem_free guest.mem_free))',
+    '{ (if (> guest.mem_free 500000) (defvar z 1) 0) z }',
+    '(+ (Host.StatAvg "mem_free") guest)',
+    '(debug guest.mem_free)',
+])
+def test_scalar_fallback(body, caplog):
+    policy = "(defvar z 0) (with Guests guest %s)" % body
+    with caplog.at_level(logging.DEBUG, logger='mom.Policy.Vector'):
+        verify_same(policy, seeds=[0])
+    assert "scalar path" in caplog.text
+
+
+def test_controls_not_set_on_fallback():
+    policy = """
+    (with Guests guest {
+        (guest.Control "a" 1)
+        (/ 1 (- guest.mem_free guest.mem_free))
+    })
+    """
+    results, controls = evaluate(policy, 0, True)
+    assert results.startswith('ZeroDivisionError')
+    # Only the guest the scalar path got to is changed
+    assert controls[0] == {'a': 1}
+    assert all(c == {} for c in controls[1:])
+
+
+def test_few_guests_use_scalar_path():
+    e = Parser.Evaluator()
+    guests = make_guests(0, Vector.MIN_ITEMS - 1)
+    assert Vector.run(e, guests, 'guest', Parser.get_code(e, '1')[0]) is None